@@ -2,41 +2,254 @@
 # Python flask server to interact with webGL.
 # Octavio Navarro. 2024
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS, cross_origin
-from parkAgents.model import ParkModel
-from parkAgents.agent import Bike, Traffic_Light, Destination, Obstacle, Road
+from frame_cache import FrameCache
+from parkAgents.compiled import PARK_FILES, compile_map
+from parkAgents.metrics import MetricsRegistry, merge_snapshots, render
+from prefetch import PrefetchRegistry, agents_json, merged_json
+from replay import ReplayRegistry
+from sessions import SessionRegistry, UnknownSession
+from streams import RateConflict, StreamRegistry
+import argparse
+import json
+import os
+import threading
+import time
 import traceback
 
-# Size of the board:
-parkModel = None
-currentStep = 0
+# Sessions of the server. Each client gets its own model, which lives in one
+# of the registry's worker processes. Created on the first request, so that
+# the worker processes are only started by the process that serves requests.
+sessions = None
+streams = None
+frames = None
+prefetchers = None
+sessionsLock = threading.Lock()
+
+# Metrics of the server process. The metrics of the models are collected by
+# their worker processes and added up by /metrics.
+serverMetrics = MetricsRegistry()
+requestSeconds = serverMetrics.histogram(
+    "park_http_request_seconds", "Time spent handling requests, by endpoint.", ["endpoint"]
+)
+serializeSeconds = serverMetrics.histogram(
+    "park_http_serialize_seconds",
+    "Time spent serializing response bodies, including getting them from the workers, by endpoint.",
+    ["endpoint"],
+)
+openSessions = serverMetrics.gauge("park_sessions", "Open simulation sessions.")
+
+# Trace file replayed by every session instead of simulating, set by --replay.
+replayFile = None
+
+# Map used when /init does not ask for one.
+DEFAULT_MAP = "2024_base.txt"
+
+# Maps in park_files that /init can load.
+mapFiles = sorted(
+    mapFile for mapFile in os.listdir(PARK_FILES) if mapFile.endswith(".txt")
+)
 
 # This application will be used to interact with WebGL
 app = Flask("Park example")
 cors = CORS(app, origins=["http://localhost"])
 
 
+@app.before_request
+def startTimer():
+    request.environ["park.start"] = time.perf_counter()
+
+
+@app.after_request
+def observeRequest(response):
+    start = request.environ.get("park.start")
+    if start is not None and request.endpoint is not None:
+        requestSeconds.observe(time.perf_counter() - start, endpoint=request.endpoint)
+    return response
+
+
+def serialized(build):
+    """
+    Calls build, which returns a serialized response body, and records the
+    time it took in /metrics.
+    """
+    start = time.perf_counter()
+    body = build()
+    serializeSeconds.observe(time.perf_counter() - start, endpoint=request.endpoint)
+    return body
+
+
+def getSessions():
+    global sessions
+
+    with sessionsLock:
+        if sessions is None:
+            if replayFile is not None:
+                sessions = ReplayRegistry(replayFile)
+            else:
+                sessions = SessionRegistry()
+    return sessions
+
+
+def getStreams():
+    global streams
+
+    sessions = getSessions()
+    with sessionsLock:
+        if streams is None:
+            streams = StreamRegistry(sessions)
+    return streams
+
+
+def getFrames():
+    global frames
+
+    sessions = getSessions()
+    with sessionsLock:
+        if frames is None:
+            frames = FrameCache(sessions)
+    return frames
+
+
+def getPrefetchers():
+    global prefetchers
+
+    sessions = getSessions()
+    with sessionsLock:
+        if prefetchers is None:
+            prefetchers = PrefetchRegistry(sessions)
+    return prefetchers
+
+
+def cachedResponse(key, mimetype, static=False, build=None, version=None):
+    """
+    Returns the response for a frame of the request's session, serialized
+    by its Simulation's json method, or by the method itself for binary
+    frames, only the first time it is asked for.
+    Answers 304 when the client already has the frame, and sends it gzip
+    compressed to clients that accept it.
+    Args:
+        key: (command, *args) of the Simulation method that makes the frame
+        mimetype: Type of the frame
+        static: Whether the frame stays the same for the whole session
+        build: Function that makes the frame instead of the Simulation
+        version: Version of the frame, see FrameCache.get
+    """
+    if build is None:
+        command, *args = key
+        if mimetype == "application/json":
+            build = lambda: sessionCall("json", command, *args)
+        else:
+            build = lambda: sessionCall(command, *args)
+    frame = getFrames().get(
+        request.args.get("session"), key, lambda: serialized(build), static, version
+    )
+
+    # The compressed body has its own ETag, since it is another representation.
+    compressed = "gzip" in request.accept_encodings
+    etag = frame.compressed_etag if compressed else frame.etag
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    elif compressed:
+        response = Response(frame.compressed(), mimetype=mimetype)
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(frame.body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def sessionCall(command, *args):
+    """
+    Runs a command on the model of the session given in the request's
+    ?session= argument.
+    """
+    return getSessions().call(request.args.get("session"), command, *args)
+
+
+def sessionPrefetcher():
+    """
+    Returns the FramePrefetcher of the request's session, or None if the
+    session does not prefetch its frames.
+    """
+    return getPrefetchers().get(request.args.get("session"))
+
+
+def prefetchedVersion(frame):
+    # Version of the cached frames of a prefetching session, which change
+    # when its client moves to another frame instead of when it is stepped.
+    # Taken from the frame the body is made of, since the prefetcher may
+    # move the client on before the frame is cached.
+    return f"p{frame['currentStep']}"
+
+
+def unknownSession():
+    return (
+        jsonify(
+            {"message": f"Unknown session {request.args.get('session')}, call /init"}
+        ),
+        404,
+    )
+
+
 # This route will be used to send the parameters of the simulation to the server.
-# The servers expects a POST request with the parameters in a.json.
+# The servers expects a GET request, optionally with the name of one of the maps in park_files as ?map=.
+# It returns the id of a new session, that must be sent as ?session= to the other routes.
+# When the server replays a trace, the session starts at its first step and the map is the recorded one.
+# With ?prefetch=<n>, the server steps the model up to n steps ahead of the client, so that
+# /update, /getAgents, /getFrame and /advance only read the next frame.
+# With ?profile=1, the phases of every step are timed, see /getProfile.
 @app.route("/init", methods=["GET"])
 @cross_origin()
 def initModel():
-    global currentStep, parkModel
-
     if request.method == "GET":
         try:
-            currentStep = 0
+            if replayFile is not None:
+                session, info = getSessions().create()
+                return jsonify(
+                    {
+                        "message": "Replay initiated.",
+                        "session": session,
+                        "prefetch": 0,
+                        **info,
+                    }
+                )
+
+            mapFile = request.args.get("map", DEFAULT_MAP)
+            if mapFile not in mapFiles:
+                return (
+                    jsonify({"message": f"Unknown map {mapFile}", "maps": mapFiles}),
+                    404,
+                )
+
+            engine = request.args.get("engine", "agents")
+            if engine not in ["agents", "vector"]:
+                return jsonify({"message": f"Unknown engine {engine}"}), 400
+
+            seed = request.args.get("seed", type=int)
+
+            profile = request.args.get("profile", "0") in ["1", "true"]
+
+            prefetch = request.args.get("prefetch", 0, type=int)
+            if not 0 <= prefetch <= 1024:
+                return jsonify({"message": "Invalid prefetch"}), 400
 
             # Create the model using the parameters sent by the application
-            parkModel = ParkModel()
+            session, info = getSessions().create(
+                mapFile, engine=engine, verbose=False, seed=seed, profile=profile
+            )
+            if prefetch:
+                getPrefetchers().start(session, prefetch)
 
             # Return a message to saying that the model was created successfully
             return jsonify(
                 {
                     "message": "Parameters recieved, model initiated.",
-                    "width": parkModel.width,
-                    "height": parkModel.height,
+                    "session": session,
+                    "prefetch": prefetch,
+                    **info,
                 }
             )
 
@@ -50,68 +263,105 @@ def initModel():
 @app.route("/getAgents", methods=["GET"])
 @cross_origin()
 def getAgents():
-    global parkModel
-
     if request.method == "GET":
         # Get the positions of the agents and return them to WebGL in JSON.json.t.
         # Note that the positions are sent as a list of dictionaries, where each dictionary has the id and position of an agent.
         # The y coordinate is set to 1, since the agents are in a 3D world. The z coordinate corresponds to the row (y coordinate) of the grid in mesa.
+        # With ?since=<step>, only the agents that changed after that step are sent, along with the ids of the agents that were removed.
+        # The response is serialized once per step and shared by every client of the session.
+        # When replaying a trace, ?step=<n> returns the agents after any recorded step, which never change.
         try:
-            agentInfo = [
-                {
-                    "id": str(a.unique_id),
-                    "x": x,
-                    "y": 1,
-                    "z": z,
-                    "direction": a.direction,
-                }
-                for agents, (x, z) in parkModel.grid.coord_iter()
-                for a in agents
-                if isinstance(a, Bike)
-            ]
+            since = request.args.get("since", type=int)
+            step = request.args.get("step", type=int)
+            if step is not None:
+                if replayFile is None:
+                    return jsonify({"message": "?step= is only available in replays"}), 400
+                return cachedResponse(("agents_at", step), "application/json", static=True)
 
-            return jsonify({"agents": agentInfo})
+            prefetcher = sessionPrefetcher()
+            if prefetcher is not None:
+                frame = prefetcher.current
+                return cachedResponse(
+                    ("agents", since),
+                    "application/json",
+                    build=lambda: agents_json(frame, since),
+                    version=prefetchedVersion(frame),
+                )
+            return cachedResponse(("agents", since), "application/json")
+        except UnknownSession:
+            return unknownSession()
         except Exception as e:
             print(traceback.format_exc())
             print(e)
             return jsonify({"message": "Error with the agent positions"}), 500
 
 
+# This route will be used to get the positions of the agents as a packed binary frame
+# The frame is a little-endian header with the step (uint32) and the number of agents (uint32),
+# followed by a record per agent with its id (int32), x (uint16), z (uint16) and direction code (uint8),
+# where the direction codes are 1 Up, 2 Down, 3 Left and 4 Right.
+@app.route("/getFrame", methods=["GET"])
+@cross_origin()
+def getFrame():
+    if request.method == "GET":
+        try:
+            prefetcher = sessionPrefetcher()
+            if prefetcher is not None:
+                frame = prefetcher.current
+                return cachedResponse(
+                    ("frame",),
+                    "application/octet-stream",
+                    build=lambda: frame["frame"],
+                    version=prefetchedVersion(frame),
+                )
+            return cachedResponse(("frame",), "application/octet-stream")
+        except UnknownSession:
+            return unknownSession()
+        except Exception as e:
+            print(traceback.format_exc())
+            print(e)
+            return jsonify({"message": "Error with the agent frame"}), 500
+
+
+# This route will be used to get the statistics of the simulation
+# The counters are kept up to date by the model as the bikes spawn, move, wait and leave,
+# so reading them does not count the bikes.
+# Prefetching sessions return the statistics of the frame the client is at, not of the model ahead of it.
+@app.route("/getStats", methods=["GET"])
+@cross_origin()
+def getStats():
+    if request.method == "GET":
+        try:
+            prefetcher = sessionPrefetcher()
+            if prefetcher is not None:
+                frame = prefetcher.current
+                return cachedResponse(
+                    ("stats",),
+                    "application/json",
+                    build=lambda: frame["stats"],
+                    version=prefetchedVersion(frame),
+                )
+            return cachedResponse(("stats",), "application/json")
+        except UnknownSession:
+            return unknownSession()
+        except Exception as e:
+            print(traceback.format_exc())
+            print(e)
+            return jsonify({"message": "Error with the statistics"}), 500
+
+
 # This route will be used to get the positions of the obstacles
 @app.route("/getMap", methods=["GET"])
 @cross_origin()
 def getObstacles():
-    global parkModel
-
     if request.method == "GET":
         try:
             # Get the positions of the obstacles and return them to WebGL in JSON.json.t.
             # Same as before, the positions are sent as a list of dictionaries, where each dictionary has the id and position of an obstacle.
-            map_tiles = {
-                "obstacles": [],
-                "roads": [],
-                "traffic_lights": [],
-                "destinations": [],
-            }
-            for agents, (x, y) in parkModel.grid.coord_iter():
-                for a in agents:
-                    agent_info = {
-                        "id": str(a.unique_id),
-                        "x": x,
-                        "y": 1,
-                        "z": y,
-                    }
-                    if isinstance(a, Obstacle):
-                        map_tiles["obstacles"].append(agent_info)
-                    elif isinstance(a, Road):
-                        map_tiles["roads"].append(agent_info)
-                    elif isinstance(a, Traffic_Light):
-                        agent_info["direction"] = a.direction
-                        map_tiles["traffic_lights"].append(agent_info)
-                    elif isinstance(a, Destination):
-                        map_tiles["destinations"].append(agent_info)
-
-            return jsonify({"map": map_tiles})
+            # The tiles are read from the model's static tile layer, and serialized once per session since they never change.
+            return cachedResponse(("map_info",), "application/json", static=True)
+        except UnknownSession:
+            return unknownSession()
         except Exception as e:
             print(traceback.format_exc())
             print(e)
@@ -122,27 +372,245 @@ def getObstacles():
 @app.route("/update", methods=["GET"])
 @cross_origin()
 def updateModel():
-    global currentStep, parkModel
     if request.method == "GET":
         try:
             # Update the model and return a message to WebGL saying that the model was updated successfully
-            parkModel.step()
-            currentStep += 1
-            if not parkModel.running:
+            # Sessions that prefetch their frames only move to the next frame, which is usually ready.
+            prefetcher = sessionPrefetcher()
+            if prefetcher is not None:
+                prefetcher.advance(1)
+                result = prefetcher.current
+            else:
+                result = sessionCall("update")
+            currentStep = result["currentStep"]
+            if not result["running"]:
                 print("\033[38;5;9mSIMULATION ENDED!\033[0m")
             return jsonify(
                 {
                     "message": f"Model updated to step {currentStep}.",
                     "currentStep": currentStep,
-                    "running": parkModel.running,
+                    "running": result["running"],
                 }
             )
+        except UnknownSession:
+            return unknownSession()
+        except Exception as e:
+            print(traceback.format_exc())
+            print(e)
+            return jsonify({"message": "Error during step."}), 500
+
+
+# This route will be used to update the model several steps and get the agents in a single request
+# ?steps= is the number of steps (1 by default, 1024 at most), and ?frames= chooses the agents that are sent:
+# "last" (default) for the agents after the last step, "all" for the agents after every step, or "none".
+# With ?format=binary the frames are sent as consecutive /getFrame frames, and the step and
+# running state in the X-Current-Step and X-Running headers. ?since= works as in /getAgents.
+@app.route("/advance", methods=["GET"])
+@cross_origin()
+def advanceModel():
+    if request.method == "GET":
+        try:
+            steps = request.args.get("steps", 1, type=int)
+            frames = request.args.get("frames", "last")
+            binary = request.args.get("format", "json") == "binary"
+            # The steps are capped, since the request holds the session's
+            # worker, and with ?frames=all a frame per step, until they are done.
+            if not 1 <= steps <= 1024 or frames not in ["last", "all", "none"]:
+                return jsonify({"message": "Invalid steps or frames"}), 400
+
+            since = request.args.get("since", type=int)
+            prefetcher = sessionPrefetcher()
+            if prefetcher is not None:
+                return prefetchedAdvance(prefetcher, steps, frames, binary, since)
+
+            result = sessionCall("advance", steps, frames, binary, since)
+            if not result["running"]:
+                print("\033[38;5;9mSIMULATION ENDED!\033[0m")
+
+            if binary:
+                return Response(
+                    b"".join(result["frames"]),
+                    mimetype="application/octet-stream",
+                    headers={
+                        "X-Current-Step": str(result["currentStep"]),
+                        "X-Running": str(result["running"]).lower(),
+                    },
+                )
+            return serialized(
+                lambda: jsonify(
+                    {
+                        "message": f"Model updated to step {result['currentStep']}.",
+                        **result,
+                    }
+                )
+            )
+        except UnknownSession:
+            return unknownSession()
         except Exception as e:
             print(traceback.format_exc())
             print(e)
             return jsonify({"message": "Error during step."}), 500
 
 
+def prefetchedAdvance(prefetcher, steps, frames, binary, since):
+    """
+    Returns the /advance response of a session that prefetches its frames,
+    joining the frames it already serialized.
+    """
+    moved = prefetcher.advance(steps)
+    current = prefetcher.current
+    if not current["running"]:
+        print("\033[38;5;9mSIMULATION ENDED!\033[0m")
+
+    if frames == "all":
+        selected = moved
+    elif frames == "last":
+        selected = [current]
+    else:
+        selected = []
+
+    if binary:
+        return Response(
+            b"".join(frame["frame"] for frame in selected),
+            mimetype="application/octet-stream",
+            headers={
+                "X-Current-Step": str(current["currentStep"]),
+                "X-Running": str(current["running"]).lower(),
+            },
+        )
+
+    def build():
+        # The changes of the frames that are skipped are merged into the last one.
+        if frames == "last" and len(moved) > 1:
+            bodies = [merged_json(moved, since)]
+        else:
+            bodies = []
+            previous = since
+            for frame in selected:
+                bodies.append(agents_json(frame, previous))
+                previous = None if previous is None else frame["step"]
+
+        header = json.dumps(
+            {
+                "message": f"Model updated to step {current['currentStep']}.",
+                "currentStep": current["currentStep"],
+                "running": current["running"],
+                "steps": len(moved),
+            },
+            separators=(",", ":"),
+        ).encode()
+        return header[:-1] + b',"frames":[' + b",".join(bodies) + b"]}"
+
+    return Response(serialized(build), mimetype="application/json")
+
+
+# This route will be used to stream the agents with Server-Sent Events
+# The server steps the model ?rate= times per second (2 by default) and sends the agents after every step,
+# as in /getAgents, together with currentStep and running. Slow clients skip frames instead of delaying the
+# simulation. An "end" event is sent when the simulation stops.
+# Every client of a session sees the same steps, so a client that asks for another rate than the one other
+# clients are streaming at gets a 409 with the current rate. Without ?rate= it joins at the current rate.
+@app.route("/stream", methods=["GET"])
+@cross_origin()
+def streamAgents():
+    if request.method == "GET":
+        session = request.args.get("session")
+        if session not in getSessions():
+            return unknownSession()
+
+        rate = request.args.get("rate", type=float)
+        if rate is not None and not 0 < rate <= 1000:
+            return jsonify({"message": "Invalid rate"}), 400
+
+        # The stream steps the model itself, so the session stops prefetching.
+        getPrefetchers().stop(session)
+        try:
+            stream, subscriber = getStreams().subscribe(session, rate)
+        except RateConflict as e:
+            return jsonify({"message": str(e), "rate": e.rate}), 409
+
+        def events():
+            try:
+                while True:
+                    frame = subscriber.get(timeout=15)
+                    if frame is not None:
+                        yield f"data: {frame}\n\n"
+                    elif subscriber.closed:
+                        yield "event: end\ndata: {}\n\n"
+                        return
+                    else:
+                        # Comment lines keep idle connections open.
+                        yield ": keep-alive\n\n"
+            finally:
+                stream.unsubscribe(subscriber)
+
+        return Response(
+            events(),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+
+# This route will be used to get the profile of a session created with /init?profile=1
+# It returns the calls and time of every phase, the slowest steps and the slowest bikes, or with
+# ?format=collapsed the phases as collapsed stacks for flame graph tools. The same files are written
+# to the profiles folder when the simulation ends.
+@app.route("/getProfile", methods=["GET"])
+@cross_origin()
+def getProfile():
+    if request.method == "GET":
+        try:
+            collapsed = request.args.get("format") == "collapsed"
+            profile = sessionCall("profile", collapsed)
+            if profile is None:
+                return jsonify({"message": "The session is not profiled, use /init?profile=1"}), 404
+            if collapsed:
+                return Response(profile, mimetype="text/plain")
+            return jsonify(profile)
+        except UnknownSession:
+            return unknownSession()
+        except Exception as e:
+            print(traceback.format_exc())
+            print(e)
+            return jsonify({"message": "Error with the profile"}), 500
+
+
+# This route will be used to monitor the server, in the Prometheus text format
+# It has histograms of the time of each step of the models by phase and of the time spent on each
+# endpoint, and counters of routes, replans and bikes, added up over every worker process.
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    if request.method == "GET":
+        openSessions.set(len(getSessions()))
+        snapshot = merge_snapshots(getSessions().metrics(), serverMetrics.snapshot())
+        return Response(render(snapshot), mimetype="text/plain; version=0.0.4")
+
+
+# This route will be used to close a session and free its model
+@app.route("/close", methods=["GET"])
+@cross_origin()
+def closeSession():
+    if request.method == "GET":
+        getStreams().stop(request.args.get("session"))
+        getPrefetchers().stop(request.args.get("session"))
+        getSessions().close(request.args.get("session"))
+        return jsonify({"message": "Session closed."})
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve park simulations to WebGL.")
+    parser.add_argument(
+        "--replay",
+        metavar="TRACE",
+        help="Replay a trace recorded with batch_run.py --record instead of simulating.",
+    )
+    replayFile = parser.parse_args().replay
+
+    # Compile every map before serving, so that the workers only have to
+    # read them from the cache.
+    if replayFile is None:
+        for mapFile in mapFiles:
+            compile_map(mapFile)
+
     # Run the flask server in port 8585
     app.run(host="localhost", port=8585, debug=True)
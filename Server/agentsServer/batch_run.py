@@ -0,0 +1,247 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Headless batch runner for the park model.
+# Runs seeded replications of a park map in a process pool and writes the
+# statistics of every run as a CSV table.
+
+from concurrent.futures import ProcessPoolExecutor
+from map_generator import generate_map, parse_size, write_map
+from parkAgents.model import ParkModel
+from parkAgents.recording import TraceRecorder
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+
+# Columns of the results table, in order.
+FIELDS = [
+    "run",
+    "seed",
+    "map",
+    "engine",
+    "detours",
+    "steps",
+    "bikes_spawned",
+    "bikes_in_model",
+    "bikes_arrived",
+    "bikes_moving",
+    "bikes_stopped",
+    "ratio_alive",
+    "ratio_arrived",
+    "ratio_moving",
+    "ratio_stopped",
+    "seconds",
+]
+
+
+def run_replication(
+    run,
+    seed,
+    map_file,
+    engine="agents",
+    max_steps=1000,
+    record_folder=None,
+    profile_folder=None,
+    detours=False,
+    map_name=None,
+    verbose=False,
+):
+    """
+    Runs one replication of a map until the model stops or max_steps is
+    reached, and returns its statistics as a dictionary. When record_folder
+    is given, the run is recorded there as run_<run>.trace, and when
+    profile_folder is given, its profile is written there as run_<run>.
+    The map column has map_name, or map_file when it is not given, and
+    verbose prints the statistics of every step.
+    """
+    start = time.perf_counter()
+    model = ParkModel(
+        map_file=map_file,
+        engine=engine,
+        verbose=verbose,
+        seed=seed,
+        profile=profile_folder is not None,
+        congestion_detours=detours,
+    )
+
+    recorder = None
+    if record_folder is not None:
+        recorder = TraceRecorder(
+            os.path.join(record_folder, f"run_{run}.trace"), model, map_file
+        )
+
+    while model.running and model.schedule.steps < max_steps:
+        model.step()
+        if recorder is not None:
+            recorder.capture()
+
+    if recorder is not None:
+        recorder.close()
+    if profile_folder is not None:
+        model.profiler.write(os.path.join(profile_folder, f"run_{run}"))
+
+    return {
+        "run": run,
+        "seed": seed,
+        "map": map_file if map_name is None else map_name,
+        "engine": model.engine_name,
+        "detours": detours,
+        "steps": model.schedule.steps,
+        "bikes_spawned": model.bikes_spawned,
+        "bikes_in_model": model.bikes_in_model,
+        "bikes_arrived": model.bikes_arrived,
+        "bikes_moving": model.bikes_moving,
+        "bikes_stopped": model.bikes_stopped,
+        "ratio_alive": model.ratio_alive,
+        "ratio_arrived": model.ratio_arrived,
+        "ratio_moving": model.ratio_moving,
+        "ratio_stopped": model.ratio_stopped,
+        "seconds": round(time.perf_counter() - start, 4),
+    }
+
+
+def run_batch(
+    map_file,
+    runs,
+    seed=0,
+    engine="agents",
+    max_steps=1000,
+    workers=None,
+    record_folder=None,
+    profile_folder=None,
+    detours=False,
+    map_name=None,
+    verbose=False,
+):
+    """
+    Runs replications with seeds seed, seed + 1, ... across a process pool
+    and returns their statistics in run order.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(
+            pool.map(
+                run_replication,
+                range(runs),
+                [seed + run for run in range(runs)],
+                [map_file] * runs,
+                [engine] * runs,
+                [max_steps] * runs,
+                [record_folder] * runs,
+                [profile_folder] * runs,
+                [detours] * runs,
+                [map_name] * runs,
+                [verbose] * runs,
+            )
+        )
+
+
+def write_results(results, output):
+    """
+    Writes the statistics of every run as CSV to a file object.
+    """
+    writer = csv.DictWriter(output, fieldnames=FIELDS)
+    writer.writeheader()
+    writer.writerows(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run seeded replications of a park map without the server."
+    )
+    parser.add_argument(
+        "--map",
+        default="2024_base.txt",
+        help="Name of a map in park_files or path of a map file.",
+    )
+    parser.add_argument(
+        "--generate",
+        metavar="WIDTHxHEIGHT",
+        help="Run on a generated map of this size instead of --map.",
+    )
+    parser.add_argument(
+        "--map-seed", type=int, default=0, help="Seed of the generated map."
+    )
+    parser.add_argument("--runs", type=int, default=10, help="Number of replications.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first run.")
+    parser.add_argument(
+        "--engine", choices=["agents", "vector"], default="agents"
+    )
+    parser.add_argument(
+        "--detours",
+        action="store_true",
+        help="Make impatient bikes take congestion aware detours, only with "
+        "the agents engine.",
+    )
+    parser.add_argument(
+        "--max-steps",
+        type=int,
+        default=1000,
+        help="Steps after which a run is stopped if the model is still running.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes.",
+    )
+    parser.add_argument(
+        "--output", help="CSV file for the results, printed to stdout if omitted."
+    )
+    parser.add_argument(
+        "--record",
+        metavar="FOLDER",
+        help="Record every run as a trace file in this folder, to replay it "
+        "with agents_server.py --replay.",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FOLDER",
+        help="Time the phases of every run and write their collapsed stacks "
+        "and summaries in this folder.",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Print the statistics of every step of every run.",
+    )
+    args = parser.parse_args(argv)
+
+    for folder in [args.record, args.profile]:
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    with tempfile.TemporaryDirectory() as folder:
+        map_file = args.map
+        map_name = None
+        if args.generate:
+            # The map file is deleted with the folder, so the results name
+            # the map by the parameters it was generated with.
+            width, height = parse_size(args.generate)
+            map_name = f"generated_{args.generate}_seed_{args.map_seed}"
+            map_file = os.path.join(folder, f"{map_name}.txt")
+            write_map(generate_map(width, height, seed=args.map_seed), map_file)
+
+        results = run_batch(
+            map_file,
+            args.runs,
+            seed=args.seed,
+            engine=args.engine,
+            max_steps=args.max_steps,
+            workers=args.workers,
+            record_folder=args.record,
+            profile_folder=args.profile,
+            detours=args.detours,
+            map_name=map_name,
+            verbose=args.verbose,
+        )
+
+    if args.output:
+        with open(args.output, "w", newline="") as output:
+            write_results(results, output)
+    else:
+        write_results(results, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Benchmark suite for the park model.
+# Times map compilation, model construction, graph and route generation,
+# route lookups and steady-state stepping for the shipped maps and tiled
+# scale-ups of them, and writes the results as JSON.
+
+from map_generator import generate_map, parse_size, write_map
+from parkAgents.compiled import PARK_FILES, CompiledMap, compile_map
+from parkAgents.graph import RoadGraph
+from parkAgents.model import ParkModel
+from parkAgents.agent import Bike
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+# Maps shipped in park_files.
+MAPS = ["2021_base.txt", "2022_base.txt", "2023_base.txt", "2024_base.txt"]
+
+# Area multipliers of the tiled versions of each map.
+SCALES = [1, 4, 16, 64]
+
+
+def tile_lines(lines, repeat):
+    """
+    Returns the lines of a map repeated repeat times in each direction.
+    """
+    rows = [line.rstrip("\n") for line in lines if line.strip()]
+    return [row * repeat + "\n" for _ in range(repeat) for row in rows]
+
+
+def scaled_map(map_file, scale, folder):
+    """
+    Returns the path of map_file tiled to scale times its area, written in
+    folder when the scale is larger than 1.
+    """
+    if scale == 1:
+        return map_file
+
+    repeat = math.isqrt(scale)
+    if repeat * repeat != scale:
+        raise ValueError(f"Scale {scale} is not a square number")
+
+    with open(os.path.join(PARK_FILES, map_file)) as baseFile:
+        lines = tile_lines(baseFile.readlines(), repeat)
+
+    path = os.path.join(folder, f"{os.path.splitext(map_file)[0]}_x{scale}.txt")
+    with open(path, "w") as scaledFile:
+        scaledFile.writelines(lines)
+    return path
+
+
+def generated_map(size, folder, seed=0):
+    """
+    Returns the path of a map of the given WIDTHxHEIGHT size made by the
+    map generator, written in folder.
+    """
+    width, height = parse_size(size)
+    path = os.path.join(folder, f"generated_{size}.txt")
+    write_map(generate_map(width, height, seed=seed), path)
+    return path
+
+
+def timed(function, *args, **kwargs):
+    """
+    Returns the result of a call and the seconds it took.
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def benchmark_map(map_file, scale, path, engine, warmup, steps, seed):
+    """
+    Runs every benchmark on one map and returns the results as a dictionary.
+    """
+    # Compiling is timed without the cache, then the model is created from
+    # the cached compiled map like the server does.
+    _, compile_seconds = timed(compile_map, path, cache_folder=None)
+    compile_map(path)
+    model, construct = timed(
+        ParkModel, map_file=path, engine=engine, verbose=False, seed=seed
+    )
+    # The graph and routes are built again apart from the model, so its
+    # engine and detours keep the ones they were created with.
+    graph, generate_graph = timed(RoadGraph.from_tiles, model.tiles)
+    _, generate_routes = timed(CompiledMap, None, model.tiles, graph)
+
+    for _ in range(warmup):
+        if not model.running:
+            break
+        model.step()
+
+    # Route lookups of the bikes in the model, or of every road for the
+    # vector engine, which does not have Bike agents.
+    if engine == "agents":
+        bikes = list(model.agents_by_type.get(Bike, ()))
+        _, get_route = timed(lambda: [bike.get_route() for bike in bikes])
+        lookups = len(bikes)
+    else:
+        destination = model.tiles.destinations[0]
+        roads = model.graph.positions
+        _, get_route = timed(
+            lambda: [model.next_hop(road, destination) for road in roads]
+        )
+        lookups = len(roads)
+
+    measured = 0
+    moves = 0
+    start = time.perf_counter()
+    while model.running and measured < steps:
+        model.step()
+        measured += 1
+        moves += model.count_moving()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "map": map_file,
+        "scale": scale,
+        "engine": engine,
+        "width": model.width,
+        "height": model.height,
+        "roads": len(model.graph),
+        "destinations": len(model.tiles.destinations),
+        "compile_seconds": compile_seconds,
+        "construct_seconds": construct,
+        "generate_graph_seconds": generate_graph,
+        "generate_routes_seconds": generate_routes,
+        "get_route_microseconds": get_route / lookups * 1e6 if lookups else None,
+        "steps": measured,
+        "bikes_in_model": model.count_bikes(),
+        "steps_per_second": measured / elapsed if elapsed else None,
+        "bike_moves_per_second": moves / elapsed if elapsed else None,
+    }
+
+
+def git_commit():
+    """
+    Returns the commit of the working tree, or None outside of git.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the park model.")
+    parser.add_argument("--maps", nargs="+", default=MAPS)
+    parser.add_argument("--scales", nargs="+", type=int, default=SCALES)
+    parser.add_argument(
+        "--generated",
+        nargs="+",
+        default=[],
+        metavar="WIDTHxHEIGHT",
+        help="Sizes of generated maps to benchmark as well, e.g. 500x500.",
+    )
+    parser.add_argument(
+        "--engines", nargs="+", choices=["agents", "vector"], default=["agents"]
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=10, help="Steps before measuring."
+    )
+    parser.add_argument(
+        "--steps", type=int, default=100, help="Steps to measure per map."
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", default="benchmark_results.json", help="JSON results file."
+    )
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for map_file in args.maps:
+            for scale in args.scales:
+                path = scaled_map(map_file, scale, folder)
+                for engine in args.engines:
+                    result = benchmark_map(
+                        map_file,
+                        scale,
+                        path,
+                        engine,
+                        args.warmup,
+                        args.steps,
+                        args.seed,
+                    )
+                    results.append(result)
+                    print(
+                        f"{map_file} x{scale} {engine}: "
+                        f"{result['steps_per_second'] or 0:.1f} steps/s",
+                        file=sys.stderr,
+                    )
+
+        for size in args.generated:
+            path = generated_map(size, folder, seed=args.seed)
+            for engine in args.engines:
+                result = benchmark_map(
+                    f"generated_{size}",
+                    1,
+                    path,
+                    engine,
+                    args.warmup,
+                    args.steps,
+                    args.seed,
+                )
+                results.append(result)
+                print(
+                    f"generated {size} {engine}: "
+                    f"{result['steps_per_second'] or 0:.1f} steps/s",
+                    file=sys.stderr,
+                )
+
+    with open(args.output, "w") as output:
+        json.dump(
+            {
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "results": results,
+            },
+            output,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Cache of serialized frames for the agents server.
+# The frames of a session are serialized once per step and shared by every
+# request for them, and compressed once for the clients that accept gzip.
+
+import gzip
+import threading
+
+
+class CachedFrame:
+    """
+    Serialized body of a response, its ETag and, once a client asks for
+    it, its gzip-compressed version.
+    Attributes:
+        etag: ETag of the body
+        compressed_etag: ETag of the compressed body, which is another
+            representation of the frame, so it can not share the ETag
+    """
+
+    def __init__(self, body, etag):
+        self.body = body
+        self.etag = etag
+        self.compressed_etag = f"{etag}-gz"
+        self.lock = threading.Lock()
+        self._compressed = None
+
+    def compressed(self):
+        with self.lock:
+            if self._compressed is None:
+                self._compressed = gzip.compress(self.body, compresslevel=5)
+            return self._compressed
+
+
+class FrameCache:
+    """
+    Serialized frames of every session, keyed by the session's version so
+    that they are made again only after its model is stepped. Frames that
+    do not depend on the step, like the map, are kept for the whole session.
+    """
+
+    def __init__(self, sessions):
+        """
+        Args:
+            sessions: SessionRegistry of the server
+        """
+        self.sessions = sessions
+        self.lock = threading.Lock()
+        # Session -> (version, {key: CachedFrame}) for frames of a step, and
+        # session -> {key: CachedFrame} for frames kept for the session.
+        self._frames = {}
+        self._static = {}
+
+    def get(self, session, key, build, static=False, version=None):
+        """
+        Returns the CachedFrame of a session for a key, calling build to
+        make its body only when it is not cached.
+        Args:
+            session: Id of the session
+            key: Tuple that identifies the frame, like ("agents", since)
+            build: Function that returns the body of the frame as bytes
+            static: Whether the frame stays the same for the whole session
+            version: Version of the frame, the session's version in the
+                registry if omitted
+        Raises UnknownSession if the session does not exist.
+        """
+        with self.lock:
+            # The version is read with the cache locked, so that a request
+            # that read an older version can not replace the frames of a
+            # newer one.
+            if static:
+                version = "static"
+            elif version is None:
+                version = self.sessions.version(session)
+            self._prune()
+            if static:
+                frames = self._static.setdefault(session, {})
+            else:
+                cached_version, frames = self._frames.get(session, (None, {}))
+                if cached_version != version:
+                    frames = {}
+                    self._frames[session] = (version, frames)
+
+            frame = frames.get(key)
+            if frame is None:
+                etag = "-".join(str(part) for part in (session, version, *key))
+                frame = frames[key] = CachedFrame(None, etag)
+
+        # The frame is built outside of the cache's lock, so that building
+        # one frame does not block requests for others, and only once, by
+        # the first request that gets its lock.
+        with frame.lock:
+            if frame.body is None:
+                frame.body = build()
+        return frame
+
+    def _prune(self):
+        # Forget the frames of sessions that were closed.
+        for cache in [self._frames, self._static]:
+            for session in [s for s in cache if s not in self.sessions]:
+                del cache[session]
@@ -0,0 +1,211 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Procedural generator of park maps.
+# Produces maps in the same character format as the files in park_files, at
+# any size, and checks that every spawn corner can reach every destination.
+
+from parkAgents.compiled import load_dictionary
+from parkAgents.graph import RoadGraph, moore_neighborhood
+from parkAgents.tiles import TileLayer
+import argparse
+import numpy as np
+import random
+import sys
+
+# Destinations of a generated map when no number is given.
+DESTINATIONS = 32
+
+
+def avenue_starts(size, block):
+    """
+    Returns the first row or column of each two lane avenue between the ring
+    roads of a map side, leaving blocks of at least block cells between
+    them.
+    """
+    starts = []
+    start = 2 + block
+    while start + 2 + block <= size - 2:
+        starts.append(start)
+        start += 2 + block
+    return starts
+
+
+def generate_map(width, height, block=8, destinations=DESTINATIONS, seed=None):
+    """
+    Returns the lines of a new park map.
+    The map has a two lane ring road going counterclockwise around it, like
+    the shipped maps, and a grid of two lane one way avenues that alternate
+    their direction. Traffic lights are placed on the lanes that enter each
+    avenue intersection, and destinations on the edges of the blocks.
+    Args:
+        width: Number of columns of the map
+        height: Number of rows of the map
+        block: Size of the blocks of obstacles between avenues
+        destinations: Number of destinations
+        seed: Seed for the placement of the destinations
+    """
+    if block < 3 or width < block + 4 or height < block + 4:
+        raise ValueError("The map must fit at least one block of 3 cells")
+
+    rng = random.Random(seed)
+    dictionary = load_dictionary()
+    chars = {direction: ord(char) for char, direction in dictionary.items()}
+    down, up, left, right = chars["Down"], chars["Up"], chars["Left"], chars["Right"]
+    vertical_light, horizontal_light = ord("S"), ord("s")
+
+    # Characters of the map as a (row, column) byte matrix, rows go from the
+    # top of the map to the bottom.
+    grid = np.full((height, width), ord("#"), dtype=np.uint8)
+
+    # Ring road, going counterclockwise like in the shipped maps.
+    grid[2:, -2:] = up
+    grid[:2, 2:] = left
+    grid[:-2, :2] = down
+    grid[-2:, :-2] = right
+
+    columns = avenue_starts(width, block)
+    rows = avenue_starts(height, block)
+    column_direction = {c: down if i % 2 == 0 else up for i, c in enumerate(columns)}
+    row_direction = {r: left if i % 2 == 0 else right for i, r in enumerate(rows)}
+
+    for c in columns:
+        grid[2:-2, c : c + 2] = column_direction[c]
+    for r in rows:
+        grid[r : r + 2, 2:-2] = row_direction[r]
+
+    for r in rows:
+        for c in columns:
+            vertical = column_direction[c]
+            horizontal = row_direction[r]
+
+            # The column where the horizontal traffic leaves the
+            # intersection keeps the avenue's direction, so both flows can
+            # cross diagonally.
+            exit_column = c if horizontal == left else c + 1
+            other_column = c + 1 if horizontal == left else c
+            grid[r : r + 2, exit_column] = vertical
+            grid[r : r + 2, other_column] = horizontal
+
+            # Traffic lights on the lanes that enter the intersection.
+            light_row = r - 1 if vertical == down else r + 2
+            grid[light_row, c : c + 2] = vertical_light
+            light_column = c + 2 if horizontal == left else c - 1
+            grid[r : r + 2, light_column] = horizontal_light
+
+    # Destinations on block cells next to a road.
+    road = grid != ord("#")
+    next_to_road = np.zeros_like(road)
+    next_to_road[1:-1, 1:-1] = (
+        road[:-2, 1:-1] | road[2:, 1:-1] | road[1:-1, :-2] | road[1:-1, 2:]
+    )
+    candidates = np.flatnonzero(~road & next_to_road).tolist()
+    for cell in rng.sample(candidates, min(destinations, len(candidates))):
+        grid.flat[cell] = ord("D")
+
+    lines = [row.tobytes().decode() + "\n" for row in grid]
+    validate_map(lines, dictionary)
+    return lines
+
+
+def reachable_from(graph, node):
+    """
+    Returns a Boolean array with the nodes of a graph that can be reached
+    from node, found with a breadth-first search over whole levels at once.
+    """
+    reached = np.zeros(len(graph), dtype=bool)
+    reached[node] = True
+    frontier = np.array([node], dtype=np.int64)
+
+    while frontier.size:
+        starts = graph.offsets[frontier]
+        counts = graph.offsets[frontier + 1] - starts
+        edges = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(
+            counts.sum()
+        )
+        successors = graph.targets[edges]
+        frontier = np.unique(successors[~reached[successors]])
+        reached[frontier] = True
+
+    return reached
+
+
+def validate_map(lines, dictionary=None):
+    """
+    Raises ValueError unless every destination can be reached from every
+    spawn corner of the map.
+    """
+    tiles = TileLayer.from_lines(lines, dictionary or load_dictionary())
+    graph = RoadGraph.from_tiles(tiles)
+
+    if not tiles.destinations:
+        raise ValueError("The map has no destinations")
+
+    approaches = [
+        [
+            graph.node_id(pos)
+            for pos in moore_neighborhood(destination, tiles.width, tiles.height)
+            if pos in graph
+        ]
+        for destination in tiles.destinations
+    ]
+
+    corners = [
+        (0, 0),
+        (0, tiles.height - 1),
+        (tiles.width - 1, 0),
+        (tiles.width - 1, tiles.height - 1),
+    ]
+    for corner in corners:
+        if corner not in graph:
+            raise ValueError(f"Spawn corner {corner} is not a road")
+
+        reached = reachable_from(graph, graph.node_id(corner))
+        for destination, nodes in zip(tiles.destinations, approaches):
+            if not reached[nodes].any():
+                raise ValueError(
+                    f"Destination {destination} can not be reached from {corner}"
+                )
+
+
+def write_map(lines, path):
+    """
+    Writes the lines of a map to a file.
+    """
+    with open(path, "w") as mapFile:
+        mapFile.writelines(lines)
+
+
+def parse_size(size):
+    """
+    Returns the (width, height) of a size written as WIDTHxHEIGHT.
+    """
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a park map.")
+    parser.add_argument("size", help="Size of the map as WIDTHxHEIGHT, e.g. 500x500.")
+    parser.add_argument("--block", type=int, default=8, help="Size of the blocks.")
+    parser.add_argument(
+        "--destinations",
+        type=int,
+        default=DESTINATIONS,
+        help="Number of destinations.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Map file, printed to stdout if omitted.")
+    args = parser.parse_args(argv)
+
+    width, height = parse_size(args.size)
+    lines = generate_map(
+        width, height, block=args.block, destinations=args.destinations, seed=args.seed
+    )
+
+    if args.output:
+        write_map(lines, args.output)
+    else:
+        sys.stdout.writelines(lines)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
 from mesa import Agent
-import heapq
 
 class Bike(Agent):
     """
@@ -19,157 +18,120 @@ class Bike(Agent):
         """
         super().__init__(unique_id, model)
         self.destination = destination
-        self.destination_neighbors = []
-        self.path = []
+        #Shared set of roads where the destination is reached
+        self.destination_neighbors = model.destination_approaches[destination]
+        self.route = None
         self.direction = "Down"
         self.impatience = 0
-        self.moving = False
+        # Whether the bike moved the last time it tried, counted by the
+        # model's bikes_moving.
+        self._moving = False
+
+    @property
+    def moving(self):
+        return self._moving
+
+    @moving.setter
+    def moving(self, moving):
+        if moving != self._moving:
+            self.model.bikes_moving += 1 if moving else -1
+            self._moving = moving
+            if self.pos is not None:
+                self.model.mark_stopped(self.pos, not moving)
 
-    def get_distance(self, pos1, pos2):
+    def get_route(self):
         """
-        Method used to calculate the distance between two points (Manhattan)
+        Method to find the route to the destination in the model's shared
+        routing tables
         """
-        return (abs(pos2[0]-pos1[0]) + abs(pos2[1]-pos1[1]))
+        self.model.route_computations += 1
+        self.route = self.model.routes[self.destination]
 
-    def get_route(self):
+    def move_to(self, neighbor):
         """
-        Method to find the route to the destination using A*
+        Auxiliary Method to move the agent to a neighbor road
         """
-        avoid = None
-        if self.path:
-            avoid = self.path[0]
-
-        #Define list with neighbor cells of the destination that are roads
-        destination_neighborhood = self.model.grid.get_neighborhood(self.destination, moore=True, include_center = False)
-
-        for neighbor_cells in destination_neighborhood:
-            cell_agents = self.model.grid.get_cell_list_contents(neighbor_cells)
-            for agent in cell_agents:
-                if isinstance(agent, Road):
-                    self.destination_neighbors.append(neighbor_cells)
-
-        if self.pos in self.destination_neighbors:
-            return
-        
-        open_list = [(0, self.pos)]
-        closed_list = set()
-        closed_list.add(avoid)
-
-        #Dictionary to store parents 
-        came_from = {}
-
-        #Cost 
-        g_score = {self.pos : 0}
-        #Heuristic + Cost
-        f_score = {self.pos: self.get_distance(self.pos, self.destination)}
-
-        while open_list:
-            #Current pos = (cost, position)
-            current_pos = heapq.heappop(open_list)
-            
-            #Destination Reached
-            if current_pos[1] in self.destination_neighbors:
-                self.path = self.reconstruct_path(came_from, current_pos[1])
-                return
-            
-            closed_list.add(current_pos)
-
-            #For each of the possible cells from current_pos
-            for neighbor in self.model.graph_get(current_pos[1]):
-                
-                #If the cell was already explored, skip
-                if neighbor.pos in closed_list:
-                    continue
-
-                tentative_g_score = g_score[current_pos[1]] + 1 
-
-                if neighbor.pos not in g_score or tentative_g_score < g_score[neighbor.pos]:
+        self.impatience = 0
+        self.moving = True
 
-                    came_from[neighbor.pos] = current_pos[1]
-                    g_score[neighbor.pos] = tentative_g_score
-                    f_score[neighbor.pos] = tentative_g_score + self.get_distance(neighbor.pos, self.destination)
+        self.model.move_bike(self, neighbor)
+        self.direction = self.model.tiles.direction_at(self.pos)
+    
+    def free_neighbors(self):
+        """
+        Returns the roads the agent can move to that have no bike
+        """
+        empty_neighbors = []
 
-                    heapq.heappush(open_list, (f_score[neighbor.pos], neighbor.pos))
+        for neighbor in self.model.graph_get(self.pos):
+            if self.model.is_free(neighbor):
+                empty_neighbors.append(neighbor)
+        return empty_neighbors
 
-    def reconstruct_path(self, came_from, current_pos):
+    def wait(self, cells, alarm=None):
         """
-        Auxiliary Method to reconstruct the path
+        Auxiliary Method to wait in place when the agent can not move, and
+        sleep until one of the given roads is freed or the alarm step
         """
-        path = []
-        while current_pos in came_from:
-            path.append(current_pos)
-            current_pos = came_from[current_pos]
-        path.reverse()
-        return path
-    
+        self.moving = False
+        self.impatience += 1
+        self.model.schedule.sleep(self, cells, alarm)
+
     def move(self):
         """
-        Move the agent one cell in it's path
+        Move the agent one cell along the route to its destination
         """
-        #Check if the first element of the path is empty
-        # print(f"---------BIKE: {self.unique_id}, PATH: {self.path}, DESTINATION: {self.destination}-----------")
-        
         #Find empty available neighbors
-        empty_neighbors = []
+        empty_neighbors = self.free_neighbors()
 
-        neighbors_list = [neighbor.pos for neighbor in self.model.graph_get(self.pos)]
-        
-        for neighbor in neighbors_list:
-            bikes_found = [agent for agent in self.model.grid.get_cell_list_contents(neighbor) if isinstance(agent, Bike)]
-            if len(bikes_found) == 0:
-                empty_neighbors.append(neighbor)
-
-        #If there are no available steps, wait
+        #If there are no available steps, wait until a neighbor is freed
         if not empty_neighbors:
-            self.moving = False
-            self.impatience += 1
+            self.wait(self.model.graph_get(self.pos))
             #print(f"CASE 0: Bike {self.unique_id} waited at {self.pos} because there are no available neighbors")
             return
         
-        #Try moving to the first road in path
-        if self.path[0] in empty_neighbors:
-            self.impatience = 0
-            self.moving = True
-            
-            self.model.grid.move_agent(self, self.path.pop(0))
-            self.direction = next(filter(
-                lambda a: isinstance(a, Road),
-                self.model.grid.get_cell_list_contents(self.pos)
-            )).direction
+        #Try moving to the next road in the route
+        next_road = self.route.next_hop_from(self.pos)
+        if next_road in empty_neighbors:
+            self.move_to(next_road)
             #print(f"CASE 1: Bike {self.unique_id} moved along it's path")
             return
         
-        if len(self.path) == 1:
-            self.moving = False
-            self.impatience += 1
+        distance = self.route.distance_from(self.pos)
+        if distance == 1:
+            self.wait((next_road,))
             #print(f"CASE 2: Bike {self.unique_id} is once step away from it's destination and waited at: {self.pos}")
             return
 
         #For each of the possible empty neighbors,
-        #find the neighbor that can reach the next road in the path
+        #find the neighbor that is also one step closer to the destination
         for neighbor in empty_neighbors:
-            if self.path[1] in [neighbor.pos for neighbor in self.model.graph_get(neighbor)]:
-                self.impatience = 0
-                self.path.pop(0)
-                self.moving = True
-
-                self.model.grid.move_agent(self, neighbor)
-                self.direction = next(filter(
-                    lambda a: isinstance(a, Road),
-                    self.model.grid.get_cell_list_contents(self.pos)
-                )).direction
+            if self.route.distance_from(neighbor) == distance - 1:
+                self.move_to(neighbor)
                 #print(f"CASE 3: Bike {self.unique_id} moved towards {neighbor} by choosing an empty neighbor that stays on track")
                 return
                  
         if self.impatience >= 3:
-            print(f"CASE 4: Bike {self.unique_id} is recalculating it's route after becoming impatient")
+            if self.model.verbose:
+                print(f"CASE 4: Bike {self.unique_id} is recalculating it's route after becoming impatient")
             self.impatience = 0
+            self.model.replans += 1
             self.get_route()
-            self.move()
-            return
+
+            #Take the empty neighbor with the cheapest route around the
+            #stopped bikes, even if it is longer than the blocked one
+            detour = self.model.detour(self.destination, empty_neighbors)
+            if detour is not None:
+                self.move_to(detour)
+                return
         
-        self.moving = False
-        self.impatience += 1
+        #Wait until a road that stays on track is freed, or until the agent
+        #becomes impatient
+        on_track = [
+            neighbor for neighbor in self.model.graph_get(self.pos)
+            if self.route.distance_from(neighbor) == distance - 1
+        ]
+        self.wait(on_track, self.model.schedule.steps + max(1, 3 - self.impatience))
         #print(f"CASE 5: Bike {self.unique_id} is being patient")
 
 
@@ -177,27 +139,21 @@ class Bike(Agent):
         """
         Determines the new direction it will take, and then moves
         """
-        #Generate a path if it does not exist
-        if not self.path:
+        #Look up the route if it does not exist
+        if self.route is None:
             self.get_route()
 
-        #Check if a traffic light exists at that position
-        traffic_light = None
-        cell_agents = self.model.grid.get_cell_list_contents(self.pos)
-
-        for agent in cell_agents:
-            if isinstance(agent, Traffic_Light):
-                traffic_light = agent
-        
-        #If the agent is at a traffic light, wait
-        if traffic_light and traffic_light.state:
-            pass
+        #If the agent is at a traffic light that is red, wait until it changes
+        if self.model.red_light_at(self.pos):
+            self.model.schedule.sleep(
+                self, alarm=self.model.light_change_at(self.pos), waiting=False
+            )
 
         #If the agent is at it's destination, delete
         elif self.pos in self.destination_neighbors:
             #print(f"Agent: {self.unique_id} reached its destination!")
             self.model.bikes_arrived += 1
-            self.model.grid.remove_agent(self)
+            self.model.remove_bike(self)
             self.model.schedule.remove(self)
             self.model.deregister_agent(self)
 
@@ -212,67 +168,26 @@ class Traffic_Light(Agent):
     """
 
     def __init__(self, unique_id, model,
-                 state=False, direction="Left", timeToChange=10):
+                 state=False, direction="Left", timeToChange=10, index=0):
         super().__init__(unique_id, model)
         """
         Creates a new Traffic light.
         Args:
             unique_id: The agent's ID
             model: Model reference for the agent
-            state: Whether the traffic light is green or red
+            state: Whether the traffic light starts green or red
             timeToChange: After how many step should the traffic light change color 
+            index: Index of the traffic light in the model's light phases
         """
         self.direction = direction
-        self.state = state
         self.timeToChange = timeToChange
+        self.index = index
 
-    def step(self):
+    @property
+    def state(self):
         """
-        To change the state (green or red) of the traffic light in case you consider the time to change of each traffic light.
+        Whether the traffic light is green or red. The light changes color
+        every timeToChange steps, so its state is computed from the step of
+        the model instead of being stepped.
         """
-        if self.model.schedule.steps % self.timeToChange == 0:
-            self.state = not self.state
-
-
-class Destination(Agent):
-    """
-    Destination agent. Where each car should go.
-    """
-
-    def __init__(self, unique_id, model):
-        super().__init__(unique_id, model)
-
-    def step(self):
-        pass
-
-
-class Obstacle(Agent):
-    """
-    Obstacle agent. Just to add obstacles to the grid.
-    """
-
-    def __init__(self, unique_id, model):
-        super().__init__(unique_id, model)
-
-    def step(self):
-        pass
-
-
-class Road(Agent):
-    """
-    Road agent. Determines where the cars can move, and in which direction.
-    """
-
-    def __init__(self, unique_id, model, direction="Left"):
-        """
-        Creates a new road.
-        Args:
-            unique_id: The agent's ID
-            model: Model reference for the agent
-            direction: Direction where the cars can move
-        """
-        super().__init__(unique_id, model)
-        self.direction = direction
-
-    def step(self):
-        pass
+        return self.model.lights.state(self.index, self.model.schedule.steps)
@@ -0,0 +1,59 @@
+from collections import deque
+
+
+class ChangeLog:
+    """
+    Ids of the bikes that spawned, moved, turned or left the model in each
+    of its last steps, so that clients can ask for the bikes that changed
+    since the last step they saw instead of for every bike.
+    Attributes:
+        history: Number of steps kept in the log
+        start: Oldest step that changes can be asked from
+    """
+
+    def __init__(self, history=256):
+        """
+        Creates an empty change log.
+        Args:
+            history: Number of steps kept in the log
+        """
+        self.history = history
+        self.start = 0
+        # (step, changed ids, removed ids) of each step, oldest first.
+        self._entries = deque()
+
+    def _entry(self, step):
+        if not self._entries or self._entries[-1][0] != step:
+            self._entries.append((step, set(), set()))
+            while len(self._entries) > self.history:
+                self.start = self._entries.popleft()[0]
+        return self._entries[-1]
+
+    def changed(self, step, ids):
+        """
+        Records bikes that spawned, moved or turned during a step.
+        """
+        self._entry(step)[1].update(ids)
+
+    def removed(self, step, ids):
+        """
+        Records bikes that left the model during a step.
+        """
+        self._entry(step)[2].update(ids)
+
+    def since(self, step):
+        """
+        Returns the set of ids of the bikes that changed after a step and
+        are still in the model, and the set of ids of the bikes that left
+        after it, or None if the step is older than the log.
+        """
+        if step < self.start:
+            return None
+
+        changed = set()
+        removed = set()
+        for entry_step, entry_changed, entry_removed in self._entries:
+            if entry_step > step:
+                changed |= entry_changed
+                removed |= entry_removed
+        return changed - removed, removed
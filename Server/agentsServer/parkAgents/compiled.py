@@ -0,0 +1,377 @@
+from .graph import RoadGraph, moore_neighborhood
+from .hierarchy import BlockIndex, BlockRoute
+from .routing import RouteTable
+from .tiles import TileLayer
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# Folder with the park map files and the map dictionary.
+PARK_FILES = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "park_files"
+)
+
+# Folder where compiled maps are cached, one subfolder per map hash.
+CACHE_FOLDER = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "compiled_maps"
+)
+
+# Version of the layout of the compiled files, part of the cache key so that
+# old caches are not read after the layout changes.
+FORMAT_VERSION = 2
+
+# Largest number of (destination, road) entries of the routing tables of a
+# map, about 128 MB. Larger maps are routed with a BlockIndex instead.
+TABLE_ENTRIES_LIMIT = 16_000_000
+
+# Arrays stored in a compiled map, saved as <name>.npy.
+ARRAYS = [
+    "tiles",
+    "directions",
+    "light_index",
+    "lights",
+    "destinations",
+    "coords",
+    "offsets",
+    "targets",
+    "reverse_offsets",
+    "reverse_targets",
+    "node_of",
+]
+
+# Arrays of the routes, either the routing tables or the block index.
+TABLE_ARRAYS = ["distances", "next_hops"]
+INDEX_ARRAYS = [
+    "blocks",
+    "block_offsets",
+    "block_nodes",
+    "portals",
+    "exit_offsets",
+    "exit_sources",
+    "exit_costs",
+]
+
+
+def map_path(map_file):
+    """
+    Returns the path of a map file, either as given or inside PARK_FILES.
+    """
+    if os.path.exists(map_file):
+        return map_file
+    return os.path.join(PARK_FILES, map_file)
+
+
+def load_dictionary():
+    """
+    Returns the dictionary that maps the characters in the map files to
+    their meaning.
+    """
+    with open(os.path.join(PARK_FILES, "mapDictionary.json")) as dictionaryFile:
+        return json.load(dictionaryFile)
+
+
+def map_key(map_bytes, dictionary):
+    """
+    Returns the cache key of a map, a hash of its contents, the dictionary
+    used to read it and the format of the compiled files.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"format {FORMAT_VERSION}\n".encode())
+    digest.update(json.dumps(dictionary, sort_keys=True).encode())
+    digest.update(map_bytes)
+    return digest.hexdigest()
+
+
+def destination_goals(tiles, graph):
+    """
+    Returns dictionaries that map each destination to the frozenset of
+    roads where a bike arrives to it, and to the node ids of those roads.
+    """
+    approaches = {}
+    goals = {}
+    for destination in tiles.destinations:
+        # Roads in the Moore neighborhood of the destination, where a bike
+        # is considered to have arrived.
+        roads = [
+            pos
+            for pos in moore_neighborhood(destination, tiles.width, tiles.height)
+            if pos in graph
+        ]
+        approaches[destination] = frozenset(roads)
+        goals[destination] = [graph.node_id(pos) for pos in roads]
+    return approaches, goals
+
+
+def route_tables(tiles, graph, distances=None, next_hops=None):
+    """
+    Returns the approach roads and routing table of every destination, and
+    the distance and next hop arrays of all the tables stacked as
+    (destination, node).
+    The tables are computed with a breadth first search unless distances
+    and next_hops are given, and their arrays are rows of the stacked ones.
+    Args:
+        tiles: TileLayer of the map
+        graph: RoadGraph of the map
+        distances: Stacked distance arrays of a compiled map
+        next_hops: Stacked next hop arrays of a compiled map
+    """
+    approaches, goals = destination_goals(tiles, graph)
+    if distances is None or next_hops is None:
+        tables = [
+            RouteTable(graph, destination, goals[destination])
+            for destination in tiles.destinations
+        ]
+        shape = (len(tables), len(graph))
+        distances = np.stack([table.distance for table in tables]).reshape(shape)
+        next_hops = np.stack([table.next_hop for table in tables]).reshape(shape)
+
+    routes = {
+        destination: RouteTable.from_arrays(
+            graph, destination, goals[destination], distances[i], next_hops[i]
+        )
+        for i, destination in enumerate(tiles.destinations)
+    }
+    return approaches, routes, distances, next_hops
+
+
+def block_routes(tiles, graph, index):
+    """
+    Returns the approach roads and BlockRoute of every destination.
+    Args:
+        tiles: TileLayer of the map
+        graph: RoadGraph of the map
+        index: BlockIndex of the graph
+    """
+    approaches, goals = destination_goals(tiles, graph)
+    routes = {
+        destination: BlockRoute(index, destination, goals[destination])
+        for destination in tiles.destinations
+    }
+    return approaches, routes
+
+
+class CompiledMap:
+    """
+    Static data of a park map: its tiles, road graph and routes.
+    Compiled maps are saved as a folder of .npy files that can be loaded
+    with memory-mapped reads, so large maps do not have to be parsed and
+    routed again every time a model is created.
+    Maps whose routing tables would have more than TABLE_ENTRIES_LIMIT
+    entries are routed with a BlockIndex instead, and their routes only
+    search the blocks the bikes go through, see parkAgents.hierarchy.
+    Attributes:
+        key: Cache key of the map
+        tiles: TileLayer of the map
+        graph: RoadGraph of the map
+        approaches: Dictionary that maps each destination to the frozenset
+            of roads where a bike arrives to it
+        routes: Dictionary that maps each destination to its RouteTable, or
+            to its BlockRoute when the map has an index
+        distances: (destinations, nodes) int32 array with the distance
+            arrays of every routing table, None when the map has an index
+        next_hops: (destinations, nodes) int32 array with the next hop
+            arrays of every routing table, None when the map has an index
+        index: BlockIndex of the graph, None when the map has routing tables
+    """
+
+    def __init__(
+        self, key, tiles, graph, distances=None, next_hops=None, index=None
+    ):
+        """
+        Creates a compiled map, computing its routing tables or its block
+        index if they are not given.
+        Args:
+            key: Cache key of the map
+            tiles: TileLayer of the map
+            graph: RoadGraph of the map
+            distances: Stacked distance arrays of the routing tables
+            next_hops: Stacked next hop arrays of the routing tables
+            index: BlockIndex of the graph
+        """
+        self.key = key
+        self.tiles = tiles
+        self.graph = graph
+
+        if (
+            index is None
+            and distances is None
+            and len(tiles.destinations) * len(graph) > TABLE_ENTRIES_LIMIT
+        ):
+            index = BlockIndex.from_graph(graph)
+        self.index = index
+
+        if index is not None:
+            self.approaches, self.routes = block_routes(tiles, graph, index)
+            self.distances = self.next_hops = None
+        else:
+            (
+                self.approaches,
+                self.routes,
+                self.distances,
+                self.next_hops,
+            ) = route_tables(tiles, graph, distances, next_hops)
+
+    @classmethod
+    def from_lines(cls, lines, dataDictionary, key=None):
+        """
+        Compiles the lines of a map file.
+        Args:
+            lines: Lines of the map file, where each character is a cell
+            dataDictionary: Dictionary that maps the characters in the map
+                file to their meaning
+            key: Cache key of the map
+        """
+        tiles = TileLayer.from_lines(lines, dataDictionary)
+        return cls(key, tiles, RoadGraph.from_tiles(tiles))
+
+    def save(self, folder):
+        """
+        Writes the compiled map to a folder.
+        """
+        os.makedirs(folder, exist_ok=True)
+        tiles = self.tiles
+        graph = self.graph
+        arrays = {
+            "tiles": tiles.tiles,
+            "directions": tiles.directions,
+            "light_index": tiles.light_index,
+            "lights": np.array(
+                [[x, y, state, period] for (x, y), state, period in tiles.lights],
+                dtype=np.int32,
+            ).reshape(-1, 4),
+            "destinations": np.array(tiles.destinations, dtype=np.int32).reshape(
+                -1, 2
+            ),
+            "coords": graph.coords,
+            "offsets": graph.offsets,
+            "targets": graph.targets,
+            "reverse_offsets": graph.reverse_offsets,
+            "reverse_targets": graph.reverse_targets,
+            "node_of": graph.node_of,
+        }
+        if self.index is not None:
+            names = ARRAYS + INDEX_ARRAYS
+            arrays.update(
+                {name: getattr(self.index, name) for name in INDEX_ARRAYS}
+            )
+        else:
+            names = ARRAYS + TABLE_ARRAYS
+            arrays.update({"distances": self.distances, "next_hops": self.next_hops})
+        for name in names:
+            np.save(os.path.join(folder, f"{name}.npy"), arrays[name])
+
+        # The metadata is written last, a folder without it is incomplete.
+        with open(os.path.join(folder, "compiled.json"), "w") as metadataFile:
+            json.dump(
+                {
+                    "format": FORMAT_VERSION,
+                    "key": self.key,
+                    "width": tiles.width,
+                    "height": tiles.height,
+                    "block_size": (
+                        self.index.block_size if self.index is not None else None
+                    ),
+                },
+                metadataFile,
+            )
+
+    @classmethod
+    def load(cls, folder, mmap_mode="r"):
+        """
+        Reads a compiled map from a folder.
+        Args:
+            folder: Folder written by save
+            mmap_mode: Mode used to memory-map the arrays, or None to read
+                them into memory
+        """
+        with open(os.path.join(folder, "compiled.json")) as metadataFile:
+            metadata = json.load(metadataFile)
+        if metadata["format"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported compiled map format in {folder}")
+
+        block_size = metadata["block_size"]
+        names = ARRAYS + (INDEX_ARRAYS if block_size is not None else TABLE_ARRAYS)
+        arrays = {
+            name: np.load(os.path.join(folder, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in names
+        }
+
+        tiles = TileLayer.from_arrays(
+            arrays["tiles"],
+            arrays["directions"],
+            arrays["light_index"],
+            [
+                ((x, y), bool(state), period)
+                for x, y, state, period in arrays["lights"].tolist()
+            ],
+            list(map(tuple, arrays["destinations"].tolist())),
+        )
+        graph = RoadGraph(
+            arrays["coords"],
+            arrays["offsets"],
+            arrays["targets"],
+            reverse_offsets=arrays["reverse_offsets"],
+            reverse_targets=arrays["reverse_targets"],
+            node_of=arrays["node_of"],
+        )
+        if block_size is not None:
+            return cls(
+                metadata["key"],
+                tiles,
+                graph,
+                index=BlockIndex(
+                    graph, block_size, *(arrays[name] for name in INDEX_ARRAYS)
+                ),
+            )
+        return cls(
+            metadata["key"],
+            tiles,
+            graph,
+            distances=arrays["distances"],
+            next_hops=arrays["next_hops"],
+        )
+
+
+def compile_map(map_file, cache_folder=CACHE_FOLDER):
+    """
+    Returns the CompiledMap of a map file, loaded from the cache when the
+    file was compiled before and compiled and cached otherwise.
+    Args:
+        map_file: Name of a map in PARK_FILES, or the path of a map file
+        cache_folder: Folder of the cache, or None to always compile
+    """
+    dataDictionary = load_dictionary()
+    with open(map_path(map_file), "rb") as baseFile:
+        map_bytes = baseFile.read()
+    key = map_key(map_bytes, dataDictionary)
+
+    if cache_folder is not None:
+        folder = os.path.join(cache_folder, key)
+        if os.path.exists(os.path.join(folder, "compiled.json")):
+            return CompiledMap.load(folder)
+
+    compiled = CompiledMap.from_lines(
+        map_bytes.decode().replace("\r\n", "\n").splitlines(keepends=True),
+        dataDictionary,
+        key,
+    )
+
+    if cache_folder is not None:
+        # Written to a temporary folder first, so that other processes never
+        # read a half written map.
+        try:
+            os.makedirs(cache_folder, exist_ok=True)
+            temporary = tempfile.mkdtemp(prefix=".compiling-", dir=cache_folder)
+            compiled.save(temporary)
+            try:
+                os.rename(temporary, folder)
+            except OSError:
+                # Another process cached the same map first.
+                shutil.rmtree(temporary, ignore_errors=True)
+        except OSError as e:
+            print(f"Could not cache compiled map {map_file}: {e}")
+
+    return compiled
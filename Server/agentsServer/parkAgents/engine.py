@@ -0,0 +1,379 @@
+import numpy as np
+from .tiles import DIRECTION_CODES, DIRECTIONS
+
+
+class VectorEngine:
+    """
+    Steps every bike of a ParkModel at once with batched NumPy operations.
+    The bike state is stored in struct-of-arrays form, the first count
+    entries of each array belong to the bikes in the model.
+    Attributes:
+        ids: int64 array with the id of each bike
+        nodes: int32 array with the graph node each bike is on
+        destinations: int32 array with the index of each bike's destination
+            in model.tiles.destinations
+        directions: uint8 array with the road direction code of each bike
+        impatience: int32 array with the steps each bike has been waiting
+        moving: Boolean array with whether each bike moved in the last step
+        count: Number of bikes in the model
+    """
+
+    def __init__(self, model, capacity=1024):
+        """
+        Creates the engine for a model whose graph and routes are built.
+        Args:
+            model: Model reference for the engine
+            capacity: Initial number of bikes the arrays can hold
+        Raises ValueError if the map of the model is routed with a block
+        index, see parkAgents.hierarchy.
+        """
+        if model.distances is None:
+            raise ValueError(
+                "The vector engine needs the routing tables of every "
+                "destination, and the map is routed with a block index"
+            )
+        self.model = model
+        self.graph = model.graph
+        self.count = 0
+
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.nodes = np.zeros(capacity, dtype=np.int32)
+        self.destinations = np.zeros(capacity, dtype=np.int32)
+        self.directions = np.zeros(capacity, dtype=np.uint8)
+        self.impatience = np.zeros(capacity, dtype=np.int32)
+        self.moving = np.zeros(capacity, dtype=bool)
+
+        # Routing tables of every destination stacked as (destination, node).
+        self.destination_index = {
+            destination: index
+            for index, destination in enumerate(model.tiles.destinations)
+        }
+        self.distance = model.distances
+        self.next_hop = model.next_hops
+        self.neighbors = self.graph.neighbor_matrix()
+
+        # Flat index in the (width, height) layers of each node's cell.
+        self.cells = (
+            self.graph.coords[:, 0].astype(np.int64) * model.height
+            + self.graph.coords[:, 1]
+        )
+        self.node_lights = model.tiles.light_index.reshape(-1)[self.cells]
+        self.node_directions = model.tiles.directions.reshape(-1)[self.cells]
+
+        # Priorities for cells claimed by several bikes in the same step.
+        self.rng = np.random.default_rng(model.random.getrandbits(64))
+        # Priority of the bike that left each node in the current step, -1
+        # for the nodes no bike left.
+        self.freed_by = np.full(len(self.graph), -1, dtype=np.int64)
+        self.just_freed = np.zeros(len(self.graph), dtype=bool)
+
+    def _fields(self):
+        return [
+            "ids",
+            "nodes",
+            "destinations",
+            "directions",
+            "impatience",
+            "moving",
+        ]
+
+    def _reserve(self, count):
+        capacity = len(self.ids)
+        if count <= capacity:
+            return
+        while capacity < count:
+            capacity *= 2
+        for field in self._fields():
+            old = getattr(self, field)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[: self.count] = old[: self.count]
+            setattr(self, field, new)
+
+    def add_bike(self, unique_id, pos, destination):
+        """
+        Adds a bike at a free road.
+        Args:
+            unique_id: The bike's ID
+            pos: Grid coords where the bike starts
+            destination: Grid coords of the bike's destination
+        """
+        self.add_bikes([unique_id], [pos], [destination])
+
+    def add_bikes(self, ids, positions, destinations):
+        """
+        Adds several bikes at once, all of them at free roads.
+        Args:
+            ids: IDs of the bikes
+            positions: Grid coords where each bike starts
+            destinations: Grid coords of the destination of each bike
+        """
+        added = len(ids)
+        self._reserve(self.count + added)
+        new = slice(self.count, self.count + added)
+
+        self.ids[new] = ids
+        self.nodes[new] = [self.graph.node_id(pos) for pos in positions]
+        self.destinations[new] = [
+            self.destination_index[destination] for destination in destinations
+        ]
+        # New bikes face down, like new Bike agents.
+        self.directions[new] = DIRECTION_CODES["Down"]
+        self.impatience[new] = 0
+        self.moving[new] = False
+
+        self.model.occupancy.reshape(-1)[self.cells[self.nodes[new]]] = self.ids[
+            new
+        ]
+        self.model.changes.changed(self.model.change_step(), self.ids[new].tolist())
+        self.model.bikes_in_model += added
+        # Each new bike looks up the routing table of its destination.
+        self.model.route_computations += added
+        self.count += added
+
+    def _keep(self, mask):
+        kept = int(np.count_nonzero(mask))
+        for field in self._fields():
+            array = getattr(self, field)
+            array[:kept] = array[: self.count][mask]
+        self.count = kept
+
+    def light_states(self):
+        """
+        Returns a boolean array with the state of every traffic light.
+        """
+        return self.model.light_states()
+
+    def bikes(self, ids=None):
+        """
+        Returns a list with the (id, pos, direction) of every bike, or of
+        the bikes with the given ids.
+        """
+        rows = slice(0, self.count)
+        if ids is not None:
+            rows = np.flatnonzero(
+                np.isin(self.ids[: self.count], np.fromiter(ids, dtype=np.int64))
+            )
+        coords = self.graph.coords[self.nodes[rows]].tolist()
+        return [
+            (unique_id, tuple(pos), DIRECTIONS[direction])
+            for unique_id, pos, direction in zip(
+                self.ids[rows].tolist(), coords, self.directions[rows].tolist()
+            )
+        ]
+
+    def bike_arrays(self):
+        """
+        Returns arrays with the id, grid coords and direction code of every
+        bike, without copying the engine's state more than needed.
+        """
+        return (
+            self.ids[: self.count],
+            self.graph.coords[self.nodes[: self.count]],
+            self.directions[: self.count],
+        )
+
+    def count_moving(self):
+        """
+        Returns the number of bikes that moved in the last step.
+        """
+        return int(np.count_nonzero(self.moving[: self.count]))
+
+    def _decide(
+        self,
+        free,
+        neighbors,
+        hop,
+        hop_slot,
+        current,
+        progress_slot,
+        reachable_slot,
+        neighbor_distance,
+        impatience,
+    ):
+        # Picks the road each bike moves to with the same rules as
+        # Bike.move, -1 for the bikes that wait, and whether each bike
+        # became impatient and looked for a detour.
+        target = np.full(len(free), -1, dtype=np.int32)
+
+        # CASE 1: move to the next road in the route.
+        on_route = (hop >= 0) & (hop_slot & free).any(axis=1)
+        target[on_route] = hop[on_route]
+
+        # CASE 2: one step away from the destination, wait.
+        undecided = free.any(axis=1) & ~on_route & (current != 1)
+
+        # CASE 3: move to the first empty neighbor one step closer.
+        progress = free & progress_slot
+        on_track = undecided & progress.any(axis=1)
+        first = progress.argmax(axis=1)
+        target[on_track] = neighbors[on_track, first[on_track]]
+
+        # CASE 4: impatient bikes take the empty neighbor with the shortest
+        # remaining route. The congestion aware detours of Bike agents are
+        # searched one bike at a time, so the engine keeps the table choice.
+        impatient = undecided & ~on_track & (impatience >= 3)
+        reachable = free & reachable_slot
+        detour = impatient & reachable.any(axis=1)
+        best = np.where(
+            reachable, neighbor_distance, np.iinfo(np.int32).max
+        ).argmin(axis=1)
+        target[detour] = neighbors[detour, best[detour]]
+        return target, impatient
+
+    def step(self):
+        """
+        Advance every bike by one step.
+        Bikes at a red traffic light wait, bikes next to their destination
+        leave the model and the rest follow the same rules as Bike.move.
+        The bikes move in a random order drawn from the engine's generator:
+        a bike can move into a cell freed by a bike before it in the order,
+        and when several bikes pick the same cell the first one takes it.
+        """
+        if self.count == 0:
+            return
+
+        model = self.model
+        occupancy = model.occupancy.reshape(-1)
+        distance_of = self.distance.reshape(-1)
+        nodes_count = len(self.graph)
+
+        # Bikes waiting at a red traffic light keep their state.
+        lights = self.node_lights[self.nodes[: self.count]]
+        red = np.zeros(self.count, dtype=bool)
+        at_light = lights >= 0
+        red[at_light] = self.light_states()[lights[at_light]]
+
+        # Bikes next to their destination leave the model.
+        routes = (
+            self.destinations[: self.count].astype(np.int64) * nodes_count
+            + self.nodes[: self.count]
+        )
+        distance = distance_of[routes]
+        arrived = ~red & (distance == 0)
+        if arrived.any():
+            occupancy[self.cells[self.nodes[: self.count][arrived]]] = -1
+            model.bikes_arrived += int(np.count_nonzero(arrived))
+            model.bikes_in_model -= int(np.count_nonzero(arrived))
+            model.bikes_moving -= int(np.count_nonzero(self.moving[: self.count][arrived]))
+            model.changes.removed(
+                model.change_step(), self.ids[: self.count][arrived].tolist()
+            )
+            keep = ~arrived
+            self._keep(keep)
+            red = red[keep]
+            routes = routes[keep]
+            distance = distance[keep]
+
+        active = np.flatnonzero(~red)
+        if active.size == 0:
+            return
+
+        nodes = self.nodes[active]
+        impatience = self.impatience[active]
+        current = distance[active]
+        # Offset of each active bike's routing table in the flat arrays.
+        table = (routes[active] - nodes)[:, None]
+
+        # Successors of each active bike, padded with -1, and which of them
+        # are the next road in the route, one step closer or lead to the
+        # destination at all.
+        neighbors = self.neighbors[nodes]
+        valid = neighbors >= 0
+        safe = np.where(valid, neighbors, 0)
+        neighbor_cells = self.cells[safe]
+        neighbor_distance = np.where(valid, distance_of[table + safe], -1)
+        hop = self.next_hop.reshape(-1)[routes[active]]
+        hop_slot = valid & (neighbors == hop[:, None])
+        progress_slot = valid & (neighbor_distance == (current - 1)[:, None]) & (
+            neighbor_distance >= 0
+        )
+        reachable_slot = valid & (neighbor_distance >= 0)
+
+        # Random order in which the bikes move, like the random activation
+        # of Bike agents. A bike sees the cells freed by the bikes before it
+        # in the order, and takes a cell before the bikes after it.
+        priority = self.rng.permutation(active.size)
+        # Bikes that were waiting sleep in BikeScheduler, and are activated
+        # after the others when a cell next to them is freed.
+        priority[~self.moving[active]] += active.size
+        freed_by = self.freed_by
+
+        target = np.full(active.size, -1, dtype=np.int32)
+        impatient = np.zeros(active.size, dtype=bool)
+        moved = np.zeros(active.size, dtype=bool)
+        pending = np.arange(active.size)
+        freed = []
+        # Bikes that could not move decide again when a neighbor is freed
+        # or another bike took their cell, until no more bikes move.
+        while pending.size:
+            free = (
+                valid[pending]
+                & (occupancy[neighbor_cells[pending]] < 0)
+                & (freed_by[safe[pending]] < priority[pending, None])
+            )
+            choice, replanned = self._decide(
+                free,
+                neighbors[pending],
+                hop[pending],
+                hop_slot[pending],
+                current[pending],
+                progress_slot[pending],
+                reachable_slot[pending],
+                neighbor_distance[pending],
+                impatience[pending],
+            )
+            target[pending] = choice
+            impatient[pending] = replanned
+
+            movers = pending[choice >= 0]
+            if movers.size == 0:
+                break
+            # Priorities go up to twice the number of bikes.
+            key = target[movers].astype(np.int64) * 2 * active.size
+            order = movers[np.argsort(key + priority[movers])]
+            claimed = target[order]
+            first_claim = np.ones(order.size, dtype=bool)
+            first_claim[1:] = claimed[1:] != claimed[:-1]
+            winners = order[first_claim]
+            moved[winners] = True
+
+            left = nodes[winners]
+            occupancy[self.cells[left]] = -1
+            occupancy[self.cells[target[winners]]] = self.ids[active[winners]]
+            freed_by[left] = priority[winners]
+            freed.append(left)
+
+            lost = order[~first_claim]
+            waiting = np.flatnonzero(~moved & (target < 0))
+            self.just_freed[left] = True
+            reopened = waiting[
+                (valid[waiting] & self.just_freed[safe[waiting]]).any(axis=1)
+            ]
+            self.just_freed[left] = False
+            pending = np.concatenate((lost, reopened))
+        if freed:
+            freed_by[np.concatenate(freed)] = -1
+
+        count = int(np.count_nonzero(impatient))
+        model.replans += count
+        model.route_computations += count
+
+        # Bikes that start or stop moving update the model's counter.
+        was_moving = self.moving[active]
+        model.bikes_moving += int(np.count_nonzero(moved & ~was_moving))
+        model.bikes_moving -= int(np.count_nonzero(~moved & was_moving))
+
+        bikes = active[moved]
+        new_nodes = target[moved]
+        model.changes.changed(model.change_step(), self.ids[bikes].tolist())
+        self.nodes[bikes] = new_nodes
+        self.directions[bikes] = self.node_directions[new_nodes]
+        self.impatience[bikes] = 0
+        self.moving[bikes] = True
+
+        # Impatient bikes that could not move start waiting again.
+        waiting = ~moved
+        self.moving[active[waiting]] = False
+        self.impatience[active[waiting]] = np.where(
+            impatient[waiting], 1, impatience[waiting] + 1
+        )
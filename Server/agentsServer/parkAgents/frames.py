@@ -0,0 +1,43 @@
+import numpy as np
+
+# Header of a binary frame: the step of the model and the number of bikes.
+FRAME_HEADER = np.dtype([("step", "<u4"), ("count", "<u4")])
+
+# Record of each bike in a binary frame, packed without padding. The
+# direction is a code of tiles.DIRECTIONS, and z is the row of the grid.
+FRAME_RECORD = np.dtype(
+    [("id", "<i4"), ("x", "<u2"), ("z", "<u2"), ("direction", "u1")]
+)
+
+
+def pack_frame(step, ids, coords, directions):
+    """
+    Returns the bikes of a step as a little-endian binary frame, a
+    FRAME_HEADER followed by one FRAME_RECORD per bike.
+    Args:
+        step: Step of the model
+        ids: Array with the id of each bike
+        coords: (bikes, 2) array with the grid coords of each bike
+        directions: Array with the direction code of each bike
+    """
+    header = np.array([(step, len(ids))], dtype=FRAME_HEADER)
+    records = np.empty(len(ids), dtype=FRAME_RECORD)
+    records["id"] = ids
+    records["x"] = coords[:, 0]
+    records["z"] = coords[:, 1]
+    records["direction"] = directions
+    return header.tobytes() + records.tobytes()
+
+
+def unpack_frame(frame):
+    """
+    Returns the step and the records array of a binary frame.
+    """
+    header = np.frombuffer(frame, dtype=FRAME_HEADER, count=1)[0]
+    records = np.frombuffer(
+        frame,
+        dtype=FRAME_RECORD,
+        count=int(header["count"]),
+        offset=FRAME_HEADER.itemsize,
+    )
+    return int(header["step"]), records
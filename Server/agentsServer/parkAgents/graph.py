@@ -0,0 +1,319 @@
+import numpy as np
+from .tiles import DIRECTION_CODES
+
+# Offsets of the cells in the Moore neighborhood of a cell.
+MOORE_OFFSETS = [
+    (dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx != 0 or dy != 0
+]
+
+
+def moore_neighborhood(pos, width, height):
+    """
+    Returns the grid coords around pos that are inside a width x height map.
+    """
+    x, y = pos
+    return [
+        (x + dx, y + dy)
+        for dx, dy in MOORE_OFFSETS
+        if 0 <= x + dx < width and 0 <= y + dy < height
+    ]
+
+
+def possible_roads(tiles, road):
+    """
+    Returns the grid coords of the roads a bike can move to from a road.
+    Args:
+        tiles: TileLayer of the map
+        road: Grid coords of the road
+    """
+    direction = tiles.direction_at(road)
+    possible = []
+
+    for neighbor in moore_neighborhood(road, tiles.width, tiles.height):
+        neighbor_direction = tiles.direction_at(neighbor)
+        if neighbor_direction is None:
+            continue
+
+        if (
+            direction == "Up"
+            and neighbor[1] == road[1] + 1
+            and not (
+                neighbor_direction == "Left"
+                and neighbor[0] > road[0]
+                or neighbor_direction == "Right"
+                and neighbor[0] < road[0]
+            )
+        ):
+            possible.append(neighbor)
+        elif (
+            direction == "Down"
+            and neighbor[1] == road[1] - 1
+            and not (
+                neighbor_direction == "Left"
+                and neighbor[0] > road[0]
+                or neighbor_direction == "Right"
+                and neighbor[0] < road[0]
+            )
+        ):
+            possible.append(neighbor)
+        elif (
+            direction == "Left"
+            and neighbor[0] == road[0] - 1
+            and not (
+                neighbor_direction == "Up"
+                and neighbor[1] < road[1]
+                or neighbor_direction == "Down"
+                and neighbor[1] > road[1]
+            )
+        ):
+            possible.append(neighbor)
+        elif (
+            direction == "Right"
+            and neighbor[0] == road[0] + 1
+            and not (
+                neighbor_direction == "Up"
+                and neighbor[1] < road[1]
+                or neighbor_direction == "Down"
+                and neighbor[1] > road[1]
+            )
+        ):
+            possible.append(neighbor)
+    return possible
+
+
+class RoadGraph:
+    """
+    Directed graph of the roads in the park, indexed by position.
+    Attributes:
+        coords: (nodes, 2) int32 array with the grid coords of each node
+        offsets: CSR row offsets, the successors of node i are
+            targets[offsets[i]:offsets[i + 1]]
+        targets: CSR column array with the node ids of the successors
+        reverse_offsets: CSR row offsets of the reversed graph
+        reverse_targets: CSR column array with the node ids of the
+            predecessors
+        node_of: int32 array indexed by [x, y] with the node id of the road
+            in each cell, -1 where there is no road
+        positions: List with the grid coords of each node, indexed by node
+            id, built on first use
+        index: Dictionary that maps grid coords to node ids, built on first
+            use
+    """
+
+    def __init__(
+        self,
+        positions,
+        offsets,
+        targets,
+        reverse_offsets=None,
+        reverse_targets=None,
+        node_of=None,
+    ):
+        """
+        Creates a new road graph from its CSR arrays.
+        The arrays are used as given when they already have the right type,
+        so they can be memory-mapped from a compiled map.
+        Args:
+            positions: Grid coords of each road, as a list or (nodes, 2) array
+            offsets: CSR row offsets, one more than the number of roads
+            targets: CSR column array with the node ids of the successors
+            reverse_offsets: CSR row offsets of the reversed graph, computed
+                if omitted
+            reverse_targets: CSR column array of the reversed graph, computed
+                if omitted
+            node_of: Array with the node id of each cell, computed if omitted
+        """
+        self.coords = np.asarray(positions, dtype=np.int32).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int32)
+        self.targets = np.asarray(targets, dtype=np.int32)
+        nodes = len(self.coords)
+
+        # Reversed graph, used to search backwards from a destination.
+        if reverse_offsets is None or reverse_targets is None:
+            sources = np.repeat(np.arange(nodes, dtype=np.int32), self.out_degree())
+            reverse_targets = sources[np.argsort(self.targets, kind="stable")]
+            reverse_offsets = np.zeros(nodes + 1, dtype=np.int32)
+            reverse_offsets[1:] = np.cumsum(np.bincount(self.targets, minlength=nodes))
+        self.reverse_offsets = np.asarray(reverse_offsets, dtype=np.int32)
+        self.reverse_targets = np.asarray(reverse_targets, dtype=np.int32)
+
+        if node_of is None:
+            shape = tuple(self.coords.max(axis=0) + 1) if nodes else (0, 0)
+            node_of = np.full(shape, -1, dtype=np.int32)
+            node_of[self.coords[:, 0], self.coords[:, 1]] = np.arange(
+                nodes, dtype=np.int32
+            )
+        self.node_of = np.asarray(node_of, dtype=np.int32)
+
+        self._positions = None
+        self._index = None
+        self._adjacency = None
+        self._neighbor_matrix = None
+
+    @property
+    def positions(self):
+        if self._positions is None:
+            self._positions = list(map(tuple, self.coords.tolist()))
+        return self._positions
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = {pos: node for node, pos in enumerate(self.positions)}
+        return self._index
+
+    @classmethod
+    def from_successors(cls, positions, successors):
+        """
+        Creates a road graph from the grid coords each road can move to.
+        Args:
+            positions: List with the grid coords of each road
+            successors: List with the grid coords each road can move to,
+                in the same order as positions
+        """
+        index = {pos: node for node, pos in enumerate(positions)}
+        offsets = np.zeros(len(positions) + 1, dtype=np.int32)
+        offsets[1:] = np.cumsum([len(succ) for succ in successors])
+        targets = np.fromiter(
+            (index[pos] for succ in successors for pos in succ),
+            dtype=np.int32,
+            count=int(offsets[-1]),
+        )
+        return cls(positions, offsets, targets)
+
+    @classmethod
+    def from_tiles(cls, tiles):
+        """
+        Creates the road graph of a TileLayer, with the nodes in the order
+        of the map file and the successors of each node in the same order as
+        possible_roads, using array operations over the whole map.
+        """
+        roads = tiles.road_coords()
+        directions = tiles.directions
+        width, height = tiles.width, tiles.height
+
+        node_of = np.full((width, height), -1, dtype=np.int32)
+        node_of[roads[:, 0], roads[:, 1]] = np.arange(len(roads), dtype=np.int32)
+
+        up, down, left, right = (
+            DIRECTION_CODES[direction] for direction in ["Up", "Down", "Left", "Right"]
+        )
+
+        sources = []
+        targets = []
+        keys = []
+        for k, (dx, dy) in enumerate(MOORE_OFFSETS):
+            # Cells whose neighbor at (dx, dy) is inside the map.
+            x0, x1 = max(0, -dx), width - max(0, dx)
+            y0, y1 = max(0, -dy), height - max(0, dy)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            road = directions[x0:x1, y0:y1]
+            neighbor = directions[x0 + dx:x1 + dx, y0 + dy:y1 + dy]
+
+            # Same rules as possible_roads, with dx and dy fixed.
+            vertical_ok = ~(
+                (neighbor == left) & (dx > 0) | (neighbor == right) & (dx < 0)
+            )
+            horizontal_ok = ~(
+                (neighbor == up) & (dy < 0) | (neighbor == down) & (dy > 0)
+            )
+            edge = (neighbor != 0) & (
+                (road == up) & (dy == 1) & vertical_ok
+                | (road == down) & (dy == -1) & vertical_ok
+                | (road == left) & (dx == -1) & horizontal_ok
+                | (road == right) & (dx == 1) & horizontal_ok
+            )
+
+            ex, ey = np.nonzero(edge)
+            ex += x0
+            ey += y0
+            source = node_of[ex, ey]
+            sources.append(source)
+            targets.append(node_of[ex + dx, ey + dy])
+            keys.append(source.astype(np.int64) * len(MOORE_OFFSETS) + k)
+
+        if keys:
+            order = np.argsort(np.concatenate(keys))
+            sources = np.concatenate(sources)[order]
+            targets = np.concatenate(targets)[order]
+        else:
+            sources = targets = np.zeros(0, dtype=np.int32)
+
+        offsets = np.zeros(len(roads) + 1, dtype=np.int32)
+        offsets[1:] = np.cumsum(np.bincount(sources, minlength=len(roads)))
+        return cls(roads, offsets, targets, node_of=node_of)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __contains__(self, pos):
+        return self.node_id(pos) is not None
+
+    def node_id(self, pos):
+        """
+        Returns the node id of a road, or None if there is no road at pos.
+        """
+        x, y = pos
+        if 0 <= x < self.node_of.shape[0] and 0 <= y < self.node_of.shape[1]:
+            node = int(self.node_of[x, y])
+            if node >= 0:
+                return node
+        return None
+
+    def neighbors(self, pos):
+        """
+        Returns the grid coords of the roads reachable in one step from pos.
+        """
+        node = self.index.get(pos)
+        if node is None:
+            return ()
+        if self._adjacency is None:
+            # Tuples of successor coords, so that callers that work with
+            # positions do not have to convert the CSR arrays on every
+            # query.
+            positions = self.positions
+            offsets = self.offsets.tolist()
+            targets = self.targets.tolist()
+            self._adjacency = [
+                tuple(positions[target] for target in targets[start:end])
+                for start, end in zip(offsets[:-1], offsets[1:])
+            ]
+        return self._adjacency[node]
+
+    def neighbor_ids(self, node):
+        """
+        Returns the node ids of the successors of a node as a CSR slice.
+        """
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def predecessor_ids(self, node):
+        """
+        Returns the node ids of the roads that can move into a node.
+        """
+        return self.reverse_targets[
+            self.reverse_offsets[node]:self.reverse_offsets[node + 1]
+        ]
+
+    def neighbor_matrix(self):
+        """
+        Returns a (nodes, max out degree) int32 array with the successors of
+        each node in CSR order, padded with -1.
+        """
+        if self._neighbor_matrix is None:
+            degree = self.out_degree()
+            width = int(degree.max()) if len(degree) else 0
+            matrix = np.full((len(self), width), -1, dtype=np.int32)
+            rows = np.repeat(np.arange(len(self)), degree)
+            columns = np.arange(len(self.targets)) - np.repeat(
+                self.offsets[:-1], degree
+            )
+            matrix[rows, columns] = self.targets
+            self._neighbor_matrix = matrix
+        return self._neighbor_matrix
+
+    def out_degree(self):
+        """
+        Returns an array with the number of successors of each node.
+        """
+        return np.diff(self.offsets)
@@ -0,0 +1,391 @@
+from .metrics import NODES_EXPANDED
+import heapq
+import numpy as np
+
+# Side of the square blocks of cells a BlockIndex splits a map into.
+BLOCK_SIZE = 32
+
+# Number of blocks whose edges are kept in memory by a BlockIndex.
+CACHED_BLOCKS = 256
+
+INFINITY = float("inf")
+
+
+class BlockIndex:
+    """
+    Hierarchical index of a road graph, for maps too large to keep a
+    routing table of every road to every destination. The map is split in
+    square blocks of cells, and the roads with an edge to or from another
+    block are the portals of their block. For every exit, a portal with an
+    edge that leaves its block, the index keeps the moves from the other
+    portals of the block to it without leaving the block.
+    Routes to a destination search the portals with these moves instead of
+    the roads, and the roads of a block are only searched when a bike in it
+    asks for its route, see BlockRoute.
+    Attributes:
+        block_size: Side of the blocks in cells
+        blocks: int32 array with the block of each node
+        block_offsets: CSR offsets, the nodes of block b are
+            block_nodes[block_offsets[b]:block_offsets[b + 1]]
+        block_nodes: int32 array with the node ids sorted by block
+        portals: int32 array with the node id of each portal
+        portal_of: int32 array with the portal of each node, -1 for the
+            nodes that are not portals
+        exit_offsets: CSR offsets, the portals that reach exit p without
+            leaving its block are exit_sources[exit_offsets[p]:exit_offsets[p + 1]]
+        exit_sources: CSR column array with the portals that reach each exit
+        exit_costs: CSR array with the moves from each source to the exit
+    """
+
+    def __init__(
+        self,
+        graph,
+        block_size,
+        blocks,
+        block_offsets,
+        block_nodes,
+        portals,
+        exit_offsets,
+        exit_sources,
+        exit_costs,
+    ):
+        """
+        Creates a block index from its arrays, used as given when they
+        already have the right type so that they can be memory-mapped from a
+        compiled map. Use from_graph to build the arrays.
+        Args:
+            graph: RoadGraph the index was built from
+            block_size: Side of the blocks in cells
+        """
+        self.graph = graph
+        self.block_size = block_size
+        self.blocks = np.asarray(blocks, dtype=np.int32)
+        self.block_offsets = np.asarray(block_offsets, dtype=np.int32)
+        self.block_nodes = np.asarray(block_nodes, dtype=np.int32)
+        self.portals = np.asarray(portals, dtype=np.int32)
+        self.exit_offsets = np.asarray(exit_offsets, dtype=np.int32)
+        self.exit_sources = np.asarray(exit_sources, dtype=np.int32)
+        self.exit_costs = np.asarray(exit_costs, dtype=np.int32)
+
+        self.portal_of = np.full(len(graph), -1, dtype=np.int32)
+        self.portal_of[self.portals] = np.arange(len(self.portals), dtype=np.int32)
+        # Position of each node in the list of nodes of its block.
+        self.local = np.zeros(len(graph), dtype=np.int32)
+        self.local[self.block_nodes] = np.arange(
+            len(graph), dtype=np.int32
+        ) - np.repeat(self.block_offsets[:-1], np.diff(self.block_offsets))
+        self._edges = {}
+        self._portal_edges = None
+
+    @classmethod
+    def from_graph(cls, graph, block_size=BLOCK_SIZE):
+        """
+        Builds the block index of a road graph, searching every block from
+        each of its exits.
+        """
+        nodes = len(graph)
+        coords = graph.coords.astype(np.int64)
+        columns = int(coords[:, 1].max()) // block_size + 1 if nodes else 0
+        blocks = coords[:, 0] // block_size * columns + coords[:, 1] // block_size
+        block_count = int(blocks.max()) + 1 if nodes else 0
+
+        block_nodes = np.argsort(blocks, kind="stable").astype(np.int32)
+        block_offsets = np.zeros(block_count + 1, dtype=np.int32)
+        block_offsets[1:] = np.cumsum(np.bincount(blocks, minlength=block_count))
+
+        # Edges between two blocks, from an exit to an entry.
+        sources = np.repeat(np.arange(nodes, dtype=np.int32), graph.out_degree())
+        crossing = blocks[sources] != blocks[graph.targets]
+        exits = np.unique(sources[crossing])
+        portals = np.union1d(exits, graph.targets[crossing]).astype(np.int32)
+
+        index = cls(
+            graph,
+            block_size,
+            blocks,
+            block_offsets,
+            block_nodes,
+            portals,
+            np.zeros(len(portals) + 1, dtype=np.int32),
+            np.zeros(0, dtype=np.int32),
+            np.zeros(0, dtype=np.int32),
+        )
+
+        # Moves from the portals of each block to each of its exits.
+        # The exits are searched block by block, so the edges of each block
+        # are only read once.
+        rows = [[] for portal in range(len(portals))]
+        portal_of = index.portal_of.tolist()
+        local = index.local.tolist()
+        expanded = 0
+        for exit_node in exits[np.argsort(blocks[exits], kind="stable")].tolist():
+            block = int(blocks[exit_node])
+            distance = index.search_block(block, {exit_node: 0})
+            for portal_node in index.block_portals(block):
+                moves = distance[local[portal_node]]
+                if portal_node != exit_node and moves < INFINITY:
+                    rows[portal_of[exit_node]].append((portal_of[portal_node], moves))
+            expanded += sum(moves < INFINITY for moves in distance)
+        NODES_EXPANDED.inc(expanded)
+        index._edges = {}
+
+        exit_offsets = np.zeros(len(portals) + 1, dtype=np.int32)
+        exit_offsets[1:] = np.cumsum([len(row) for row in rows])
+        edges = np.array(
+            [edge for row in rows for edge in row], dtype=np.int32
+        ).reshape(-1, 2)
+        index.exit_offsets = exit_offsets
+        index.exit_sources = edges[:, 0].copy()
+        index.exit_costs = edges[:, 1].copy()
+        return index
+
+    def __len__(self):
+        return len(self.block_offsets) - 1
+
+    def block_portals(self, block):
+        """
+        Returns the node ids of the portals of a block.
+        """
+        block_nodes = self.block_nodes[
+            self.block_offsets[block]:self.block_offsets[block + 1]
+        ]
+        return block_nodes[self.portal_of[block_nodes] >= 0].tolist()
+
+    def search_block(self, block, seeds):
+        """
+        Returns a list with the moves from every node of a block to the
+        closest seed without leaving the block, in the order of its nodes
+        in block_nodes, INFINITY where no seed can be reached.
+        Args:
+            block: Block to search
+            seeds: Dictionary with the moves from each seed node to the end
+                of the route
+        """
+        predecessors = self._block_edges(block)
+        local = self.local
+        distance = [INFINITY] * len(predecessors)
+        queue = []
+        for node, moves in seeds.items():
+            position = int(local[node])
+            if moves < distance[position]:
+                distance[position] = moves
+                queue.append((moves, position))
+        heapq.heapify(queue)
+
+        while queue:
+            moves, position = heapq.heappop(queue)
+            if moves > distance[position]:
+                continue
+            moves += 1
+            for predecessor in predecessors[position]:
+                if moves < distance[predecessor]:
+                    distance[predecessor] = moves
+                    heapq.heappush(queue, (moves, predecessor))
+        return distance
+
+    def portal_edges(self):
+        """
+        Returns a list with the (portal, moves) of the portals that reach
+        each portal in one block, built on first use: the portals of its
+        block that reach it without leaving the block, and the exits of
+        other blocks with an edge into it.
+        """
+        if self._portal_edges is None:
+            graph = self.graph
+            sources = np.repeat(
+                np.arange(len(graph), dtype=np.int32), graph.out_degree()
+            )
+            crossing = self.blocks[sources] != self.blocks[graph.targets]
+            offsets = self.exit_offsets.tolist()
+            exit_sources = self.exit_sources.tolist()
+            exit_costs = self.exit_costs.tolist()
+            edges = [
+                list(zip(exit_sources[start:end], exit_costs[start:end]))
+                for start, end in zip(offsets[:-1], offsets[1:])
+            ]
+            for source, target in zip(
+                self.portal_of[sources[crossing]].tolist(),
+                self.portal_of[graph.targets[crossing]].tolist(),
+            ):
+                edges[target].append((source, 1))
+            self._portal_edges = edges
+        return self._portal_edges
+
+    def _block_edges(self, block):
+        # Predecessors inside the block of each node of the block, by their
+        # position in the block. Read from the CSR arrays of the graph for
+        # the whole block at once.
+        edges = self._edges.get(block)
+        if edges is not None:
+            return edges
+
+        graph = self.graph
+        block_nodes = self.block_nodes[
+            self.block_offsets[block]:self.block_offsets[block + 1]
+        ]
+        starts = graph.reverse_offsets[block_nodes]
+        counts = graph.reverse_offsets[block_nodes + 1] - starts
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(
+            int(counts.sum())
+        )
+        predecessors = graph.reverse_targets[positions]
+        owners = np.repeat(np.arange(len(block_nodes)), counts)
+        inside = self.blocks[predecessors] == block
+
+        edges = [[] for node in range(len(block_nodes))]
+        for owner, predecessor in zip(
+            owners[inside].tolist(), self.local[predecessors[inside]].tolist()
+        ):
+            edges[owner].append(predecessor)
+
+        if len(self._edges) >= CACHED_BLOCKS:
+            del self._edges[next(iter(self._edges))]
+        self._edges[block] = edges
+        return edges
+
+
+class BlockRoute:
+    """
+    Route from every road to one destination through a BlockIndex, with the
+    same methods as RouteTable. The moves from each portal to the
+    destination are searched over the portals the first time the route is
+    used, and the moves from the roads of a block the first time a road of
+    the block is asked for, so a route never searches more roads than the
+    blocks its bikes go through.
+    Attributes:
+        destination: Grid coords of the destination
+        goals: Node ids of the roads where a bike reaches the destination
+    """
+
+    def __init__(self, index, destination, goals):
+        """
+        Args:
+            index: BlockIndex of the graph
+            destination: Grid coords of the destination
+            goals: Node ids of the roads next to the destination
+        """
+        self.index = index
+        self.graph = index.graph
+        self.destination = destination
+        self.goals = list(goals)
+        self._portal_distance = None
+        # Moves from the roads of each searched block, by block.
+        self._tables = {}
+
+    def distance_of(self, node):
+        """
+        Returns the number of steps from a node to the destination, or -1 if
+        it can not be reached.
+        """
+        block = int(self.index.blocks[node])
+        table = self._tables.get(block)
+        if table is None:
+            table = self._tables[block] = self._search(block)
+        moves = table[self.index.local[node]]
+        return -1 if moves == INFINITY else moves
+
+    def distance_from(self, pos):
+        """
+        Returns the number of steps from a road to the destination, or -1 if
+        it can not be reached.
+        """
+        node = self.graph.node_id(pos)
+        if node is None:
+            return -1
+        return self.distance_of(node)
+
+    def next_hop_of(self, node):
+        """
+        Returns the node id of the next road on the route, or -1 at the goals
+        and at nodes that can not reach the destination.
+        """
+        distance = self.distance_of(node)
+        if distance <= 0:
+            return -1
+        for successor in self.graph.neighbor_ids(node).tolist():
+            if self.distance_of(successor) == distance - 1:
+                return successor
+        return -1
+
+    def next_hop_from(self, pos):
+        """
+        Returns the grid coords of the next road on the route, or None at the
+        goals and at roads that can not reach the destination.
+        """
+        node = self.graph.node_id(pos)
+        if node is None:
+            return None
+        next_hop = self.next_hop_of(node)
+        return None if next_hop < 0 else self.graph.positions[next_hop]
+
+    def route_from(self, pos):
+        """
+        Returns the list of grid coords to follow from a road to the
+        destination, not including pos itself.
+        """
+        route = []
+        node = self.graph.node_id(pos)
+        if node is None:
+            return route
+        node = self.next_hop_of(node)
+        while node >= 0:
+            route.append(self.graph.positions[node])
+            node = self.next_hop_of(node)
+        return route
+
+    def _search(self, block):
+        # Moves from the roads of a block, to the goals in the block or to
+        # one of its portals and from there to the destination.
+        index = self.index
+        portal_distance = self._portals()
+        seeds = {
+            node: portal_distance[index.portal_of[node]]
+            for node in index.block_portals(block)
+            if portal_distance[index.portal_of[node]] < INFINITY
+        }
+        for goal in self.goals:
+            if index.blocks[goal] == block:
+                seeds[goal] = 0
+        table = index.search_block(block, seeds)
+        NODES_EXPANDED.inc(sum(moves < INFINITY for moves in table))
+        return table
+
+    def _portals(self):
+        # Moves from every portal to the destination, searched backwards
+        # over the portals from the ones that reach a goal in its block.
+        if self._portal_distance is not None:
+            return self._portal_distance
+
+        index = self.index
+        portal_of = index.portal_of
+        local = index.local
+
+        distance = [INFINITY] * len(index.portals)
+        queue = []
+        goal_blocks = {}
+        for goal in self.goals:
+            goal_blocks.setdefault(int(index.blocks[goal]), {})[goal] = 0
+        for block, seeds in goal_blocks.items():
+            moves_in_block = index.search_block(block, seeds)
+            for node in index.block_portals(block):
+                moves = moves_in_block[local[node]]
+                if moves < INFINITY:
+                    distance[portal_of[node]] = moves
+                    queue.append((moves, int(portal_of[node])))
+        heapq.heapify(queue)
+
+        edges = index.portal_edges()
+        expanded = 0
+        while queue:
+            moves, portal = heapq.heappop(queue)
+            if moves > distance[portal]:
+                continue
+            expanded += 1
+            for source, cost in edges[portal]:
+                if moves + cost < distance[source]:
+                    distance[source] = moves + cost
+                    heapq.heappush(queue, (moves + cost, source))
+        NODES_EXPANDED.inc(expanded)
+
+        self._portal_distance = distance
+        return distance
@@ -0,0 +1,59 @@
+import numpy as np
+
+
+class LightPhases:
+    """
+    State of every traffic light as a function of the step of the model.
+    A light with period timeToChange flips at every step that is a multiple
+    of it, so its state is its initial state flipped once per multiple
+    already passed, and no light has to be stepped.
+    Attributes:
+        initial: Boolean array with the initial state of each light
+        periods: Array with the timeToChange of each light
+    """
+
+    def __init__(self, lights):
+        """
+        Args:
+            lights: List of (pos, state, timeToChange) tuples, as in
+                TileLayer.lights
+        """
+        self.initial = np.array([state for pos, state, period in lights], dtype=bool)
+        self.periods = np.array([period for pos, state, period in lights], dtype=np.int64)
+        # Python copies for the lookups of single lights.
+        self._initial = self.initial.tolist()
+        self._periods = self.periods.tolist()
+        self._cached = (None, None)
+
+    def __len__(self):
+        return len(self._periods)
+
+    def state(self, index, step):
+        """
+        Returns the state of a light while the model is at a step, True
+        when bikes must wait at it.
+        """
+        period = self._periods[index]
+        flips = (step + period - 1) // period
+        return self._initial[index] != bool(flips & 1)
+
+    def next_change(self, index, step):
+        """
+        Returns the first step after a step at which a light has the other
+        state. Lights change at the end of the steps that are a multiple of
+        their timeToChange.
+        """
+        period = self._periods[index]
+        return (step + period - 1) // period * period + 1
+
+    def states(self, step):
+        """
+        Returns a boolean array with the state of every light while the model
+        is at a step. The array of the last step asked for is reused.
+        """
+        cached_step, states = self._cached
+        if cached_step != step:
+            flips = (step + self.periods - 1) // self.periods
+            states = self.initial ^ (flips & 1).astype(bool)
+            self._cached = (step, states)
+        return states
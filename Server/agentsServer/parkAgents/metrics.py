@@ -0,0 +1,235 @@
+import bisect
+import threading
+
+# Buckets of the time histograms, in seconds.
+TIME_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+# Buckets of the histograms that count things per step.
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Metric:
+    """
+    Metric with one value per combination of label values. Updating a
+    metric only takes a lock and a dictionary lookup, so metrics can be
+    collected all the time.
+    Attributes:
+        name: Name of the metric
+        help: Description of the metric
+        labels: Names of the labels of the metric
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def snapshot(self):
+        """
+        Returns the metric as a dictionary that can be sent to other
+        processes and merged with merge_snapshots.
+        """
+        with self.lock:
+            values = {
+                key: list(value) if isinstance(value, list) else value
+                for key, value in self.values.items()
+            }
+        return {
+            "kind": self.kind,
+            "help": self.help,
+            "labels": self.labels,
+            "values": values,
+        }
+
+
+class Counter(Metric):
+    """Metric that only goes up."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Metric that is set to the current value of something."""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Metric that counts observations in buckets, along with their sum.
+    Attributes:
+        buckets: Upper bounds of the buckets, in increasing order
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            # Count of each bucket, plus one for +Inf, and the sum.
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[bucket] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot["buckets"] = self.buckets
+        return snapshot
+
+
+class MetricsRegistry:
+    """
+    Metrics of a process, by name.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def snapshot(self):
+        """
+        Returns every metric as a dictionary, see Metric.snapshot.
+        """
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+def merge_snapshots(*snapshots):
+    """
+    Returns the sum of the snapshots of several processes. Counters,
+    gauges and histograms with the same labels are added up.
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {**metric, "values": {}})
+            for key, value in metric["values"].items():
+                if key not in target["values"]:
+                    target["values"][key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    total = target["values"][key]
+                    for i, count in enumerate(value):
+                        total[i] += count
+                else:
+                    target["values"][key] += value
+    return merged
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    ]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def render(snapshot):
+    """
+    Returns a snapshot in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, metric in sorted(snapshot.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for key, value in sorted(metric["values"].items()):
+            if metric["kind"] != "histogram":
+                lines.append(f"{name}{_labels(metric['labels'], key)} {value}")
+                continue
+
+            cumulative = 0
+            bounds = [str(bound) for bound in metric["buckets"]] + ["+Inf"]
+            for bound, count in zip(bounds, value[:-1]):
+                cumulative += count
+                labels = _labels(metric["labels"], key, [("le", bound)])
+                lines.append(f"{name}_bucket{labels} {cumulative}")
+            labels = _labels(metric["labels"], key)
+            lines.append(f"{name}_sum{labels} {value[-1]}")
+            lines.append(f"{name}_count{labels} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+# Metrics of the models of this process.
+REGISTRY = MetricsRegistry()
+
+STEP_SECONDS = REGISTRY.histogram(
+    "park_step_seconds",
+    "Wall time of ParkModel.step, by phase: spawn, engine (vector engine only), "
+    "scheduler, stats and total.",
+    ["phase"],
+)
+ROUTE_COMPUTATIONS = REGISTRY.histogram(
+    "park_route_computations_per_step",
+    "Routes looked up by the bikes in each step.",
+    buckets=COUNT_BUCKETS,
+)
+REPLANS = REGISTRY.counter(
+    "park_replans_total",
+    "Routes recalculated by impatient bikes (CASE 4 of Bike.move).",
+)
+NODES_EXPANDED = REGISTRY.counter(
+    "park_route_nodes_expanded_total",
+    "Roads expanded by the searches that build the routing tables.",
+)
+REPLAN_NODES_EXPANDED = REGISTRY.counter(
+    "park_replan_nodes_expanded_total",
+    "Roads expanded by the incremental searches of impatient bikes.",
+)
+BIKES_IN_MODEL = REGISTRY.gauge(
+    "park_bikes_in_model",
+    "Bikes in the models of the server.",
+)
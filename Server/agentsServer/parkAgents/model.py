@@ -1,163 +1,258 @@
 from mesa import Model
-from mesa.time import RandomActivation
 from mesa.space import MultiGrid
-from .agent import Bike, Destination, Obstacle, Road, Traffic_Light
-import json
+from .agent import Bike, Traffic_Light
+from .changes import ChangeLog
+from .compiled import compile_map, route_tables
+from .engine import VectorEngine
+from .graph import RoadGraph, possible_roads
+from .lights import LightPhases
+from .metrics import REPLANS, ROUTE_COMPUTATIONS, STEP_SECONDS
+from .profiling import (
+    ENGINE,
+    SCHEDULER,
+    SPAWN,
+    ProfiledBike,
+    Profiler,
+)
+from .replanning import CongestionRoutes
+from .scheduler import BikeScheduler
+from .tiles import DIRECTION_CODES
+import numpy as np
+import time
 
 
 class ParkModel(Model):
     """
     Creates a model based on a park map.
+    Args:
+        map_file: Name of a map in PARK_FILES, or the path of a map file
+        compiled: CompiledMap to use instead of compiling map_file
+        engine: "agents" to step every Bike agent through the scheduler, or
+            "vector" to step all the bikes at once with a VectorEngine. Maps
+            routed with a block index run with the agents engine, since the
+            vector engine needs the routing tables of every destination
+        verbose: Whether to print the statistics of every step, read them
+            with stats() otherwise
+        congestion_detours: Whether impatient Bike agents take the road
+            with the cheapest route around the stopped bikes instead of the
+            one with the shortest route, see parkAgents.replanning. The
+            vector engine always takes the shortest route
+    Attributes:
+        engine_name: Engine the model runs with, "agents" or "vector"
+        engine_message: Why the model runs with another engine than the one
+            asked for, or None
+        bikes_spawned: Number of bikes spawned so far
+        bikes_in_model: Number of bikes in the model
+        bikes_arrived: Number of bikes that reached their destination
+        bikes_moving: Number of bikes that moved the last time they tried
+        seed: Seed of the model's random number generator, must be passed
+            as a keyword so that Mesa picks it up
+        profile: Whether to time the phases of every step and of every bike
+            in a Profiler, see parkAgents.profiling
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        map_file="2024_base.txt",
+        compiled=None,
+        engine="agents",
+        verbose=False,
+        seed=None,
+        profile=False,
+        congestion_detours=False,
+    ):
         super().__init__(self)
-        # Load the map dictionary. The dictionary maps the characters in the map file to the corresponding agent.
-        dataDictionary = json.load(open("park_files/mapDictionary.json"))
+        self.verbose = verbose
+
+        # Profiled models use agents that time themselves.
+        self.profiler = Profiler() if profile else None
+        self.bike_class = ProfiledBike if profile else Bike
+
+        # Load the compiled map, with the tiles, road graph and routing
+        # tables of the map file. Maps are only parsed and routed the first
+        # time, after that they are read from the cache.
+        if compiled is None:
+            compiled = compile_map(map_file)
+        self.compiled = compiled
 
         self.traffic_lights = []
-        self.graph = []
+        self.tiles = compiled.tiles
+        self.graph = compiled.graph
+        self.routes = compiled.routes
+        self.destination_approaches = compiled.approaches
+        self.distances = compiled.distances
+        self.next_hops = compiled.next_hops
+
+        self.engine_message = None
+        if engine == "vector" and self.distances is None:
+            self.engine_message = (
+                "The vector engine needs the routing tables of every "
+                "destination, and the map is routed with a block index, so "
+                "it runs with the agents engine"
+            )
+            if verbose:
+                print(self.engine_message)
+            engine = "agents"
+        self.engine_name = engine
 
+        # Bike agents by id, and the bikes that changed in the last steps.
+        self.bike_agents = {}
+        self.changes = ChangeLog()
+
+        # Counters kept up to date by the bikes as they spawn, move, wait
+        # and leave, so the statistics never have to count the bikes.
         self.bikes_spawned = 0
         self.bikes_in_model = 0
         self.bikes_arrived = 0
-        self.bikes_stopped = 0
         self.bikes_moving = 0
 
-        self.ratio_arrived = 0
-        self.ratio_alive = 0
-        self.ratio_moving = 0
-        self.ratio_stopped = 0
-
-        # Load the map file. The map file is a text file where each character represents an agent.
-        with open("park_files/2024_base.txt") as baseFile:
-            lines = baseFile.readlines()
-            self.width = len(lines[0]) - 1
-            self.height = len(lines)
-
-            self.grid = MultiGrid(self.width, self.height, torus=False)
-            self.schedule = RandomActivation(self)
-
-            # Goes through each character in the map file and creates the corresponding agent.
-            for r, row in enumerate(lines):
-                for c, col in enumerate(row):
-                    if col in ["v", "^", ">", "<"]:
-                        agent = Road(
-                            f"r_{r*self.width+c}", self, dataDictionary[col]
-                        )
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-
-                    elif col in ["S", "s"]:
-                        spawned_road = False
-                        # Spawn road tile under traffic_light.
-                        if col == "S":
-                            for road in [lines[r - 1][c], lines[r + 1][c]]:
-                                if road in ["v", "^"]:
-                                    agent = Road(
-                                        f"r_{r*self.width+c}",
-                                        self,
-                                        dataDictionary[road],
-                                    )
-                                    spawned_road = True
-                                    break
-
-                            if not spawned_road:
-                                agent = Road(
-                                    f"r_{r*self.width+c}",
-                                    self,
-                                    dataDictionary["v"],
-                                )
-
-                        elif col == "s":
-                            for road in [lines[r][c - 1], lines[r][c + 1]]:
-                                if road in [">", "<"]:
-                                    agent = Road(
-                                        f"r_{r*self.width+c}",
-                                        self,
-                                        dataDictionary[road],
-                                    )
-                                    spawned_road = True
-                                    break
-
-                            if not spawned_road:
-                                agent = Road(
-                                    f"r_{r*self.width+c}",
-                                    self,
-                                    dataDictionary["v"],
-                                )
-
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-
-                        agent = Traffic_Light(
-                            f"tl_{r*self.width+c}",
-                            self,
-                            direction=agent.direction,
-                            state=False if col == "S" else True,
-                            timeToChange=int(dataDictionary[col]),
-                        )
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-                        self.schedule.add(agent)
-                        self.traffic_lights.append(agent)
-
-                    elif col == "#":
-                        agent = Obstacle(f"ob_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-
-                    elif col == "D":
-                        # Spawn obstacle tile under destination.
-                        agent = Obstacle(f"ob_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
-
-                        agent = Destination(f"d_{r*self.width+c}", self)
-                        self.grid.place_agent(agent, (c, self.height - r - 1))
+        # Routes looked up by the bikes, and routes recalculated by
+        # impatient bikes, reported to the metrics after every step.
+        self.route_computations = 0
+        self.replans = 0
+
+        self.width = self.tiles.width
+        self.height = self.tiles.height
+        # Destinations that can be reached from each corner, looked up the
+        # first time a bike spawns at it.
+        self.corner_destinations = {}
+
+        self.grid = MultiGrid(self.width, self.height, torus=False)
+        # Occupancy layer with the id of the bike in each cell, or -1.
+        self.occupancy = np.full((self.width, self.height), -1, dtype=np.int64)
+        # Layer with 1 where a bike is stopped, and the congestion aware
+        # costs that impatient bikes replan with, kept up to date with it.
+        # Both are only kept when the bikes take congestion aware detours.
+        self.stopped = np.zeros((self.width, self.height), dtype=np.uint8)
+        self.detours = (
+            CongestionRoutes(self)
+            if congestion_detours and engine == "agents"
+            else None
+        )
+        # Bikes that can not move sleep in the scheduler until a cell they
+        # watch is freed, see parkAgents.scheduler.
+        self.schedule = BikeScheduler(self)
+
+        # The state of the traffic lights is computed from the step, so they
+        # are not in the scheduler. The agents are kept in the order of
+        # tiles.lights for the code that reads them.
+        self.lights = LightPhases(self.tiles.lights)
+        for index, (pos, state, timeToChange) in enumerate(self.tiles.lights):
+            agent = Traffic_Light(
+                self.tiles.tile_id("tl", pos),
+                self,
+                direction=self.tiles.direction_at(pos),
+                state=state,
+                timeToChange=timeToChange,
+                index=index,
+            )
+            agent.pos = pos
+            self.traffic_lights.append(agent)
 
         self.running = True
 
-        self.generate_graph()
+        # Bikes are stored as arrays instead of agents in the vector engine.
+        self.engine = VectorEngine(self) if engine == "vector" else None
 
     def step(self):
         """Advance the model by one step."""
+        start = time.perf_counter()
+        route_computations = self.route_computations
+        replans = self.replans
+        stepping = True
+
         # Spawn new bikes every 10 episodes
         if self.schedule.steps % 1 == 0:
-            try:
-                before_spawn = len(self.agents_by_type[Bike])
-            except KeyError:
-                before_spawn = 0
+            before_spawn = self.count_bikes()
 
             self.spawn_bikes()
-            if len(self.agents_by_type[Bike]) == before_spawn:
+            if self.count_bikes() == before_spawn:
                 self.running = False
-                return
+                stepping = False
 
-        if len(self.agents_by_type[Bike]) == len(self.agents_by_type[Road]):
+        if stepping and self.count_bikes() == len(self.graph):
             self.running = False
-            return
-
-        self.calculate_data()
-
-    def calculate_data(self):
-        self.bikes_in_model = len(self.get_agents_of_type(Bike))
-        self.ratio_alive = self.bikes_in_model / self.bikes_spawned
-        self.ratio_arrived = self.bikes_arrived / self.bikes_spawned
-
-        self.bikes_moving = len(
-            [bike for bike in self.get_agents_of_type(Bike) if bike.moving]
-        )
-        self.bikes_stopped = self.bikes_in_model - self.bikes_moving
-
-        self.ratio_moving = self.bikes_moving / self.bikes_in_model
-        self.ratio_stopped = self.bikes_stopped / self.bikes_in_model
-
-        self.schedule.step()
-
-        print(
-            f"\033[38;5;197mSTEPS:\033[0m {self.schedule.steps}\n"
-            f"\033[38;5;27mBIKES SPAWNED:\033[0m {self.bikes_spawned}\n"
-            f"\033[38;5;33mIN MAP:\033[0m {self.bikes_in_model}\n"
-            f"\033[38;5;40mARRIVED:\033[0m {self.bikes_arrived} ({round(self.ratio_arrived, 2)})\n"
-            f"\033[38;5;214mMOVING:\033[0m {self.bikes_moving}\n"
-            f"\033[38;5;202mSTOPPED:\033[0m {self.bikes_stopped}"
-        )
+            stepping = False
+
+        spawned = time.perf_counter()
+        STEP_SECONDS.observe(spawned - start, phase="spawn")
+
+        if stepping:
+            if self.engine is not None:
+                self.engine.step()
+            scheduled = time.perf_counter()
+            self.schedule.step()
+            stepped = time.perf_counter()
+            # Same phases as in the profiler, the engine out of the scheduler.
+            if self.engine is not None:
+                STEP_SECONDS.observe(scheduled - spawned, phase="engine")
+            STEP_SECONDS.observe(stepped - scheduled, phase="scheduler")
+
+            if self.verbose:
+                print(
+                    f"Step {self.schedule.steps}: {self.bikes_spawned} spawned, "
+                    f"{self.bikes_in_model} in map, {self.bikes_arrived} arrived "
+                    f"({round(self.ratio_arrived, 2)}), {self.bikes_moving} moving, "
+                    f"{self.bikes_stopped} stopped"
+                )
+            STEP_SECONDS.observe(time.perf_counter() - stepped, phase="stats")
+
+            ROUTE_COMPUTATIONS.observe(self.route_computations - route_computations)
+            if self.replans > replans:
+                REPLANS.inc(self.replans - replans)
+
+        end = time.perf_counter()
+        STEP_SECONDS.observe(end - start, phase="total")
+
+        if self.profiler is not None:
+            self.profiler.add(SPAWN, spawned - start)
+            if stepping:
+                if self.engine is not None:
+                    self.profiler.add(ENGINE, scheduled - spawned)
+                self.profiler.add(SCHEDULER, stepped - scheduled)
+            self.profiler.add_step(self.schedule.steps, end - start)
+
+    @property
+    def bikes_stopped(self):
+        """Number of bikes that could not move the last time they tried."""
+        return self.bikes_in_model - self.bikes_moving
+
+    @property
+    def ratio_alive(self):
+        """Ratio of the spawned bikes that are still in the model."""
+        return self.bikes_in_model / self.bikes_spawned if self.bikes_spawned else 0
+
+    @property
+    def ratio_arrived(self):
+        """Ratio of the spawned bikes that reached their destination."""
+        return self.bikes_arrived / self.bikes_spawned if self.bikes_spawned else 0
+
+    @property
+    def ratio_moving(self):
+        """Ratio of the bikes in the model that are moving."""
+        return self.bikes_moving / self.bikes_in_model if self.bikes_in_model else 0
+
+    @property
+    def ratio_stopped(self):
+        """Ratio of the bikes in the model that are stopped."""
+        return self.bikes_stopped / self.bikes_in_model if self.bikes_in_model else 0
+
+    def stats(self):
+        """
+        Returns a dictionary with the step of the model and its statistics.
+        """
+        return {
+            "step": self.schedule.steps,
+            "bikes_spawned": self.bikes_spawned,
+            "bikes_in_model": self.bikes_in_model,
+            "bikes_arrived": self.bikes_arrived,
+            "bikes_moving": self.bikes_moving,
+            "bikes_stopped": self.bikes_stopped,
+            "ratio_alive": self.ratio_alive,
+            "ratio_arrived": self.ratio_arrived,
+            "ratio_moving": self.ratio_moving,
+            "ratio_stopped": self.ratio_stopped,
+        }
 
     def spawn_bikes(self):
         """Spawn new bikes at the empty corners of the grid."""
@@ -169,91 +264,258 @@ class ParkModel(Model):
         ]
 
         for corner in corners:
-            clear = True
-            for agent in self.grid.iter_cell_list_contents([corner]):
-                if isinstance(agent, Bike):
-                    clear = False
-                    break
-
-            if not clear:
+            if not self.is_free(corner):
                 continue
 
-            destination_pos = [
-                destination.pos
-                for destination in self.get_agents_of_type(Destination)
-            ]
+            # Only choose destinations that can be reached from the corner.
+            destination_pos = self.corner_destinations.get(corner)
+            if destination_pos is None:
+                destination_pos = self.corner_destinations[corner] = [
+                    destination
+                    for destination in self.tiles.destinations
+                    if self.routes[destination].distance_from(corner) >= 0
+                ]
 
-            new_bike = Bike(
-                self.next_id(), self, self.random.choice(destination_pos)
-            )
-            self.grid.place_agent(new_bike, corner)
-            self.schedule.add(new_bike)
+            if not destination_pos:
+                continue
+
+            bike_id = self.next_id()
+            destination = self.random.choice(destination_pos)
+            if self.engine is not None:
+                self.engine.add_bike(bike_id, corner, destination)
+            else:
+                new_bike = self.bike_class(bike_id, self, destination)
+                self.place_bike(new_bike, corner)
+                self.schedule.add(new_bike)
             self.bikes_spawned += 1
 
-    def get_possible_roads(self, road):
-        neighbor_roads = [
-            neighbor
-            for neighbor in self.grid.get_neighbors(
-                road.pos, moore=True, include_center=False
-            )
-            if isinstance(neighbor, Road)
-        ]
+    def count_bikes(self):
+        """Returns the number of bikes in the model."""
+        return self.bikes_in_model
+
+    def bikes(self, ids=None):
+        """
+        Returns a list with the (id, pos, direction) of every bike, or of
+        the bikes with the given ids, for either engine.
+        """
+        if self.engine is not None:
+            return self.engine.bikes(ids)
+        if ids is None:
+            bikes = self.bike_agents.values()
+        else:
+            bikes = [self.bike_agents[unique_id] for unique_id in ids]
+        return [(bike.unique_id, bike.pos, bike.direction) for bike in bikes]
+
+    def bike_arrays(self):
+        """
+        Returns an int64 array with the id of every bike, a (bikes, 2) array
+        with their grid coords and a uint8 array with their direction codes,
+        for either engine.
+        """
+        if self.engine is not None:
+            return self.engine.bike_arrays()
+        bikes = list(self.bike_agents.values())
+        ids = np.fromiter(
+            (bike.unique_id for bike in bikes), dtype=np.int64, count=len(bikes)
+        )
+        coords = np.array([bike.pos for bike in bikes], dtype=np.int32).reshape(-1, 2)
+        directions = np.fromiter(
+            (DIRECTION_CODES[bike.direction] for bike in bikes),
+            dtype=np.uint8,
+            count=len(bikes),
+        )
+        return ids, coords, directions
+
+    def bikes_since(self, step):
+        """
+        Returns the (id, pos, direction) of the bikes that spawned, moved or
+        turned after a step, and the ids of the bikes that left the model
+        after it. Returns None when the changes of that step are no longer
+        kept, and the client needs every bike instead.
+        """
+        if step > self.schedule.steps:
+            return None
+        delta = self.changes.since(step)
+        if delta is None:
+            return None
+        changed, removed = delta
+        return self.bikes(changed), sorted(removed)
+
+    def change_step(self):
+        """
+        Returns the step the changes made now belong to, the one the model
+        is advancing to.
+        """
+        return self.schedule.steps + 1
+
+    def count_moving(self):
+        """Returns the number of bikes that moved in the last step."""
+        return self.bikes_moving
+
+    def place_bike(self, bike, pos):
+        """Place a bike in the grid and in the occupancy layer."""
+        self.grid.place_agent(bike, pos)
+        self.occupancy[pos] = bike.unique_id
+        self.bike_agents[bike.unique_id] = bike
+        # New bikes have not moved yet.
+        self.mark_stopped(pos, not bike.moving)
+        self.bikes_in_model += 1
+        self.changes.changed(self.change_step(), [bike.unique_id])
+
+    def move_bike(self, bike, pos):
+        """Move a bike in the grid and in the occupancy layer."""
+        freed = bike.pos
+        self.occupancy[freed] = -1
+        self.grid.move_agent(bike, pos)
+        self.occupancy[pos] = bike.unique_id
+        self.schedule.cell_freed(freed)
+        self.changes.changed(self.change_step(), [bike.unique_id])
+
+    def remove_bike(self, bike):
+        """Remove a bike from the grid and from the occupancy layer."""
+        freed = bike.pos
+        self.occupancy[freed] = -1
+        self.grid.remove_agent(bike)
+        del self.bike_agents[bike.unique_id]
+        self.bikes_in_model -= 1
+        if bike.moving:
+            self.bikes_moving -= 1
+        else:
+            self.mark_stopped(freed, False)
+        self.changes.removed(self.change_step(), [bike.unique_id])
+        self.schedule.cell_freed(freed)
+
+    def mark_stopped(self, pos, stopped):
+        """
+        Marks whether the bike at the given grid coords is stopped, called
+        by the bikes when they stop or start moving.
+        """
+        if self.detours is None:
+            return
+        self.stopped[pos] = stopped
+        self.detours.changed([self.graph.node_id(pos)])
 
-        possible_roads = []
-
-        for neighbor_road in neighbor_roads:
-            if (
-                road.direction == "Up"
-                and neighbor_road.pos[1] == road.pos[1] + 1
-                and not (
-                    neighbor_road.direction == "Left"
-                    and neighbor_road.pos[0] > road.pos[0]
-                    or neighbor_road.direction == "Right"
-                    and neighbor_road.pos[0] < road.pos[0]
-                )
-            ):
-                possible_roads.append(neighbor_road)
-            elif (
-                road.direction == "Down"
-                and neighbor_road.pos[1] == road.pos[1] - 1
-                and not (
-                    neighbor_road.direction == "Left"
-                    and neighbor_road.pos[0] > road.pos[0]
-                    or neighbor_road.direction == "Right"
-                    and neighbor_road.pos[0] < road.pos[0]
-                )
-            ):
-                possible_roads.append(neighbor_road)
-            elif (
-                road.direction == "Left"
-                and neighbor_road.pos[0] == road.pos[0] - 1
-                and not (
-                    neighbor_road.direction == "Up"
-                    and neighbor_road.pos[1] < road.pos[1]
-                    or neighbor_road.direction == "Down"
-                    and neighbor_road.pos[1] > road.pos[1]
-                )
-            ):
-                possible_roads.append(neighbor_road)
-            elif (
-                road.direction == "Right"
-                and neighbor_road.pos[0] == road.pos[0] + 1
-                and not (
-                    neighbor_road.direction == "Up"
-                    and neighbor_road.pos[1] < road.pos[1]
-                    or neighbor_road.direction == "Down"
-                    and neighbor_road.pos[1] > road.pos[1]
-                )
-            ):
-                possible_roads.append(neighbor_road)
-        return possible_roads
+    def is_free(self, pos):
+        """Returns whether there is no bike at the given grid coords."""
+        return self.occupancy[pos] < 0
+
+    def occupied_mask(self):
+        """Returns a boolean array with the cells that have a bike."""
+        return self.occupancy >= 0
+
+    def congestion(self):
+        """Returns the ratio of roads that have a bike on them."""
+        return np.count_nonzero(self.occupancy >= 0) / len(self.graph)
+
+    def get_possible_roads(self, road):
+        """
+        Returns the grid coords of the roads a bike can move to from the road
+        at the given grid coords.
+        """
+        return possible_roads(self.tiles, road)
 
     def generate_graph(self):
-        for road in self.get_agents_of_type(Road):
-            possible_roads = self.get_possible_roads(road)
-            self.graph.append((road.pos, possible_roads))
+        """Build the road graph index from the roads in the tile layer."""
+        self.graph = RoadGraph.from_tiles(self.tiles)
 
     def graph_get(self, road):
-        for node in self.graph:
-            if road == node[0]:
-                return node[1]
+        """
+        Returns the grid coords of the roads reachable in one step from the
+        road at the given grid coords, or an empty tuple if it is not a road.
+        """
+        return self.graph.neighbors(road)
+
+    def graph_node(self, road):
+        """
+        Returns the node id in self.graph of the road at the given grid
+        coords, or None if it is not a road.
+        """
+        return self.graph.node_id(road)
+
+    def generate_routes(self):
+        """
+        Build the set of approach roads and one routing table per
+        destination, with the distance and next road to follow from every
+        road in the graph.
+        """
+        (
+            self.destination_approaches,
+            self.routes,
+            self.distances,
+            self.next_hops,
+        ) = route_tables(self.tiles, self.graph)
+
+    def next_hop(self, road, destination):
+        """
+        Returns the grid coords of the next road on the shortest route from
+        a road to a destination, or None if there is no next road.
+        """
+        return self.routes[destination].next_hop_from(road)
+
+    def route_distance(self, road, destination):
+        """
+        Returns the number of steps from a road to a destination, or -1 if
+        the destination can not be reached.
+        """
+        return self.routes[destination].distance_from(road)
+
+    def detour(self, destination, roads):
+        """
+        Returns the road, out of the given grid coords, with the lowest cost
+        to a destination when roads with a stopped bike cost STOPPED_COST,
+        or None if none of them can reach it.
+        Without congestion aware detours, and in maps routed with a block
+        index, which have no routing table to start the search from, it is
+        the road with the shortest route.
+        """
+        if self.detours is None or self.distances is None:
+            reachable = [
+                road for road in roads if self.route_distance(road, destination) >= 0
+            ]
+            return min(
+                reachable,
+                key=lambda road: self.route_distance(road, destination),
+                default=None,
+            )
+        nodes = [self.graph.node_id(road) for road in roads]
+        best = self.detours.best(destination, nodes)
+        return None if best is None else self.graph.positions[best]
+
+    def light_states(self):
+        """
+        Returns a boolean array with the state of every traffic light, in
+        the order of tiles.lights, True where bikes must wait.
+        """
+        return self.lights.states(self.schedule.steps)
+
+    def red_light_at(self, pos):
+        """
+        Returns whether there is a traffic light where bikes must wait at the
+        given grid coords.
+        """
+        index = self.tiles.light_index[pos]
+        return index >= 0 and self.lights.state(index, self.schedule.steps)
+
+    def light_change_at(self, pos):
+        """
+        Returns the first step after the current one at which the traffic
+        light at the given grid coords changes color.
+        """
+        index = self.tiles.light_index[pos]
+        return self.lights.next_change(index, self.schedule.steps)
+
+    def traffic_light_at(self, pos):
+        """
+        Returns the traffic light at the given grid coords, or None.
+        """
+        index = self.tiles.light_index[pos]
+        if index < 0:
+            return None
+        return self.traffic_lights[index]
+
+    def map_tiles(self):
+        """
+        Returns the static tiles of the map grouped by type, see
+        TileLayer.map_tiles.
+        """
+        return self.tiles.map_tiles()
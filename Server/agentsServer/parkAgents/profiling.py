@@ -0,0 +1,157 @@
+from .agent import Bike
+import json
+import time
+
+# Stacks of the profiled phases. Each phase is timed with its children,
+# and the collapsed stacks keep the time of each phase without them.
+STEP = "ParkModel.step"
+SPAWN = STEP + ";spawn_bikes"
+ENGINE = STEP + ";VectorEngine.step"
+SCHEDULER = STEP + ";BikeScheduler.step"
+BIKE_STEP = SCHEDULER + ";Bike.step"
+GET_ROUTE = BIKE_STEP + ";Bike.get_route"
+MOVE = BIKE_STEP + ";Bike.move"
+NEIGHBORS = MOVE + ";neighbor_scan"
+
+# Number of slowest steps and bikes in the summary.
+SUMMARY_TOP = 10
+
+
+class Profiler:
+    """
+    Timers and call counters of the hot paths of a model, aggregated per
+    phase, per step and per bike. A model only has a profiler when it is
+    created with profile=True, otherwise the hot paths skip the timers.
+    Attributes:
+        phases: Dictionary with [calls, seconds] of every stack
+        steps: List with the (step, seconds) of every profiled step
+        bikes: Dictionary with [steps, seconds] of every bike
+    """
+
+    clock = staticmethod(time.perf_counter)
+
+    def __init__(self):
+        self.phases = {}
+        self.steps = []
+        self.bikes = {}
+
+    def add(self, stack, seconds):
+        """
+        Adds a call of a phase that took seconds, with its children.
+        """
+        phase = self.phases.get(stack)
+        if phase is None:
+            phase = self.phases[stack] = [0, 0.0]
+        phase[0] += 1
+        phase[1] += seconds
+
+    def add_bike(self, unique_id, seconds):
+        """
+        Adds a step of a bike that took seconds.
+        """
+        bike = self.bikes.get(unique_id)
+        if bike is None:
+            bike = self.bikes[unique_id] = [0, 0.0]
+        bike[0] += 1
+        bike[1] += seconds
+
+    def add_step(self, step, seconds):
+        """
+        Adds a step of the model that took seconds, and the call of STEP.
+        """
+        self.steps.append((step, seconds))
+        self.add(STEP, seconds)
+
+    def collapsed(self):
+        """
+        Returns the phases as collapsed stacks, one "stack microseconds"
+        line per phase with the time it took without its children, as read
+        by flamegraph.pl and speedscope.
+        """
+        own = {stack: seconds for stack, (calls, seconds) in self.phases.items()}
+        for stack, (calls, seconds) in self.phases.items():
+            parent = stack.rpartition(";")[0]
+            if parent in own:
+                own[parent] -= seconds
+        return "".join(
+            f"{stack} {max(0, round(seconds * 1e6))}\n"
+            for stack, seconds in sorted(own.items())
+        )
+
+    def summary(self):
+        """
+        Returns a dictionary with the calls, total and mean seconds of every
+        phase, the slowest steps and the bikes that took the longest.
+        """
+        steps = len(self.steps)
+        slowest_steps = sorted(self.steps, key=lambda entry: entry[1], reverse=True)
+        slowest_bikes = sorted(
+            self.bikes.items(), key=lambda entry: entry[1][1], reverse=True
+        )
+        return {
+            "steps": steps,
+            "seconds": self.phases.get(STEP, [0, 0.0])[1],
+            "phases": {
+                stack: {
+                    "calls": calls,
+                    "seconds": seconds,
+                    "mean_seconds": seconds / calls,
+                    "seconds_per_step": seconds / steps if steps else 0,
+                }
+                for stack, (calls, seconds) in sorted(self.phases.items())
+            },
+            "slowest_steps": [
+                {"step": step, "seconds": seconds}
+                for step, seconds in slowest_steps[:SUMMARY_TOP]
+            ],
+            "slowest_bikes": [
+                {"id": unique_id, "steps": calls, "seconds": seconds}
+                for unique_id, (calls, seconds) in slowest_bikes[:SUMMARY_TOP]
+            ],
+        }
+
+    def write(self, prefix):
+        """
+        Writes the collapsed stacks to prefix.collapsed and the summary to
+        prefix.profile.json.
+        """
+        with open(prefix + ".collapsed", "w") as collapsedFile:
+            collapsedFile.write(self.collapsed())
+        with open(prefix + ".profile.json", "w") as summaryFile:
+            json.dump(self.summary(), summaryFile, indent=2)
+
+
+class ProfiledBike(Bike):
+    """
+    Bike that times its step, route lookups, moves and neighbor scans in
+    its model's profiler. Used instead of Bike when profiling, so that
+    models without a profiler do not pay for the timers.
+    """
+
+    def step(self):
+        profiler = self.model.profiler
+        start = profiler.clock()
+        super().step()
+        seconds = profiler.clock() - start
+        profiler.add(BIKE_STEP, seconds)
+        profiler.add_bike(self.unique_id, seconds)
+
+    def get_route(self):
+        profiler = self.model.profiler
+        start = profiler.clock()
+        super().get_route()
+        profiler.add(GET_ROUTE, profiler.clock() - start)
+
+    def move(self):
+        profiler = self.model.profiler
+        start = profiler.clock()
+        super().move()
+        profiler.add(MOVE, profiler.clock() - start)
+
+    def free_neighbors(self):
+        profiler = self.model.profiler
+        start = profiler.clock()
+        empty_neighbors = super().free_neighbors()
+        profiler.add(NEIGHBORS, profiler.clock() - start)
+        return empty_neighbors
+
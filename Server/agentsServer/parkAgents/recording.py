@@ -0,0 +1,396 @@
+from .compiled import load_dictionary, map_path
+from .frames import FRAME_HEADER, FRAME_RECORD
+from .tiles import DIRECTIONS, TileLayer
+import json
+import struct
+import threading
+import types
+import zlib
+import numpy as np
+
+# Trace files start with TRACE_MAGIC, followed by the compressed chunks and
+# the JSON index, and end with TRACE_FOOTER: the offset and length of the
+# index and TRACE_MAGIC again.
+TRACE_MAGIC = b"PKTRACE1"
+TRACE_FOOTER = struct.Struct("<QI8s")
+FORMAT_VERSION = 1
+
+# Number of steps in each chunk. The first step of a chunk is a keyframe
+# with every bike, so a step can be read by decoding only its chunk.
+CHUNK_STEPS = 64
+
+# Number of decoded chunks kept in memory by a TraceReader.
+CACHED_CHUNKS = 8
+
+COUNT = struct.Struct("<I")
+
+
+def sorted_records(ids, coords, directions):
+    """
+    Returns the bikes as a FRAME_RECORD array sorted by id.
+    """
+    order = np.argsort(ids, kind="stable")
+    records = np.empty(len(ids), dtype=FRAME_RECORD)
+    records["id"] = ids[order]
+    records["x"] = coords[order, 0]
+    records["z"] = coords[order, 1]
+    records["direction"] = directions[order]
+    return records
+
+
+def diff_records(previous, records):
+    """
+    Returns the records of the bikes that spawned, moved or turned between
+    two FRAME_RECORD arrays sorted by id, and the ids of the bikes that left.
+    """
+    if len(previous) == 0:
+        return records, np.empty(0, dtype="<i4")
+
+    position = np.minimum(
+        np.searchsorted(previous["id"], records["id"]), len(previous) - 1
+    )
+    unchanged = previous[position] == records
+    removed = previous["id"][~np.isin(previous["id"], records["id"])]
+    return records[~unchanged], removed.astype("<i4")
+
+
+def apply_diff(previous, changed, removed):
+    """
+    Returns the FRAME_RECORD array, sorted by id, that results from a diff
+    made by diff_records.
+    """
+    stale = np.isin(previous["id"], removed) | np.isin(previous["id"], changed["id"])
+    records = np.concatenate([previous[~stale], changed])
+    return records[np.argsort(records["id"], kind="stable")]
+
+
+class TraceRecorder:
+    """
+    Records the bikes and traffic lights of a model after every step into
+    a trace file, in chunks of CHUNK_STEPS steps compressed with zlib. Each
+    chunk starts with every bike, and the other steps of the chunk only
+    keep the bikes that changed.
+    The model is not stepped by the recorder: call capture after every step
+    and close when done, or use the recorder as a context manager.
+    Attributes:
+        model: Recorded ParkModel
+        chunk_steps: Number of steps in each chunk
+    """
+
+    def __init__(self, path, model, map_file, chunk_steps=CHUNK_STEPS):
+        """
+        Creates a trace file and records the current step of a model.
+        Args:
+            path: Path of the trace file
+            model: ParkModel to record
+            map_file: Map of the model, stored in the trace so that it can be
+                replayed without the map file
+            chunk_steps: Number of steps in each chunk
+        """
+        self.model = model
+        self.chunk_steps = chunk_steps
+
+        with open(map_path(map_file), newline="") as mapFile:
+            lines = mapFile.read().replace("\r\n", "\n").splitlines(keepends=True)
+        self.metadata = {
+            "format": FORMAT_VERSION,
+            "map": map_file,
+            "lines": lines,
+            "dictionary": load_dictionary(),
+            "width": model.width,
+            "height": model.height,
+            "lights": len(model.traffic_lights),
+            "chunk_steps": chunk_steps,
+        }
+
+        self.file = open(path, "wb")
+        self.file.write(TRACE_MAGIC)
+        # Offset and length of every chunk, and the model step of every
+        # recorded step.
+        self._chunks = []
+        self._steps = []
+        self._entries = []
+        self._previous = None
+        self.capture()
+
+    def capture(self):
+        """
+        Records the bikes and traffic lights of the model's current step.
+        """
+        model = self.model
+        records = sorted_records(*model.bike_arrays())
+        if self._entries:
+            changed, removed = diff_records(self._previous, records)
+        else:
+            changed, removed = records, np.empty(0, dtype="<i4")
+        lights = np.packbits(model.light_states())
+
+        header = np.array([(model.schedule.steps, len(changed))], dtype=FRAME_HEADER)
+        self._entries.append(
+            header.tobytes()
+            + changed.tobytes()
+            + COUNT.pack(len(removed))
+            + removed.tobytes()
+            + lights.tobytes()
+        )
+        self._steps.append(model.schedule.steps)
+        self._previous = records
+
+        if len(self._entries) == self.chunk_steps:
+            self._flush()
+
+    def _flush(self):
+        if not self._entries:
+            return
+        chunk = zlib.compress(b"".join(self._entries))
+        self._chunks.append((self.file.tell(), len(chunk)))
+        self.file.write(chunk)
+        self._entries = []
+
+    def close(self):
+        """
+        Writes the last chunk and the index, and closes the trace file.
+        """
+        if self.file.closed:
+            return
+        self._flush()
+        index = json.dumps(
+            {**self.metadata, "steps": self._steps, "chunks": self._chunks}
+        ).encode()
+        offset = self.file.tell()
+        self.file.write(index)
+        self.file.write(TRACE_FOOTER.pack(offset, len(index), TRACE_MAGIC))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TraceReader:
+    """
+    Reads the steps of a trace file made by TraceRecorder. Reading a step
+    only decodes its chunk, and the last decoded chunks are kept in memory.
+    Attributes:
+        metadata: Map, size and other information stored with the trace
+        steps: Array with the model step of every recorded step
+    """
+
+    def __init__(self, path):
+        """
+        Opens a trace file and reads its index.
+        Raises ValueError if the file is not a trace file.
+        """
+        self.file = open(path, "rb")
+        self.lock = threading.Lock()
+
+        if self.file.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a trace file")
+        self.file.seek(-TRACE_FOOTER.size, 2)
+        offset, length, magic = TRACE_FOOTER.unpack(self.file.read(TRACE_FOOTER.size))
+        if magic != TRACE_MAGIC:
+            raise ValueError(f"{path} was not closed, it has no index")
+        self.file.seek(offset)
+        self.metadata = json.loads(self.file.read(length))
+        if self.metadata["format"] != FORMAT_VERSION:
+            raise ValueError(f"{path} has an unsupported format")
+
+        self.steps = np.array(self.metadata.pop("steps"), dtype=np.int64)
+        self.chunks = self.metadata.pop("chunks")
+        self.chunk_steps = self.metadata["chunk_steps"]
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self.steps)
+
+    def tiles(self):
+        """
+        Returns the TileLayer of the recorded map.
+        """
+        return TileLayer.from_lines(self.metadata["lines"], self.metadata["dictionary"])
+
+    def records(self, index):
+        """
+        Returns the FRAME_RECORD array of the bikes after a recorded step,
+        sorted by id.
+        Args:
+            index: Number of the recorded step, from 0 to len(self) - 1
+        """
+        return self._chunk(index // self.chunk_steps)[index % self.chunk_steps][0]
+
+    def lights(self, index):
+        """
+        Returns a boolean array with the state of every traffic light after
+        a recorded step, in the order of TileLayer.lights.
+        """
+        packed = self._chunk(index // self.chunk_steps)[index % self.chunk_steps][1]
+        return np.unpackbits(packed)[: self.metadata["lights"]].astype(bool)
+
+    def frame(self, index):
+        """
+        Returns the bikes after a recorded step as a binary frame, see
+        parkAgents.frames.
+        """
+        records = self.records(index)
+        header = np.array([(self.steps[index], len(records))], dtype=FRAME_HEADER)
+        return header.tobytes() + records.tobytes()
+
+    def index_of(self, step):
+        """
+        Returns the number of the last recorded step at a model step, or None
+        if that step was not recorded.
+        """
+        index = int(np.searchsorted(self.steps, step, side="right")) - 1
+        if index < 0 or self.steps[index] != step:
+            return None
+        return index
+
+    def _chunk(self, chunk):
+        # Decodes every step of a chunk, applying the changes of each step
+        # to the bikes of the step before it.
+        with self.lock:
+            decoded = self._decoded.get(chunk)
+            if decoded is not None:
+                return decoded
+
+            offset, length = self.chunks[chunk]
+            self.file.seek(offset)
+            data = zlib.decompress(self.file.read(length))
+
+        light_bytes = (self.metadata["lights"] + 7) // 8
+        decoded = []
+        records = np.empty(0, dtype=FRAME_RECORD)
+        position = 0
+        while position < len(data):
+            header = np.frombuffer(data, dtype=FRAME_HEADER, count=1, offset=position)
+            count = int(header[0]["count"])
+            position += FRAME_HEADER.itemsize
+            changed = np.frombuffer(data, dtype=FRAME_RECORD, count=count, offset=position)
+            position += count * FRAME_RECORD.itemsize
+            (removed_count,) = COUNT.unpack_from(data, position)
+            position += COUNT.size
+            removed = np.frombuffer(data, dtype="<i4", count=removed_count, offset=position)
+            position += removed_count * 4
+            lights = np.frombuffer(data, dtype=np.uint8, count=light_bytes, offset=position)
+            position += light_bytes
+
+            records = apply_diff(records, changed, removed) if decoded else changed
+            decoded.append((records, lights))
+
+        with self.lock:
+            if len(self._decoded) >= CACHED_CHUNKS:
+                del self._decoded[next(iter(self._decoded))]
+            self._decoded[chunk] = decoded
+        return decoded
+
+    def close(self):
+        self.file.close()
+
+
+class ReplayModel:
+    """
+    Stands in for a ParkModel, reading the bikes of every step from a trace
+    instead of simulating them. Provides the methods of ParkModel used by
+    the server, so a replay can be served like a live simulation.
+    Attributes:
+        reader: TraceReader of the trace
+        index: Number of the recorded step the replay is at
+        running: Whether there are recorded steps after the current one
+        engine_name: "replay", replays are read instead of run by an engine
+        engine_message: Always None, as in ParkModel
+    """
+
+    engine_name = "replay"
+    engine_message = None
+
+    def __init__(self, reader, tiles=None):
+        """
+        Creates a replay at the first recorded step of a trace.
+        Args:
+            reader: TraceReader of the trace
+            tiles: TileLayer of the recorded map, read from the trace if
+                omitted
+        """
+        self.reader = reader
+        self.tiles = tiles if tiles is not None else reader.tiles()
+        self.width = reader.metadata["width"]
+        self.height = reader.metadata["height"]
+        self.schedule = types.SimpleNamespace(steps=0)
+        # Replays are not simulated, so there is nothing to profile.
+        self.profiler = None
+        self.seek(0)
+
+    def seek(self, index):
+        """
+        Moves the replay to a recorded step.
+        """
+        self.index = max(0, min(index, len(self.reader) - 1))
+        self.schedule.steps = int(self.reader.steps[self.index])
+        self.running = self.index < len(self.reader) - 1
+
+    def step(self):
+        """Move to the next recorded step."""
+        self.seek(self.index + 1)
+
+    def bikes(self, ids=None, index=None):
+        """
+        Returns a list with the (id, pos, direction) of every bike, or of
+        the bikes with the given ids, as in ParkModel.bikes.
+        Args:
+            index: Recorded step to read instead of the current one
+        """
+        records = self.reader.records(self.index if index is None else index)
+        if ids is not None:
+            records = records[np.isin(records["id"], list(ids))]
+        return [
+            (unique_id, (x, z), DIRECTIONS[direction])
+            for unique_id, x, z, direction in records.tolist()
+        ]
+
+    def bike_arrays(self):
+        """
+        Returns the ids, grid coords and direction codes of the bikes, as in
+        ParkModel.bike_arrays.
+        """
+        records = self.reader.records(self.index)
+        coords = np.stack([records["x"], records["z"]], axis=1).astype(np.int32)
+        return records["id"].astype(np.int64), coords, records["direction"]
+
+    def bikes_since(self, step):
+        """
+        Returns the bikes that changed after a step and the ids of the bikes
+        that left, as in ParkModel.bikes_since.
+        """
+        if step > self.schedule.steps:
+            return None
+        since = self.reader.index_of(step)
+        if since is None:
+            return None
+        changed, removed = diff_records(
+            self.reader.records(since), self.reader.records(self.index)
+        )
+        return self.bikes(changed["id"]), sorted(removed.tolist())
+
+    def stats(self):
+        """
+        Returns the step and the number of bikes of the replay. The other
+        statistics of ParkModel.stats are not recorded.
+        """
+        return {
+            "step": self.schedule.steps,
+            "bikes_in_model": len(self.reader.records(self.index)),
+        }
+
+    def light_states(self):
+        """
+        Returns a boolean array with the state of every traffic light.
+        """
+        return self.reader.lights(self.index)
+
+    def map_tiles(self):
+        """
+        Returns the static tiles of the map, see TileLayer.map_tiles.
+        """
+        return self.tiles.map_tiles()
@@ -0,0 +1,295 @@
+from .metrics import REPLAN_NODES_EXPANDED
+import heapq
+import numpy as np
+
+# Cost of moving into a road where a bike is stopped, moving into any other
+# road costs 1. Bikes that are moving leave their road in the next step, so
+# they do not count as congestion.
+STOPPED_COST = 4
+
+INFINITY = float("inf")
+
+
+class CongestionRoute:
+    """
+    Costs from the roads to one destination around the stopped bikes of the
+    model, kept up to date with an incremental search (D* Lite) that goes
+    backwards from the goals. When bikes stop or start moving, only the
+    roads whose cost changes are searched again, and only as far as the
+    road that is asked for needs.
+    The search is directed to that road by a bound of the moves to get from
+    it to each road: the largest difference in x or y, or the difference of
+    their distances in the routing table, which can not be larger than the
+    moves between them. When another road is asked for, the bound between
+    both roads is added to km instead of making the keys in the queue again.
+    Attributes:
+        destination: Grid coords of the destination
+        g: Dictionary with the cost to the destination found so far of the
+            nodes that were searched again, the other nodes have the cost
+            in the routing table
+        rhs: Dictionary with the cost through their successors of the nodes
+            that were searched again
+    """
+
+    def __init__(self, routes, destination, goals):
+        """
+        Args:
+            routes: CongestionRoutes of the model
+            destination: Grid coords of the destination
+            goals: Node ids of the roads next to the destination
+        """
+        self.routes = routes
+        self.destination = destination
+        # The routing table may be memory-mapped, a plain view of it is
+        # faster to read one node at a time.
+        self.distance = np.asarray(routes.model.routes[destination].distance)
+        self.goals = frozenset(goals)
+
+        # The routing table has the costs when no bike is stopped, so the
+        # search starts from it and the stopped bikes are applied as changes
+        # the first time the route is used. Only the nodes searched again
+        # are kept in g and rhs.
+        self.g = {}
+        self.rhs = {}
+        self.stopped = bytearray(len(routes.graph))
+        # Position in the journal of the CongestionRoutes up to which the
+        # stopped bikes were applied.
+        self.position = -1
+
+        # Inconsistent nodes by key, for the road the search is directed to.
+        self.queue = []
+        self.start = None
+        self.km = 0
+
+    def cost_from(self, node):
+        """
+        Returns the cost from a node to the destination with the current
+        stopped bikes, INFINITY if it can not be reached.
+        """
+        if self.start is None:
+            self._direct(node)
+        elif node != self.start:
+            # Moving the start lowers the bound to each node by the bound
+            # between both starts at most, so with it added to km the keys
+            # in the queue are still no larger than the new ones.
+            self.km += self._heuristic(node)
+            self._direct(node)
+        self._sync()
+        self._search(node)
+        return self._cost(self.g, node)
+
+    def _cost(self, values, node):
+        # Cost of a node in g or rhs, the one in the routing table if the
+        # node was not searched again.
+        value = values.get(node)
+        if value is None:
+            distance = int(self.distance[node])
+            value = distance if distance >= 0 else INFINITY
+        return value
+
+    def _direct(self, node):
+        # Directs the search to another road.
+        self.start = node
+        self._x, self._y = self.routes.graph.coords[node].tolist()
+        self._distance = int(self.distance[node])
+
+    def _heuristic(self, node):
+        # Bikes move to one of the 8 cells around them, and every move
+        # changes the distance in the routing table by one at most, so the
+        # heuristic never overestimates the moves from the start to a node.
+        x, y = self.routes.graph.coords[node].tolist()
+        return max(
+            abs(x - self._x),
+            abs(y - self._y),
+            self._distance - int(self.distance[node]),
+        )
+
+    def _key(self, node):
+        best = min(self._cost(self.g, node), self._cost(self.rhs, node))
+        return (best + self._heuristic(node) + self.km, best)
+
+    def _sync(self):
+        # Applies the roads where bikes stopped or started moving since the
+        # last call.
+        routes = self.routes
+        stopped = np.frombuffer(self.stopped, dtype=np.uint8)
+        if self.position < routes.base:
+            # The journal was dropped, compare every road instead.
+            changed = np.flatnonzero(stopped != routes.stopped_nodes())
+        else:
+            nodes = np.unique(
+                np.array(routes.journal[self.position - routes.base:], dtype=np.int64)
+            )
+            changed = nodes[stopped[nodes] != routes.stopped_nodes(nodes)]
+        self.position = routes.base + len(routes.journal)
+
+        g, rhs, cost = self.g, self.rhs, self._cost
+        for node in changed.tolist():
+            self.stopped[node] ^= 1
+            node_g = cost(g, node)
+            if node_g == INFINITY:
+                continue
+            if self.stopped[node]:
+                # Only the roads that were routed through the road change.
+                previous = node_g + 1
+                for predecessor in routes.predecessors(node):
+                    if cost(rhs, predecessor) == previous:
+                        self._update(predecessor)
+            else:
+                # Only the roads that are now cheaper through the road change.
+                through = node_g + 1
+                for predecessor in routes.predecessors(node):
+                    if (
+                        through < cost(rhs, predecessor)
+                        and predecessor not in self.goals
+                    ):
+                        rhs[predecessor] = through
+                        if cost(g, predecessor) != through:
+                            heapq.heappush(
+                                self.queue, self._key(predecessor) + (predecessor,)
+                            )
+
+    def _update(self, node):
+        # Recomputes the cost of a node through its successors, and queues
+        # it when it no longer matches the cost found so far.
+        g, rhs, cost, stopped = self.g, self.rhs, self._cost, self.stopped
+        if node not in self.goals:
+            best = INFINITY
+            for successor in self.routes.successors(node):
+                through = cost(g, successor) + (
+                    STOPPED_COST if stopped[successor] else 1
+                )
+                if through < best:
+                    best = through
+            rhs[node] = best
+        if cost(g, node) != cost(rhs, node):
+            heapq.heappush(self.queue, self._key(node) + (node,))
+
+    def _search(self, target):
+        g, rhs, cost, stopped = self.g, self.rhs, self._cost, self.stopped
+        queue, routes = self.queue, self.routes
+        expanded = 0
+        while queue:
+            first, second, node = queue[0]
+            target_g = cost(g, target)
+            if target_g == cost(rhs, target) and (first, second) >= (
+                target_g + self.km,
+                target_g,
+            ):
+                break
+            heapq.heappop(queue)
+            node_g, node_rhs = cost(g, node), cost(rhs, node)
+            if node_g == node_rhs:
+                continue
+            # Entries queued for an earlier start or before the node changed
+            # again are queued with their current key.
+            key = self._key(node)
+            if (first, second) < key:
+                heapq.heappush(queue, key + (node,))
+                continue
+
+            expanded += 1
+            if node_g > node_rhs:
+                g[node] = node_rhs
+                through = node_rhs + (STOPPED_COST if stopped[node] else 1)
+                for predecessor in routes.predecessors(node):
+                    if through < cost(rhs, predecessor):
+                        rhs[predecessor] = through
+                        if cost(g, predecessor) != through:
+                            heapq.heappush(
+                                queue, self._key(predecessor) + (predecessor,)
+                            )
+            else:
+                g[node] = INFINITY
+                self._update(node)
+                for predecessor in routes.predecessors(node):
+                    self._update(predecessor)
+        if expanded:
+            REPLAN_NODES_EXPANDED.inc(expanded)
+
+
+class CongestionRoutes:
+    """
+    Costs to the destinations of a model around its stopped bikes, used by
+    impatient bikes to take a detour around the jams. The model writes the
+    roads where bikes stop or start moving to a journal, and the
+    CongestionRoute of each destination applies them the next time it is
+    used. Routes are only created for the destinations bikes replan to, and
+    read the CSR arrays of the graph instead of copying them.
+    Attributes:
+        graph: RoadGraph of the model
+        journal: List with the node ids of the roads where a bike stopped or
+            started moving
+        base: Number of journal entries that were dropped
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.graph = model.graph
+        self.journal = []
+        self.base = 0
+        self._routes = {}
+
+    def changed(self, nodes):
+        """
+        Adds the node ids of roads where a bike stopped or started moving to
+        the journal, if any route reads it. The journal is dropped when it
+        is longer than the graph, and the routes that had not read it
+        compare every road instead.
+        """
+        if not self._routes:
+            return
+        self.journal.extend(nodes)
+        if len(self.journal) > len(self.graph):
+            self.base += len(self.journal)
+            self.journal = []
+
+    def successors(self, node):
+        """Returns a list with the node ids of the successors of a node."""
+        return self.graph.neighbor_ids(node).tolist()
+
+    def predecessors(self, node):
+        """Returns a list with the node ids of the predecessors of a node."""
+        return self.graph.predecessor_ids(node).tolist()
+
+    def stopped_nodes(self, nodes=None):
+        """
+        Returns a uint8 array with 1 at the nodes where a bike is stopped,
+        for every node or for the given node ids.
+        """
+        coords = self.graph.coords if nodes is None else self.graph.coords[nodes]
+        return self.model.stopped[coords[:, 0], coords[:, 1]]
+
+    def route(self, destination):
+        """
+        Returns the CongestionRoute of a destination, created on first use.
+        """
+        route = self._routes.get(destination)
+        if route is None:
+            goals = [
+                self.graph.node_id(road)
+                for road in self.model.destination_approaches[destination]
+            ]
+            route = self._routes[destination] = CongestionRoute(
+                self, destination, goals
+            )
+        return route
+
+    def best(self, destination, nodes):
+        """
+        Returns the node, out of the given node ids, with the lowest cost to
+        the destination, or None if none of them can reach it.
+        """
+        route = self.route(destination)
+        if len(nodes) == 1:
+            # Stopped bikes make roads cost more but never cut them, so
+            # there is nothing to search for a single road.
+            return nodes[0] if route.distance[nodes[0]] >= 0 else None
+        best, best_cost = None, INFINITY
+        for node in nodes:
+            if route.distance[node] < 0:
+                continue
+            cost = route.cost_from(node)
+            if cost < best_cost:
+                best, best_cost = node, cost
+        return best
@@ -0,0 +1,103 @@
+from collections import deque
+from .metrics import NODES_EXPANDED
+import numpy as np
+
+
+class RouteTable:
+    """
+    Reverse shortest-path tree from every road to one destination.
+    Attributes:
+        destination: Grid coords of the destination
+        goals: Node ids of the roads where a bike reaches the destination
+        distance: Array with the number of steps from each node to the
+            closest goal, -1 if the destination can not be reached
+        next_hop: Array with the node id of the next road on the route,
+            -1 at the goals and at unreachable nodes
+    """
+
+    def __init__(self, graph, destination, goals):
+        """
+        Creates the routing table with a breadth first search that goes
+        backwards from the goals.
+        Args:
+            graph: RoadGraph of the model
+            destination: Grid coords of the destination
+            goals: Node ids of the roads next to the destination
+        """
+        self.graph = graph
+        self.destination = destination
+        self.goals = list(goals)
+
+        distance = [-1] * len(graph)
+        next_hop = [-1] * len(graph)
+
+        reverse_offsets = graph.reverse_offsets.tolist()
+        reverse_targets = graph.reverse_targets.tolist()
+
+        queue = deque()
+        for goal in self.goals:
+            if distance[goal] == -1:
+                distance[goal] = 0
+                queue.append(goal)
+
+        while queue:
+            node = queue.popleft()
+            for predecessor in reverse_targets[
+                reverse_offsets[node]:reverse_offsets[node + 1]
+            ]:
+                if distance[predecessor] == -1:
+                    distance[predecessor] = distance[node] + 1
+                    next_hop[predecessor] = node
+                    queue.append(predecessor)
+
+        self.distance = np.array(distance, dtype=np.int32)
+        self.next_hop = np.array(next_hop, dtype=np.int32)
+        NODES_EXPANDED.inc(int(np.count_nonzero(self.distance >= 0)))
+
+    @classmethod
+    def from_arrays(cls, graph, destination, goals, distance, next_hop):
+        """
+        Creates a routing table from arrays that were already computed, like
+        the ones stored in a compiled map.
+        """
+        table = cls.__new__(cls)
+        table.graph = graph
+        table.destination = destination
+        table.goals = list(goals)
+        table.distance = distance
+        table.next_hop = next_hop
+        return table
+
+    def distance_from(self, pos):
+        """
+        Returns the number of steps from a road to the destination, or -1 if
+        it can not be reached.
+        """
+        node = self.graph.node_id(pos)
+        if node is None:
+            return -1
+        return int(self.distance[node])
+
+    def next_hop_from(self, pos):
+        """
+        Returns the grid coords of the next road on the route, or None at the
+        goals and at roads that can not reach the destination.
+        """
+        node = self.graph.node_id(pos)
+        if node is None or self.next_hop[node] < 0:
+            return None
+        return self.graph.positions[self.next_hop[node]]
+
+    def route_from(self, pos):
+        """
+        Returns the list of grid coords to follow from a road to the
+        destination, not including pos itself.
+        """
+        route = []
+        node = self.graph.node_id(pos)
+        if node is None or self.distance[node] < 0:
+            return route
+        while self.next_hop[node] >= 0:
+            node = self.next_hop[node]
+            route.append(self.graph.positions[node])
+        return route
@@ -0,0 +1,129 @@
+from mesa.time import BaseScheduler
+
+
+class BikeScheduler(BaseScheduler):
+    """
+    Scheduler of the Bike agents that only activates the bikes that can do
+    something. Each step has two stages: first the bikes whose alarm rings
+    at the step are woken, then the awake bikes are activated in a random
+    order, as in RandomActivation.
+    A bike that can not move goes to sleep, watching the cells that would
+    let it move and with an alarm at the step it would do something else,
+    such as a traffic light changing or its impatience running out. The
+    model wakes it when one of the cells is freed. Bikes woken during a
+    step are activated in that step, after the others, unless they already
+    were.
+    Attributes:
+        awake: Dictionary with the awake bikes by id
+        asleep: Dictionary with the step each sleeping bike went to sleep
+            at, by id
+    """
+
+    def __init__(self, model):
+        super().__init__(model)
+        self.awake = {}
+        self.asleep = {}
+        # Sleeping bikes by id, with the cells they watch, their alarm and
+        # whether they lose patience while they sleep.
+        self._sleepers = {}
+        # Sleeping bikes by id watching each cell, and by alarm step.
+        self._watchers = {}
+        self._alarms = {}
+        # Bikes to activate in the current step, None between steps.
+        self._queue = None
+
+    def add(self, agent):
+        super().add(agent)
+        self.awake[agent.unique_id] = agent
+
+    def remove(self, agent):
+        super().remove(agent)
+        self.awake.pop(agent.unique_id, None)
+        if agent.unique_id in self.asleep:
+            self._forget(agent)
+
+    def step(self):
+        """
+        Wakes the bikes whose alarm rings, and activates every awake bike
+        once, in a random order.
+        """
+        for bike in list(self._alarms.get(self.steps, {}).values()):
+            self.wake(bike)
+
+        self._queue = list(self.awake.values())
+        self.model.random.shuffle(self._queue)
+        # The queue grows while it is activated, with the woken bikes.
+        position = 0
+        while position < len(self._queue):
+            self._queue[position].step()
+            position += 1
+        self._queue = None
+
+        self.steps += 1
+        self.time += 1
+
+    def sleep(self, bike, cells=(), alarm=None, waiting=True):
+        """
+        Stops activating a bike until one of the cells is freed or the alarm
+        step.
+        Args:
+            bike: Bike to put to sleep, during its step
+            cells: Grid coords of the cells to watch
+            alarm: Step to wake the bike at, or None to only wake it when a
+                cell is freed
+            waiting: Whether the bike waits while it sleeps, so that its
+                impatience goes up every step it sleeps
+        """
+        # A bike that would be woken at the next step anyway stays awake.
+        if alarm is not None and alarm <= self.steps + 1:
+            return
+        unique_id = bike.unique_id
+        del self.awake[unique_id]
+        self.asleep[unique_id] = self.steps
+        self._sleepers[unique_id] = (bike, cells, alarm, waiting)
+        for cell in cells:
+            self._watchers.setdefault(cell, {})[unique_id] = bike
+        if alarm is not None:
+            self._alarms.setdefault(alarm, {})[unique_id] = bike
+
+    def wake(self, bike):
+        """
+        Activates a sleeping bike again, from this step if it has not been
+        activated in it, with the impatience it would have if it had waited
+        every step it slept.
+        """
+        slept = self.steps - self.asleep[bike.unique_id]
+        waiting = self._sleepers[bike.unique_id][3]
+        self._forget(bike)
+        self.awake[bike.unique_id] = bike
+
+        if slept > 0:
+            if waiting:
+                bike.impatience += slept - 1
+            if self._queue is not None:
+                self._queue.append(bike)
+
+    def cell_freed(self, cell):
+        """
+        Wakes the bikes that watch a cell, called by the model when the bike
+        in the cell moves or leaves.
+        """
+        watchers = self._watchers.get(cell)
+        if watchers:
+            for bike in list(watchers.values()):
+                self.wake(bike)
+
+    def _forget(self, bike):
+        unique_id = bike.unique_id
+        del self.asleep[unique_id]
+        bike, cells, alarm, waiting = self._sleepers.pop(unique_id)
+        for cell in cells:
+            watchers = self._watchers[cell]
+            del watchers[unique_id]
+            if not watchers:
+                del self._watchers[cell]
+        if alarm is not None:
+            sleepers = self._alarms[alarm]
+            del sleepers[unique_id]
+            if not sleepers:
+                del self._alarms[alarm]
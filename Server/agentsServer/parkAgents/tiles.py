@@ -0,0 +1,196 @@
+import numpy as np
+
+# Tile types stored in TileLayer.tiles.
+EMPTY = 0
+ROAD = 1
+OBSTACLE = 2
+DESTINATION = 3
+TRAFFIC_LIGHT = 4
+
+# Road directions stored in TileLayer.directions, indexed by their code.
+DIRECTIONS = [None, "Up", "Down", "Left", "Right"]
+DIRECTION_CODES = {direction: code for code, direction in enumerate(DIRECTIONS)}
+
+
+class TileLayer:
+    """
+    Static content of a park map, stored as arrays indexed by [x, y].
+    Attributes:
+        width: Width of the map
+        height: Height of the map
+        tiles: uint8 array with the tile type of each cell
+        directions: uint8 array with the road direction code of each cell,
+            0 where there is no road
+        light_index: int32 array with the index of the traffic light in each
+            cell, -1 where there is no traffic light
+        lights: List of (pos, state, timeToChange) tuples, one per traffic
+            light, in the order used by light_index
+        destinations: List with the grid coords of the destinations
+    """
+
+    def __init__(self, width, height):
+        """
+        Creates an empty tile layer.
+        Args:
+            width: Width of the map
+            height: Height of the map
+        """
+        self.width = width
+        self.height = height
+        self.tiles = np.zeros((width, height), dtype=np.uint8)
+        self.directions = np.zeros((width, height), dtype=np.uint8)
+        self.light_index = np.full((width, height), -1, dtype=np.int32)
+        self.lights = []
+        self.destinations = []
+
+    @classmethod
+    def from_lines(cls, lines, dataDictionary):
+        """
+        Creates the tile layer of a map file.
+        Args:
+            lines: Lines of the map file, where each character is a cell
+            dataDictionary: Dictionary that maps the characters in the map
+                file to their meaning
+        """
+        layer = cls(len(lines[0]) - 1, len(lines))
+
+        # Characters of the map as a (row, column) byte matrix.
+        chars = np.zeros((layer.height, layer.width), dtype=np.uint8)
+        for r, row in enumerate(lines):
+            row = row.rstrip("\n").encode()[: layer.width]
+            chars[r, : len(row)] = np.frombuffer(row, dtype=np.uint8)
+
+        tiles = np.zeros(256, dtype=np.uint8)
+        directions = np.zeros(256, dtype=np.uint8)
+        for col in ["v", "^", ">", "<"]:
+            tiles[ord(col)] = ROAD
+            directions[ord(col)] = DIRECTION_CODES[dataDictionary[col]]
+        tiles[ord("S")] = tiles[ord("s")] = TRAFFIC_LIGHT
+        tiles[ord("#")] = OBSTACLE
+        tiles[ord("D")] = DESTINATION
+
+        # Map rows go from the top of the grid to the bottom.
+        layer.tiles[:] = tiles[chars][::-1].T
+        layer.directions[:] = directions[chars][::-1].T
+
+        for r, c in zip(*np.nonzero((chars == ord("S")) | (chars == ord("s")))):
+            r, c = int(r), int(c)
+            col = lines[r][c]
+            pos = (c, layer.height - r - 1)
+
+            # Road tile under traffic_light, in the direction of the roads
+            # next to it.
+            direction = dataDictionary["v"]
+            if col == "S":
+                for road in [lines[r - 1][c], lines[r + 1][c]]:
+                    if road in ["v", "^"]:
+                        direction = dataDictionary[road]
+                        break
+
+            elif col == "s":
+                for road in [lines[r][c - 1], lines[r][c + 1]]:
+                    if road in [">", "<"]:
+                        direction = dataDictionary[road]
+                        break
+
+            layer.directions[pos] = DIRECTION_CODES[direction]
+            layer.light_index[pos] = len(layer.lights)
+            layer.lights.append(
+                (pos, False if col == "S" else True, int(dataDictionary[col]))
+            )
+
+        for r, c in zip(*np.nonzero(chars == ord("D"))):
+            layer.destinations.append((int(c), layer.height - int(r) - 1))
+
+        return layer
+
+    @classmethod
+    def from_arrays(cls, tiles, directions, light_index, lights, destinations):
+        """
+        Creates a tile layer from arrays that were already computed, like
+        the ones stored in a compiled map. The arrays are not copied.
+        Args:
+            tiles: Array with the tile type of each cell
+            directions: Array with the road direction code of each cell
+            light_index: Array with the traffic light index of each cell
+            lights: List of (pos, state, timeToChange) tuples
+            destinations: List with the grid coords of the destinations
+        """
+        layer = cls.__new__(cls)
+        layer.width, layer.height = tiles.shape
+        layer.tiles = tiles
+        layer.directions = directions
+        layer.light_index = light_index
+        layer.lights = lights
+        layer.destinations = destinations
+        return layer
+
+    def is_road(self, pos):
+        """
+        Returns whether a bike can drive on the given grid coords.
+        """
+        return self.directions[pos] != 0
+
+    def direction_at(self, pos):
+        """
+        Returns the direction of the road at the given grid coords, or None.
+        """
+        return DIRECTIONS[self.directions[pos]]
+
+    def road_coords(self):
+        """
+        Returns a (roads, 2) array with the grid coords of every road, in the
+        order of the map file.
+        """
+        rows, xs = np.nonzero(self.directions[:, ::-1].T)
+        return np.stack([xs, self.height - rows - 1], axis=1)
+
+    def road_positions(self):
+        """
+        Returns the grid coords of every road, in the order of the map file.
+        """
+        return list(map(tuple, self.road_coords().tolist()))
+
+    def tile_id(self, prefix, pos):
+        """
+        Returns the id of a tile, numbered by its position in the map file.
+        """
+        return f"{prefix}_{(self.height - pos[1] - 1) * self.width + pos[0]}"
+
+    def map_tiles(self):
+        """
+        Returns the static tiles of the map grouped by type, as lists of
+        dictionaries with the id and position of each tile.
+        The y coordinate is set to 1, since the tiles are in a 3D world. The
+        z coordinate corresponds to the row (y coordinate) of the grid.
+        """
+        map_tiles = {
+            "obstacles": [],
+            "roads": [],
+            "traffic_lights": [],
+            "destinations": [],
+        }
+
+        xs, ys = np.nonzero(self.tiles)
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            tile = self.tiles[x, y]
+            if tile == OBSTACLE or tile == DESTINATION:
+                map_tiles["obstacles"].append(self._tile_info("ob", x, y))
+                if tile == DESTINATION:
+                    map_tiles["destinations"].append(self._tile_info("d", x, y))
+            else:
+                map_tiles["roads"].append(self._tile_info("r", x, y))
+                if tile == TRAFFIC_LIGHT:
+                    agent_info = self._tile_info("tl", x, y)
+                    agent_info["direction"] = self.direction_at((x, y))
+                    map_tiles["traffic_lights"].append(agent_info)
+
+        return map_tiles
+
+    def _tile_info(self, prefix, x, y):
+        return {
+            "id": self.tile_id(prefix, (x, y)),
+            "x": x,
+            "y": 1,
+            "z": y,
+        }
@@ -0,0 +1,194 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Prefetching of simulation frames for the agents server.
+# A prefetcher steps the model of a session ahead of its client into a
+# bounded buffer of serialized frames, so that /update and /getAgents only
+# read the next frame instead of waiting for the model to step.
+
+from collections import deque
+import json
+import threading
+
+
+def agents_json(frame, since=None):
+    """
+    Returns the /getAgents body of a prefetched frame as JSON bytes.
+    Args:
+        frame: Frame made by Simulation.prefetch
+        since: Step of the last bikes the client has, as in /getAgents
+    """
+    if since is None:
+        return frame["agents"]
+    if since == frame["since"]:
+        return frame["delta"]
+
+    if since == frame["step"]:
+        # The client already has the bikes of this step.
+        result = {"step": frame["step"], "agents": [], "full": False, "removed": []}
+        return json.dumps(result, separators=(",", ":")).encode()
+    return full_json(frame)
+
+
+def full_json(frame):
+    """
+    Returns every bike of a prefetched frame as a /getAgents?since= body
+    with full set, for clients whose step is older than the frame's delta.
+    """
+    result = json.loads(frame["agents"])
+    result.update(full=True, removed=[])
+    return json.dumps(result, separators=(",", ":")).encode()
+
+
+def merged_json(frames, since):
+    """
+    Returns the /getAgents body of the last of several consecutive
+    prefetched frames as JSON bytes, merging their deltas when the client
+    has the bikes of the frame before the first one.
+    """
+    if since is None or since != frames[0]["since"] or len(frames) == 1:
+        return agents_json(frames[-1], since)
+
+    # Bike ids are never reused, so later changes replace earlier ones.
+    agents = {}
+    removed = set()
+    for frame in frames:
+        delta = json.loads(frame["delta"])
+        if delta["full"]:
+            return full_json(frames[-1])
+        agents.update((agent["id"], agent) for agent in delta["agents"])
+        removed.update(delta["removed"])
+
+    result = {
+        "step": frames[-1]["step"],
+        "agents": [agent for id, agent in agents.items() if id not in removed],
+        "full": False,
+        "removed": sorted(removed, key=int),
+    }
+    return json.dumps(result, separators=(",", ":")).encode()
+
+
+class FramePrefetcher:
+    """
+    Steps the model of a session in a thread, keeping up to size frames
+    ready for its client. The thread waits while the buffer is full, and
+    stops when the model stops running or the session is closed.
+    Attributes:
+        session: Id of the session
+        size: Maximum number of frames kept ahead of the client
+        current: Frame the client is at
+    """
+
+    def __init__(self, sessions, session, size):
+        """
+        Creates a prefetcher and starts its thread.
+        Args:
+            sessions: SessionRegistry of the server
+            session: Id of the session to step
+            size: Maximum number of frames kept ahead of the client
+        """
+        self.sessions = sessions
+        self.session = session
+        self.size = size
+        self.condition = threading.Condition()
+        self.ready = deque()
+        self.current = sessions.call(session, "prefetch", False)
+        self.running = True
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        since = self.current["step"]
+        try:
+            while True:
+                with self.condition:
+                    while self.running and len(self.ready) >= self.size:
+                        # Stop waiting for a client whose session was closed.
+                        if self.session not in self.sessions:
+                            self.running = False
+                        self.condition.wait(1)
+                    if not self.running:
+                        return
+
+                frame = self.sessions.call(self.session, "prefetch", True, since)
+                since = frame["step"]
+                with self.condition:
+                    self.ready.append(frame)
+                    self.condition.notify_all()
+                if not frame["running"]:
+                    return
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+
+    def advance(self, steps=1):
+        """
+        Moves the client up to steps frames forward, waiting for the frames
+        that are not ready yet, and returns the list of frames it moved
+        through. Stops early at the frame where the model stopped running.
+        """
+        frames = []
+        with self.condition:
+            while len(frames) < steps:
+                while not self.ready and self.running:
+                    self.condition.wait()
+                if not self.ready:
+                    break
+                self.current = self.ready.popleft()
+                frames.append(self.current)
+                # A frame was taken, so the thread can step the model again.
+                self.condition.notify_all()
+                if not self.current["running"]:
+                    break
+
+        if not frames and self.error is not None:
+            raise self.error
+        return frames
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+
+class PrefetchRegistry:
+    """
+    Prefetchers of the server, at most one per session.
+    """
+
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.lock = threading.Lock()
+        self.prefetchers = {}
+
+    def start(self, session, size):
+        """
+        Starts prefetching up to size frames of a session.
+        """
+        prefetcher = FramePrefetcher(self.sessions, session, size)
+        with self.lock:
+            # Forget the prefetchers of sessions that were closed.
+            for closed in [s for s in self.prefetchers if s not in self.sessions]:
+                self.prefetchers.pop(closed).stop()
+            self.prefetchers[session] = prefetcher
+        return prefetcher
+
+    def get(self, session):
+        """
+        Returns the prefetcher of a session, or None if it does not have one.
+        """
+        with self.lock:
+            prefetcher = self.prefetchers.get(session)
+            if prefetcher is not None and session not in self.sessions:
+                del self.prefetchers[session]
+                prefetcher.stop()
+                return None
+            return prefetcher
+
+    def stop(self, session):
+        with self.lock:
+            prefetcher = self.prefetchers.pop(session, None)
+        if prefetcher is not None:
+            prefetcher.stop()
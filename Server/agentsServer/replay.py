@@ -0,0 +1,143 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Replay sessions for the agents server.
+# When the server is started with --replay, every session reads the steps of
+# a recorded trace instead of simulating them, so serving a replay costs no
+# simulation at all and any step can be read at once.
+
+from parkAgents.recording import ReplayModel, TraceReader
+from sessions import Simulation, UnknownSession
+import threading
+import time
+import uuid
+
+
+class Replay(Simulation):
+    """
+    Simulation of a replay session, whose model is a ReplayModel.
+    """
+
+    def agents_at(self, index):
+        """
+        Returns the bikes after a recorded step, as in agents(), without
+        moving the replay.
+        Args:
+            index: Number of the recorded step, the currentStep of a live
+                simulation
+        """
+        model = self.model
+        index = max(0, min(index, len(model.reader) - 1))
+        return {
+            "step": int(model.reader.steps[index]),
+            "agents": [
+                {"id": str(unique_id), "x": x, "y": 1, "z": z, "direction": direction}
+                for unique_id, (x, z), direction in model.bikes(index=index)
+            ],
+        }
+
+
+class ReplayRegistry:
+    """
+    Sessions of a server that replays a trace file, with the same methods as
+    SessionRegistry. Every session reads the same TraceReader from the
+    server's process, and the least recently used sessions are closed when
+    there are more than max_sessions.
+    Attributes:
+        reader: TraceReader of the trace
+        max_sessions: Maximum number of open sessions
+    """
+
+    def __init__(self, path, max_sessions=1024):
+        """
+        Opens the trace file.
+        Args:
+            path: Path of a trace file made by TraceRecorder
+            max_sessions: Maximum number of open sessions
+        """
+        self.reader = TraceReader(path)
+        self.tiles = self.reader.tiles()
+        self.max_sessions = max_sessions
+
+        self.lock = threading.Lock()
+        # Replay, lock, last use time and version of each session.
+        self._replays = {}
+        self._locks = {}
+        self._last_used = {}
+        self._version = {}
+
+    def __contains__(self, session):
+        return session in self._replays
+
+    def __len__(self):
+        return len(self._replays)
+
+    def create(self, map_file=None, **options):
+        """
+        Creates a session at the first step of the replay and returns its id
+        and the info of its model. The map and options are ignored, since
+        they were fixed when the trace was recorded.
+        """
+        session = uuid.uuid4().hex
+        replay = Replay(ReplayModel(self.reader, self.tiles), self.reader.metadata["map"])
+        with self.lock:
+            while len(self._replays) >= self.max_sessions:
+                self._forget(min(self._last_used, key=self._last_used.get))
+            self._replays[session] = replay
+            self._locks[session] = threading.Lock()
+            self._last_used[session] = time.monotonic()
+            self._version[session] = 0
+        return session, replay.info()
+
+    def call(self, session, command, *args, **kwargs):
+        """
+        Runs a method of a session's Replay and returns its result.
+        Raises UnknownSession if the session does not exist.
+        """
+        with self.lock:
+            replay = self._replays.get(session)
+            if replay is None:
+                raise UnknownSession(session)
+            lock = self._locks[session]
+            self._last_used[session] = time.monotonic()
+        with lock:
+            try:
+                return getattr(replay, command)(*args, **kwargs)
+            finally:
+                if command in Simulation.STEPPING:
+                    with self.lock:
+                        if session in self._version:
+                            self._version[session] += 1
+
+    def version(self, session):
+        """
+        Returns a number that changes every time a session's replay moves.
+        Raises UnknownSession if the session does not exist.
+        """
+        with self.lock:
+            if session not in self._version:
+                raise UnknownSession(session)
+            return self._version[session]
+
+    def close(self, session):
+        with self.lock:
+            self._forget(session)
+
+    def _forget(self, session):
+        self._replays.pop(session, None)
+        self._locks.pop(session, None)
+        self._last_used.pop(session, None)
+        self._version.pop(session, None)
+
+    def metrics(self):
+        """
+        Returns the metrics of the models, which are empty since replays are
+        not simulated.
+        """
+        return {}
+
+    def shutdown(self):
+        with self.lock:
+            self._replays.clear()
+            self._locks.clear()
+            self._last_used.clear()
+            self._version.clear()
+        self.reader.close()
@@ -0,0 +1,518 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Registry of simulation sessions for the agents server.
+# Every session owns a ParkModel that lives in one of a pool of worker
+# processes, so several clients can run their own simulation at the same
+# time and the models are stepped on every core instead of on the Flask
+# request threads.
+
+from parkAgents.compiled import compile_map
+from parkAgents.frames import pack_frame
+from parkAgents.metrics import BIKES_IN_MODEL, REGISTRY, merge_snapshots
+from parkAgents.model import ParkModel
+import json
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import uuid
+
+# Estimated bytes used by each cell of the model's grid and by each agent,
+# used to decide when the sessions use too much memory.
+GRID_CELL_BYTES = 64
+AGENT_BYTES = 1024
+
+# Folder where the profiles of profiled sessions are written when their
+# model stops running.
+PROFILE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+
+
+class UnknownSession(KeyError):
+    """Raised when a request names a session that does not exist."""
+
+
+class Simulation:
+    """
+    Model of one session and the state the server keeps about it. Every
+    public method can be called from the server through the registry.
+    Attributes:
+        model: ParkModel of the session
+        map_file: Name of the map of the model
+        currentStep: Number of times the model has been updated
+        profile_prefix: Path, without extension, where the model's profile is
+            written when it stops running, or None
+    """
+
+    # Methods that change the model, after which cached frames are stale.
+    STEPPING = {"update", "advance", "prefetch"}
+
+    def __init__(self, model, map_file):
+        self.model = model
+        self.map_file = map_file
+        self.currentStep = 0
+        self.profile_prefix = None
+
+    def info(self):
+        """
+        Returns the map, size and engine of the model, with a warning when
+        it runs with another engine than the one asked for.
+        """
+        info = {
+            "map": self.map_file,
+            "width": self.model.width,
+            "height": self.model.height,
+            "engine": self.model.engine_name,
+        }
+        if self.model.engine_message is not None:
+            info["warning"] = self.model.engine_message
+        return info
+
+    def update(self):
+        """
+        Advances the model by one step and returns the current step and
+        whether the model is still running.
+        """
+        was_running = self.model.running
+        self.model.step()
+        self.currentStep += 1
+        if was_running and not self.model.running:
+            self.write_profile()
+        return {"currentStep": self.currentStep, "running": self.model.running}
+
+    def write_profile(self):
+        """
+        Writes the profile of a profiled model to profile_prefix, see
+        Profiler.write.
+        """
+        if self.profile_prefix is None or self.model.profiler is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.profile_prefix), exist_ok=True)
+            self.model.profiler.write(self.profile_prefix)
+        except OSError as e:
+            print(f"Could not write the profile {self.profile_prefix}: {e}")
+
+    def profile(self, collapsed=False):
+        """
+        Returns the summary of the model's profile, or its collapsed stacks
+        as a string, or None if the model is not profiled.
+        """
+        profiler = self.model.profiler
+        if profiler is None:
+            return None
+        return profiler.collapsed() if collapsed else profiler.summary()
+
+    def advance(self, steps=1, frames="last", binary=False, since=None):
+        """
+        Advances the model by up to steps steps, stopping early if it stops
+        running, and returns the bikes along with the current step.
+        Args:
+            steps: Number of steps to advance
+            frames: "last" for the bikes after the last step, "all" for the
+                bikes after every step, or "none" to skip them
+            binary: Whether to return the frames as packed binary frames
+                instead of as agents() dictionaries
+            since: Step of the last bikes the client has, to only return the
+                bikes that changed after it, as in agents()
+        """
+        collected = []
+        stepped = 0
+        while stepped < steps:
+            self.update()
+            stepped += 1
+            if frames == "all":
+                collected.append(self.frame() if binary else self.agents(since))
+                since = None if since is None else self.model.schedule.steps
+            if not self.model.running:
+                break
+
+        if frames == "last":
+            collected.append(self.frame() if binary else self.agents(since))
+
+        return {
+            "currentStep": self.currentStep,
+            "running": self.model.running,
+            "steps": stepped,
+            "frames": collected,
+        }
+
+    def agents(self, since=None):
+        """
+        Returns the id, position and direction of the bikes and the step of
+        the model. When since is given, only the bikes that spawned, moved
+        or turned after that step are returned, along with the ids of the
+        bikes that left the model, unless the step is too old and full is
+        set to True.
+        The y coordinate is set to 1, since the agents are in a 3D world. The
+        z coordinate corresponds to the row (y coordinate) of the grid.
+        """
+        model = self.model
+        delta = None if since is None else model.bikes_since(since)
+        if delta is None:
+            bikes, removed = model.bikes(), []
+        else:
+            bikes, removed = delta
+
+        result = {
+            "step": model.schedule.steps,
+            "agents": [
+                {
+                    "id": str(unique_id),
+                    "x": x,
+                    "y": 1,
+                    "z": z,
+                    "direction": direction,
+                }
+                for unique_id, (x, z), direction in bikes
+            ],
+        }
+        if since is not None:
+            result["full"] = delta is None
+            result["removed"] = [str(unique_id) for unique_id in removed]
+        return result
+
+    def frame(self):
+        """
+        Returns the bikes as a packed binary frame, see parkAgents.frames.
+        """
+        return pack_frame(self.model.schedule.steps, *self.model.bike_arrays())
+
+    def prefetch(self, step=True, since=None):
+        """
+        Advances the model by one step, unless step is False, and returns
+        its frame serialized ahead of time for a FramePrefetcher: the step
+        of the model, the current step, whether it is running, the bikes as
+        agents() and agents(since) JSON bytes, the binary frame and the
+        statistics as stats() JSON bytes.
+        Args:
+            step: Whether to advance the model first
+            since: Step of the previous frame, for the delta of the bikes
+        """
+        if step:
+            self.update()
+        return {
+            "step": self.model.schedule.steps,
+            "currentStep": self.currentStep,
+            "running": self.model.running,
+            "since": since,
+            "agents": self.json("agents"),
+            "delta": None if since is None else self.json("agents", since),
+            "frame": self.frame(),
+            "stats": self.json("stats"),
+        }
+
+    def json(self, command, *args):
+        """
+        Returns the result of another method serialized as JSON bytes, so
+        that the server does not have to serialize it again.
+        """
+        return json.dumps(
+            getattr(self, command)(*args), separators=(",", ":")
+        ).encode()
+
+    def stats(self):
+        """
+        Returns the statistics of the model, see ParkModel.stats.
+        """
+        return self.model.stats()
+
+    def map(self):
+        """
+        Returns the static tiles of the map.
+        """
+        return self.model.map_tiles()
+
+    def map_info(self):
+        """
+        Returns the body of /getMap, the static tiles of the map.
+        """
+        return {"map": self.map()}
+
+    def memory(self):
+        """
+        Returns an estimate of the bytes used by the model. The compiled map
+        is not included, since it is shared by every session of the map.
+        """
+        model = self.model
+        size = model.occupancy.nbytes
+        size += model.width * model.height * GRID_CELL_BYTES
+        size += len(model.agents) * AGENT_BYTES
+        if model.engine is not None:
+            size += sum(
+                getattr(model.engine, field).nbytes for field in model.engine._fields()
+            )
+        return size
+
+
+def worker_main(connection):
+    """
+    Main loop of a worker process. Receives (command, session, args,
+    kwargs) tuples and answers each one with ("ok", result) or ("error",
+    message).
+    Args:
+        connection: Worker's end of the pipe to the registry
+    """
+    simulations = {}
+    compiled_maps = {}
+
+    while True:
+        try:
+            command, session, args, kwargs = connection.recv()
+        except EOFError:
+            return
+
+        try:
+            if command == "create":
+                map_file = kwargs.pop("map_file")
+                if map_file not in compiled_maps:
+                    compiled_maps[map_file] = compile_map(map_file)
+                model = ParkModel(
+                    map_file=map_file, compiled=compiled_maps[map_file], **kwargs
+                )
+                simulations[session] = Simulation(model, map_file)
+                if model.profiler is not None:
+                    simulations[session].profile_prefix = os.path.join(
+                        PROFILE_FOLDER, session
+                    )
+                result = simulations[session].info()
+            elif command == "close":
+                simulations.pop(session, None)
+                result = None
+            elif command == "memory":
+                result = {
+                    session: simulation.memory()
+                    for session, simulation in simulations.items()
+                }
+            elif command == "metrics":
+                BIKES_IN_MODEL.set(
+                    sum(
+                        simulation.model.bikes_in_model
+                        for simulation in simulations.values()
+                    )
+                )
+                result = REGISTRY.snapshot()
+            elif command == "stop":
+                connection.send(("ok", None))
+                return
+            else:
+                result = getattr(simulations[session], command)(*args, **kwargs)
+            connection.send(("ok", result))
+        except Exception:
+            connection.send(("error", traceback.format_exc()))
+
+
+class Worker:
+    """
+    Handle of a worker process, used by the registry.
+    Attributes:
+        process: The worker process
+        connection: Registry's end of the pipe to the worker
+        lock: Lock that keeps one command at a time in the pipe
+        sessions: Set with the ids of the sessions in the worker
+    """
+
+    def __init__(self, context):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+        self.sessions = set()
+
+    def call(self, command, session=None, *args, **kwargs):
+        """
+        Runs a command in the worker and returns its result.
+        """
+        with self.lock:
+            self.connection.send((command, session, args, kwargs))
+            status, result = self.connection.recv()
+        if status == "error":
+            raise RuntimeError(result)
+        return result
+
+    def stop(self):
+        try:
+            self.call("stop")
+        except (EOFError, OSError):
+            pass
+        self.process.join(timeout=5)
+
+
+class SessionRegistry:
+    """
+    Sessions of the server, spread over a pool of worker processes.
+    Sessions that have not been used for idle_timeout seconds are closed,
+    and the least recently used ones are closed when there are more than
+    max_sessions or their models use more than max_memory bytes.
+    Attributes:
+        workers: List of Worker handles
+        max_sessions: Maximum number of open sessions
+        max_memory: Maximum estimated bytes used by all the models
+        idle_timeout: Seconds after which an unused session is closed
+    """
+
+    def __init__(
+        self,
+        workers=None,
+        max_sessions=64,
+        max_memory=4 * 1024**3,
+        idle_timeout=30 * 60,
+    ):
+        """
+        Creates the registry and starts its worker processes.
+        Args:
+            workers: Number of worker processes, one per core if omitted
+            max_sessions: Maximum number of open sessions
+            max_memory: Maximum estimated bytes used by all the models
+            idle_timeout: Seconds after which an unused session is closed
+        """
+        # Workers are started with spawn so that they do not inherit the
+        # server's threads.
+        context = multiprocessing.get_context("spawn")
+        self.workers = [Worker(context) for _ in range(workers or os.cpu_count())]
+        self.max_sessions = max_sessions
+        self.max_memory = max_memory
+        self.idle_timeout = idle_timeout
+
+        self.lock = threading.Lock()
+        # Worker, last use time and version of each session. The version
+        # changes every time the session's model is stepped.
+        self._worker = {}
+        self._last_used = {}
+        self._version = {}
+
+    def __contains__(self, session):
+        return session in self._worker
+
+    def __len__(self):
+        return len(self._worker)
+
+    def create(self, map_file, **options):
+        """
+        Creates a session with a new model of a map and returns its id and
+        the info of its model.
+        Args:
+            map_file: Name of a map in PARK_FILES, or the path of a map file
+            options: Other arguments of ParkModel
+        """
+        self.evict(reserve=1)
+
+        session = uuid.uuid4().hex
+        with self.lock:
+            worker = min(self.workers, key=lambda worker: len(worker.sessions))
+            worker.sessions.add(session)
+            self._worker[session] = worker
+            self._last_used[session] = time.monotonic()
+            self._version[session] = 0
+
+        try:
+            info = worker.call("create", session, map_file=map_file, **options)
+        except Exception:
+            self._forget(session)
+            raise
+
+        self.evict(keep=session)
+        return session, info
+
+    def call(self, session, command, *args, **kwargs):
+        """
+        Runs a method of a session's Simulation and returns its result.
+        Raises UnknownSession if the session does not exist.
+        """
+        with self.lock:
+            worker = self._worker.get(session)
+            if worker is None:
+                raise UnknownSession(session)
+            self._last_used[session] = time.monotonic()
+        try:
+            return worker.call(command, session, *args, **kwargs)
+        finally:
+            if command in Simulation.STEPPING:
+                with self.lock:
+                    if session in self._version:
+                        self._version[session] += 1
+
+    def version(self, session):
+        """
+        Returns a number that changes every time a session's model is
+        stepped. Raises UnknownSession if the session does not exist.
+        """
+        with self.lock:
+            if session not in self._version:
+                raise UnknownSession(session)
+            return self._version[session]
+
+    def close(self, session):
+        """
+        Closes a session and frees its model.
+        """
+        worker = self._forget(session)
+        if worker is not None:
+            worker.call("close", session)
+
+    def _forget(self, session):
+        with self.lock:
+            worker = self._worker.pop(session, None)
+            self._last_used.pop(session, None)
+            self._version.pop(session, None)
+            if worker is not None:
+                worker.sessions.discard(session)
+        return worker
+
+    def memory(self):
+        """
+        Returns a dictionary with the estimated bytes used by the model of
+        every session.
+        """
+        sizes = {}
+        for worker in self.workers:
+            sizes.update(worker.call("memory"))
+        return sizes
+
+    def metrics(self):
+        """
+        Returns the metrics of the models of every worker, added up, see
+        parkAgents.metrics.
+        """
+        return merge_snapshots(*(worker.call("metrics") for worker in self.workers))
+
+    def evict(self, reserve=0, keep=None):
+        """
+        Closes the sessions that have been idle for too long, then the least
+        recently used ones until the limits are met.
+        Args:
+            reserve: Number of sessions about to be created
+            keep: Session that must not be closed
+        """
+        now = time.monotonic()
+        with self.lock:
+            by_use = sorted(self._last_used, key=self._last_used.get)
+        if keep in by_use:
+            by_use.remove(keep)
+            reserve += 1
+
+        for session in list(by_use):
+            if now - self._last_used.get(session, now) > self.idle_timeout:
+                self.close(session)
+                by_use.remove(session)
+
+        while by_use and len(by_use) + reserve > self.max_sessions:
+            self.close(by_use.pop(0))
+
+        if self.max_memory is not None and by_use:
+            sizes = self.memory()
+            total = sum(sizes.values())
+            while by_use and total > self.max_memory:
+                session = by_use.pop(0)
+                total -= sizes.get(session, 0)
+                self.close(session)
+
+    def shutdown(self):
+        """
+        Stops every worker process.
+        """
+        for worker in self.workers:
+            worker.stop()
+        self._worker.clear()
+        self._last_used.clear()
+        self._version.clear()
@@ -0,0 +1,209 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Push streaming of simulation frames for the agents server.
+# A stream steps the model of a session on its own clock and hands every
+# frame to its subscribers. Each subscriber only keeps the newest frame, so
+# slow clients skip frames instead of making the stream wait for them.
+
+import json
+import threading
+import time
+
+# Seconds a stream waits for a client to subscribe again after the last one
+# left before it stops. The model is not stepped while it waits.
+IDLE_SECONDS = 10
+
+# Steps per second of a stream when the first client does not ask for a rate.
+DEFAULT_RATE = 2
+
+
+class RateConflict(ValueError):
+    """
+    Raised when a client asks for another rate than the one of a stream that
+    other clients are subscribed to.
+    Attributes:
+        rate: Steps per second of the stream
+    """
+
+    def __init__(self, rate):
+        super().__init__(f"The session is already streamed at {rate:g} steps/s")
+        self.rate = rate
+
+
+class Subscriber:
+    """
+    Mailbox of one client of a stream, holding only the newest frame.
+    Attributes:
+        dropped: Number of frames replaced before the client read them
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.frame = None
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, frame):
+        """
+        Replaces the pending frame with a newer one.
+        """
+        with self.condition:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Returns the pending frame, waiting up to timeout seconds for one.
+        Returns None on timeout or when the stream is closed.
+        """
+        with self.condition:
+            if self.frame is None and not self.closed:
+                self.condition.wait(timeout)
+            frame, self.frame = self.frame, None
+            return frame
+
+
+class SimulationStream:
+    """
+    Steps the model of a session at a fixed rate and pushes each frame to
+    its subscribers as a JSON string. The stream pauses while it has no
+    subscribers, and ends when the model stops running, when the session is
+    closed or after IDLE_SECONDS without subscribers.
+    Attributes:
+        session: Id of the session
+        rate: Steps per second
+        subscribers: Set of Subscriber mailboxes
+    """
+
+    def __init__(self, sessions, session, rate):
+        """
+        Creates a stream and starts its thread.
+        Args:
+            sessions: SessionRegistry of the server
+            session: Id of the session to step
+            rate: Steps per second
+        """
+        self.sessions = sessions
+        self.session = session
+        self.rate = rate
+        self.subscribers = set()
+        # Wakes up a paused stream when a client subscribes or it is stopped.
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def subscribe(self):
+        subscriber = Subscriber()
+        with self.condition:
+            self.subscribers.add(subscriber)
+            # A stream that already ended sends its end to the new client.
+            if not self.running:
+                subscriber.close()
+            self.condition.notify_all()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.condition:
+            self.subscribers.discard(subscriber)
+
+    def subscribed(self):
+        with self.condition:
+            return bool(self.subscribers)
+
+    def _wait_for_subscribers(self):
+        # Waits up to IDLE_SECONDS for a client to subscribe, without
+        # stepping the model, and returns whether the stream goes on.
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.subscribers or not self.running, IDLE_SECONDS
+            )
+            return self.running and bool(self.subscribers)
+
+    def _publish(self, frame):
+        with self.condition:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(frame)
+
+    def _run(self):
+        next_step = time.monotonic()
+        try:
+            while self.running:
+                if not self.subscribed():
+                    if not self._wait_for_subscribers():
+                        break
+                    next_step = time.monotonic()
+
+                # The stream keeps its own clock, a slow step delays the
+                # next one instead of making the stream catch up.
+                next_step = max(next_step + 1 / self.rate, time.monotonic())
+
+                result = self.sessions.call(self.session, "advance", 1, "last")
+                frame = result["frames"][0]
+                frame["currentStep"] = result["currentStep"]
+                frame["running"] = result["running"]
+                self._publish(json.dumps(frame))
+                if not result["running"]:
+                    break
+
+                time.sleep(max(0, next_step - time.monotonic()))
+        except Exception as e:
+            print(f"Stream of session {self.session} stopped: {e}")
+        finally:
+            with self.condition:
+                self.running = False
+                subscribers = list(self.subscribers)
+            for subscriber in subscribers:
+                subscriber.close()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+
+class StreamRegistry:
+    """
+    Streams of the server, at most one per session.
+    """
+
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.lock = threading.Lock()
+        self.streams = {}
+
+    def subscribe(self, session, rate=None):
+        """
+        Returns the stream of a session and a new subscriber to it, starting
+        the stream if it is not running.
+        Every subscriber of a stream sees the same steps, so a stream has a
+        single rate. A rate of None joins the stream at its rate, or starts
+        it at DEFAULT_RATE. Raises RateConflict if the stream has other
+        subscribers and runs at another rate; a stream without subscribers
+        changes to the new rate.
+        """
+        with self.lock:
+            stream = self.streams.get(session)
+            if stream is None or not stream.running:
+                stream = SimulationStream(
+                    self.sessions, session, DEFAULT_RATE if rate is None else rate
+                )
+                self.streams[session] = stream
+            elif rate is not None and rate != stream.rate:
+                if stream.subscribed():
+                    raise RateConflict(stream.rate)
+                stream.rate = rate
+            return stream, stream.subscribe()
+
+    def stop(self, session):
+        with self.lock:
+            stream = self.streams.pop(session, None)
+        if stream is not None:
+            stream.stop()
@@ -0,0 +1,69 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Shared fixtures of the tests of the agents server.
+# The tests import the server modules by name, as agents_server.py does
+# when it runs from its folder.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collections import deque
+from map_generator import generate_map
+from parkAgents.compiled import PARK_FILES, CompiledMap, load_dictionary
+import pytest
+
+# Maps shipped in park_files.
+MAPS = ["2021_base.txt", "2022_base.txt", "2023_base.txt", "2024_base.txt"]
+
+
+def map_lines(map_file):
+    """
+    Returns the lines of a map in park_files.
+    """
+    with open(os.path.join(PARK_FILES, map_file)) as mapFile:
+        return mapFile.readlines()
+
+
+def bfs_distances(graph, goals):
+    """
+    Returns a dictionary with the number of steps from each road that can
+    reach one of the goal roads to the closest one, by a breadth first
+    search over the positions of the graph.
+    """
+    predecessors = {}
+    for pos in graph.positions:
+        for neighbor in graph.neighbors(pos):
+            predecessors.setdefault(neighbor, []).append(pos)
+
+    distances = {goal: 0 for goal in goals}
+    queue = deque(goals)
+    while queue:
+        pos = queue.popleft()
+        for predecessor in predecessors.get(pos, ()):
+            if predecessor not in distances:
+                distances[predecessor] = distances[pos] + 1
+                queue.append(predecessor)
+    return distances
+
+
+@pytest.fixture(scope="session")
+def dictionary():
+    return load_dictionary()
+
+
+@pytest.fixture(scope="session", params=MAPS)
+def shipped_map(request, dictionary):
+    """
+    CompiledMap of every shipped map, compiled without the cache.
+    """
+    return CompiledMap.from_lines(map_lines(request.param), dictionary)
+
+
+@pytest.fixture(scope="session")
+def generated_map(dictionary):
+    """
+    CompiledMap of a generated 64x64 map with 8 destinations.
+    """
+    lines = generate_map(64, 64, destinations=8, seed=0)
+    return CompiledMap.from_lines(lines, dictionary)
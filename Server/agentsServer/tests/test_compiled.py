@@ -0,0 +1,110 @@
+from conftest import map_lines
+from parkAgents.compiled import (
+    ARRAYS,
+    INDEX_ARRAYS,
+    CompiledMap,
+    compile_map,
+    map_key,
+)
+from parkAgents.hierarchy import BlockIndex
+import json
+import numpy as np
+import os
+import pytest
+
+
+def graph_arrays(graph):
+    return [
+        graph.coords,
+        graph.offsets,
+        graph.targets,
+        graph.reverse_offsets,
+        graph.reverse_targets,
+        graph.node_of,
+    ]
+
+
+def check_same_map(loaded, compiled):
+    assert loaded.key == compiled.key
+    for name in ["tiles", "directions", "light_index"]:
+        assert np.array_equal(
+            getattr(loaded.tiles, name), getattr(compiled.tiles, name)
+        )
+    assert loaded.tiles.lights == compiled.tiles.lights
+    assert loaded.tiles.destinations == compiled.tiles.destinations
+    for loaded_array, array in zip(
+        graph_arrays(loaded.graph), graph_arrays(compiled.graph)
+    ):
+        assert np.array_equal(loaded_array, array)
+    assert loaded.approaches == compiled.approaches
+
+    positions = compiled.graph.positions
+    for destination, route in compiled.routes.items():
+        loaded_route = loaded.routes[destination]
+        assert loaded_route.goals == route.goals
+        for pos in positions:
+            assert loaded_route.distance_from(pos) == route.distance_from(pos)
+            assert loaded_route.next_hop_from(pos) == route.next_hop_from(pos)
+
+
+@pytest.mark.parametrize("mmap_mode", ["r", None])
+def test_save_load_round_trip(shipped_map, tmp_path, mmap_mode):
+    shipped_map.save(tmp_path)
+    loaded = CompiledMap.load(tmp_path, mmap_mode=mmap_mode)
+
+    assert loaded.index is None
+    assert np.array_equal(loaded.distances, shipped_map.distances)
+    assert np.array_equal(loaded.next_hops, shipped_map.next_hops)
+    check_same_map(loaded, shipped_map)
+
+
+def test_save_load_round_trip_with_block_index(generated_map, tmp_path):
+    index = BlockIndex.from_graph(generated_map.graph, 16)
+    compiled = CompiledMap("key", generated_map.tiles, generated_map.graph, index=index)
+    compiled.save(tmp_path)
+    loaded = CompiledMap.load(tmp_path)
+
+    assert loaded.distances is None and loaded.next_hops is None
+    assert loaded.index.block_size == 16
+    for name in INDEX_ARRAYS:
+        assert np.array_equal(getattr(loaded.index, name), getattr(index, name))
+    assert not os.path.exists(os.path.join(tmp_path, "distances.npy"))
+    check_same_map(loaded, compiled)
+
+
+def test_load_rejects_other_formats(shipped_map, tmp_path):
+    shipped_map.save(tmp_path)
+    metadata_path = os.path.join(tmp_path, "compiled.json")
+    with open(metadata_path) as metadataFile:
+        metadata = json.load(metadataFile)
+    metadata["format"] = -1
+    with open(metadata_path, "w") as metadataFile:
+        json.dump(metadata, metadataFile)
+
+    with pytest.raises(ValueError):
+        CompiledMap.load(tmp_path)
+
+
+def test_compile_map_caches_by_contents(tmp_path, dictionary):
+    map_file = os.path.join(tmp_path, "map.txt")
+    with open(map_file, "w") as mapFile:
+        mapFile.writelines(map_lines("2023_base.txt"))
+    cache = os.path.join(tmp_path, "cache")
+
+    compiled = compile_map(map_file, cache_folder=cache)
+    with open(map_file, "rb") as mapFile:
+        key = map_key(mapFile.read(), dictionary)
+    assert compiled.key == key
+    folder = os.path.join(cache, key)
+    for name in ARRAYS + ["distances", "next_hops"]:
+        assert os.path.exists(os.path.join(folder, f"{name}.npy"))
+
+    cached = compile_map(map_file, cache_folder=cache)
+    assert isinstance(cached.distances, np.memmap)
+    check_same_map(cached, compiled)
+
+    # Another map gets another key.
+    with open(map_file, "a") as mapFile:
+        mapFile.write(map_lines("2023_base.txt")[0])
+    with open(map_file, "rb") as mapFile:
+        assert map_key(mapFile.read(), dictionary) != key
@@ -0,0 +1,61 @@
+from parkAgents.frames import FRAME_HEADER, FRAME_RECORD, pack_frame, unpack_frame
+from parkAgents.model import ParkModel
+from parkAgents.tiles import DIRECTION_CODES
+import numpy as np
+
+
+def test_pack_unpack_round_trip():
+    ids = np.array([3, 70000, 12], dtype=np.int64)
+    coords = np.array([[0, 0], [65535, 2], [17, 900]], dtype=np.int32)
+    directions = np.array([1, 4, 2], dtype=np.uint8)
+
+    frame = pack_frame(123456, ids, coords, directions)
+    assert len(frame) == FRAME_HEADER.itemsize + 3 * FRAME_RECORD.itemsize
+
+    step, records = unpack_frame(frame)
+    assert step == 123456
+    assert records["id"].tolist() == ids.tolist()
+    assert records["x"].tolist() == coords[:, 0].tolist()
+    assert records["z"].tolist() == coords[:, 1].tolist()
+    assert records["direction"].tolist() == directions.tolist()
+
+
+def test_layout_is_packed_little_endian():
+    frame = pack_frame(
+        2, np.array([1]), np.array([[3, 4]]), np.array([5], dtype=np.uint8)
+    )
+    # step, count, then id, x, z and direction without padding.
+    assert frame == bytes([2, 0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0, 3, 0, 4, 0, 5])
+
+
+def test_empty_frame():
+    frame = pack_frame(
+        7,
+        np.empty(0, dtype=np.int64),
+        np.empty((0, 2), dtype=np.int32),
+        np.empty(0, dtype=np.uint8),
+    )
+    step, records = unpack_frame(frame)
+    assert step == 7 and len(records) == 0
+
+
+def test_frame_of_model_matches_bikes(shipped_map):
+    for engine in ["agents", "vector"]:
+        model = ParkModel(
+            compiled=shipped_map, engine=engine, verbose=False, seed=2
+        )
+        for _ in range(10):
+            model.step()
+
+        frame = pack_frame(model.schedule.steps, *model.bike_arrays())
+        step, records = unpack_frame(frame)
+        assert step == model.schedule.steps
+        decoded = sorted(
+            (unique_id, (x, z), direction)
+            for unique_id, x, z, direction in records.tolist()
+        )
+        expected = sorted(
+            (unique_id, pos, DIRECTION_CODES[direction])
+            for unique_id, pos, direction in model.bikes()
+        )
+        assert decoded == expected
@@ -0,0 +1,84 @@
+from parkAgents.graph import RoadGraph
+
+
+def baseline_neighbors(tiles, pos):
+    """
+    Roads a bike can move to from a road, with the rules of the original
+    ParkModel.get_possible_roads over the Moore neighborhood of the road.
+    """
+    x, y = pos
+    direction = tiles.direction_at(pos)
+    roads = []
+    for nx in (x - 1, x, x + 1):
+        for ny in (y - 1, y, y + 1):
+            if (nx, ny) == pos:
+                continue
+            if not (0 <= nx < tiles.width and 0 <= ny < tiles.height):
+                continue
+            if not tiles.is_road((nx, ny)):
+                continue
+            neighbor = tiles.direction_at((nx, ny))
+            # Roads going against the turn can not be entered diagonally.
+            against_x = neighbor == "Left" and nx > x or neighbor == "Right" and nx < x
+            against_y = neighbor == "Up" and ny < y or neighbor == "Down" and ny > y
+            if direction == "Up" and ny == y + 1:
+                blocked = against_x
+            elif direction == "Down" and ny == y - 1:
+                blocked = against_x
+            elif direction == "Left" and nx == x - 1:
+                blocked = against_y
+            elif direction == "Right" and nx == x + 1:
+                blocked = against_y
+            else:
+                continue
+            if not blocked:
+                roads.append((nx, ny))
+    return sorted(roads)
+
+
+def check_graph(tiles, graph):
+    roads = tiles.road_positions()
+    assert sorted(graph.positions) == sorted(roads)
+    for pos in roads:
+        assert sorted(graph.neighbors(pos)) == baseline_neighbors(tiles, pos)
+
+
+def test_from_tiles_matches_baseline(shipped_map):
+    check_graph(shipped_map.tiles, RoadGraph.from_tiles(shipped_map.tiles))
+
+
+def test_from_tiles_matches_baseline_on_generated_map(generated_map):
+    check_graph(generated_map.tiles, generated_map.graph)
+
+
+def test_node_ids(shipped_map):
+    graph = shipped_map.graph
+    for node, pos in enumerate(graph.positions):
+        assert graph.node_id(pos) == node
+        assert pos in graph
+    assert graph.node_id((-1, 0)) is None
+    assert graph.node_id((shipped_map.tiles.width, 0)) is None
+    assert graph.neighbors((-1, 0)) == ()
+
+
+def test_predecessors_are_reverse_of_successors(shipped_map):
+    graph = shipped_map.graph
+    edges = {
+        (node, int(target))
+        for node in range(len(graph))
+        for target in graph.neighbor_ids(node)
+    }
+    reverse = {
+        (int(source), node)
+        for node in range(len(graph))
+        for source in graph.predecessor_ids(node)
+    }
+    assert edges == reverse
+
+
+def test_neighbor_matrix(generated_map):
+    graph = generated_map.graph
+    matrix = graph.neighbor_matrix()
+    for node in range(len(graph)):
+        row = matrix[node]
+        assert row[row >= 0].tolist() == graph.neighbor_ids(node).tolist()
@@ -0,0 +1,52 @@
+from conftest import bfs_distances
+from parkAgents.compiled import CompiledMap
+from parkAgents.hierarchy import BlockIndex, BlockRoute
+import pytest
+
+
+def indexed(compiled, block_size):
+    """
+    Returns a compiled map routed with a block index of the given size.
+    """
+    index = BlockIndex.from_graph(compiled.graph, block_size)
+    return CompiledMap(None, compiled.tiles, compiled.graph, index=index)
+
+
+def check_block_routes(compiled):
+    graph = compiled.graph
+    for destination in compiled.tiles.destinations:
+        route = compiled.routes[destination]
+        assert isinstance(route, BlockRoute)
+        distances = bfs_distances(graph, compiled.approaches[destination])
+        for pos in graph.positions:
+            expected = distances.get(pos, -1)
+            assert route.distance_from(pos) == expected
+
+            next_hop = route.next_hop_from(pos)
+            if expected > 0:
+                assert next_hop in graph.neighbors(pos)
+                assert distances[next_hop] == expected - 1
+            else:
+                assert next_hop is None
+        # Routes are as long as the distance.
+        for pos in graph.positions[::7]:
+            assert len(route.route_from(pos)) == max(distances.get(pos, 0), 0)
+
+
+@pytest.mark.parametrize("block_size", [4, 8])
+def test_block_routes_match_bfs(shipped_map, block_size):
+    check_block_routes(indexed(shipped_map, block_size))
+
+
+@pytest.mark.parametrize("block_size", [8, 32])
+def test_block_routes_match_bfs_on_generated_map(generated_map, block_size):
+    check_block_routes(indexed(generated_map, block_size))
+
+
+def test_block_routes_match_route_tables(generated_map):
+    compiled = indexed(generated_map, 16)
+    assert compiled.distances is None and compiled.next_hops is None
+    for destination, table in generated_map.routes.items():
+        route = compiled.routes[destination]
+        for node in range(len(generated_map.graph)):
+            assert route.distance_of(node) == int(table.distance[node])
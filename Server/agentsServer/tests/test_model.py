@@ -0,0 +1,59 @@
+from parkAgents.model import ParkModel
+import numpy as np
+import pytest
+
+
+def bike_state(model):
+    """
+    Returns the node of every bike in the model and the number of them that
+    moved in the last step, read from the bikes of either engine instead of
+    the counters of the model.
+    """
+    if model.engine is not None:
+        engine = model.engine
+        return engine.nodes[: engine.count].tolist(), engine.count_moving()
+    bikes = model.bike_agents.values()
+    nodes = [model.graph.node_id(bike.pos) for bike in bikes]
+    return nodes, sum(bike.moving for bike in bikes)
+
+
+def check_counters(model):
+    nodes, moving = bike_state(model)
+    occupied = model.occupancy >= 0
+
+    assert model.bikes_in_model == len(nodes) == int(occupied.sum())
+    # Every bike is on its own road.
+    assert None not in nodes
+    assert len(set(nodes)) == len(nodes)
+    coords = model.graph.coords[nodes]
+    assert occupied[coords[:, 0], coords[:, 1]].all()
+    ids, _, _ = model.bike_arrays()
+    assert sorted(model.occupancy[occupied].tolist()) == sorted(ids.tolist())
+
+    assert model.bikes_moving == moving
+    assert model.bikes_spawned == model.bikes_in_model + model.bikes_arrived
+    stats = model.stats()
+    assert stats["step"] == model.schedule.steps
+    assert stats["bikes_stopped"] == model.bikes_in_model - model.bikes_moving
+    if model.bikes_spawned:
+        assert np.isclose(stats["ratio_alive"] + stats["ratio_arrived"], 1)
+
+
+@pytest.mark.parametrize("engine", ["agents", "vector"])
+@pytest.mark.parametrize("seed", [0, 1])
+def test_counters_match_bikes(shipped_map, engine, seed):
+    model = ParkModel(compiled=shipped_map, engine=engine, verbose=False, seed=seed)
+    check_counters(model)
+    for _ in range(150):
+        if not model.running:
+            break
+        model.step()
+        check_counters(model)
+    assert model.bikes_arrived > 0
+
+
+def test_quiet_by_default(shipped_map, capsys):
+    model = ParkModel(compiled=shipped_map, seed=0)
+    for _ in range(5):
+        model.step()
+    assert capsys.readouterr().out == ""
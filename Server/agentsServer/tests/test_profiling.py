@@ -0,0 +1,29 @@
+from parkAgents.metrics import REGISTRY
+from parkAgents.model import ParkModel
+from parkAgents.profiling import ENGINE, SCHEDULER, SPAWN, STEP
+import pytest
+
+
+def step_seconds():
+    # Seconds of every phase of park_step_seconds, the last value of each
+    # histogram, in this process so far.
+    values = REGISTRY.snapshot()["park_step_seconds"]["values"]
+    return {phase: counts[-1] for (phase,), counts in values.items()}
+
+
+@pytest.mark.parametrize("engine", ["agents", "vector"])
+def test_metrics_phases_match_profile(shipped_map, engine):
+    model = ParkModel(compiled=shipped_map, engine=engine, seed=0, profile=True)
+    before = step_seconds()
+    for _ in range(20):
+        model.step()
+    after = step_seconds()
+
+    phases = {"spawn": SPAWN, "scheduler": SCHEDULER, "total": STEP}
+    if engine == "vector":
+        phases["engine"] = ENGINE
+    else:
+        assert after.get("engine", 0) == before.get("engine", 0)
+    for phase, stack in phases.items():
+        seconds = after[phase] - before.get(phase, 0)
+        assert seconds == pytest.approx(model.profiler.phases[stack][1])
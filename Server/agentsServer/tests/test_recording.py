@@ -0,0 +1,121 @@
+from conftest import map_lines
+from parkAgents.compiled import CompiledMap
+from parkAgents.frames import unpack_frame
+from parkAgents.model import ParkModel
+from parkAgents.recording import (
+    ReplayModel,
+    TraceReader,
+    TraceRecorder,
+    apply_diff,
+    diff_records,
+    sorted_records,
+)
+import numpy as np
+import pytest
+
+MAP = "2023_base.txt"
+
+
+@pytest.fixture(scope="module")
+def compiled(dictionary):
+    return CompiledMap.from_lines(map_lines(MAP), dictionary)
+
+
+@pytest.mark.parametrize("engine", ["agents", "vector"])
+def test_trace_round_trip(compiled, tmp_path, engine):
+    model = ParkModel(
+        map_file=MAP, compiled=compiled, engine=engine, verbose=False, seed=3
+    )
+    path = tmp_path / "run.trace"
+
+    # Bikes and lights of every recorded step, as the model had them.
+    expected = []
+    with TraceRecorder(path, model, MAP, chunk_steps=16) as recorder:
+        expected.append(
+            (
+                model.schedule.steps,
+                sorted_records(*model.bike_arrays()),
+                model.light_states().copy(),
+            )
+        )
+        for _ in range(70):
+            if not model.running:
+                break
+            model.step()
+            recorder.capture()
+            expected.append(
+                (
+                    model.schedule.steps,
+                    sorted_records(*model.bike_arrays()),
+                    model.light_states().copy(),
+                )
+            )
+
+    reader = TraceReader(path)
+    assert len(reader) == len(expected)
+    assert reader.metadata["map"] == MAP
+    assert np.array_equal(reader.tiles().directions, compiled.tiles.directions)
+    # The step that stops the model does not advance it, so the last step
+    # can be recorded twice.
+    last_index = {step: index for index, (step, _, _) in enumerate(expected)}
+    # Steps are read out of order, across chunks.
+    for index in reversed(range(len(expected))):
+        step, records, lights = expected[index]
+        assert reader.steps[index] == step
+        assert reader.index_of(step) == last_index[step]
+        assert np.array_equal(reader.records(index), records)
+        assert np.array_equal(reader.lights(index), lights)
+
+        frame_step, frame_records = unpack_frame(reader.frame(index))
+        assert frame_step == step
+        assert np.array_equal(frame_records, records)
+    assert reader.index_of(expected[-1][0] + 1) is None
+    reader.close()
+
+
+def test_replay_model(compiled, tmp_path):
+    model = ParkModel(map_file=MAP, compiled=compiled, verbose=False, seed=5)
+    path = tmp_path / "run.trace"
+    bikes = [model.bikes()]
+    with TraceRecorder(path, model, MAP, chunk_steps=8) as recorder:
+        for _ in range(20):
+            model.step()
+            recorder.capture()
+            bikes.append(model.bikes())
+
+    replay = ReplayModel(TraceReader(path))
+    for step, expected in enumerate(bikes):
+        assert replay.schedule.steps == step
+        assert sorted(replay.bikes()) == sorted(expected)
+        assert replay.stats()["bikes_in_model"] == len(expected)
+        assert replay.running == (step < len(bikes) - 1)
+        replay.step()
+
+    # The bikes that changed since an earlier step, and the ones that left.
+    replay.seek(15)
+    changed, removed = replay.bikes_since(9)
+    before = {bike[0]: bike for bike in bikes[9]}
+    after = {bike[0]: bike for bike in bikes[15]}
+    assert sorted(changed) == sorted(
+        bike for unique_id, bike in after.items() if before.get(unique_id) != bike
+    )
+    assert removed == sorted(set(before) - set(after))
+    assert replay.bikes_since(16) is None
+
+
+def test_diff_records_round_trip():
+    ids = np.array([4, 1, 9, 7])
+    coords = np.array([[0, 1], [2, 3], [4, 5], [6, 7]])
+    directions = np.array([1, 2, 3, 4], dtype=np.uint8)
+    previous = sorted_records(ids, coords, directions)
+
+    # Bike 1 moves, bike 9 turns, bike 7 leaves and bike 12 spawns.
+    ids = np.array([1, 4, 9, 12])
+    coords = np.array([[2, 4], [0, 1], [4, 5], [8, 9]])
+    directions = np.array([2, 1, 4, 2], dtype=np.uint8)
+    records = sorted_records(ids, coords, directions)
+
+    changed, removed = diff_records(previous, records)
+    assert changed["id"].tolist() == [1, 9, 12]
+    assert removed.tolist() == [7]
+    assert np.array_equal(apply_diff(previous, changed, removed), records)
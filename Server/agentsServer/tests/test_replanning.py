@@ -0,0 +1,66 @@
+from parkAgents.model import ParkModel
+from parkAgents.replanning import INFINITY, STOPPED_COST
+import heapq
+import random
+
+
+def dijkstra(routes, goals, stopped):
+    """
+    Returns a list with the cost from every node to the closest goal, by a
+    Dijkstra search backwards from the goals over the predecessors, where
+    moving into a road with a stopped bike costs STOPPED_COST.
+    """
+    costs = [INFINITY] * len(routes.graph)
+    queue = []
+    for goal in goals:
+        costs[goal] = 0
+        queue.append((0, goal))
+    heapq.heapify(queue)
+    while queue:
+        cost, node = heapq.heappop(queue)
+        if cost > costs[node]:
+            continue
+        through = cost + (STOPPED_COST if stopped[node] else 1)
+        for predecessor in routes.predecessors(node):
+            if through < costs[predecessor]:
+                costs[predecessor] = through
+                heapq.heappush(queue, (through, predecessor))
+    return costs
+
+
+def test_cost_from_matches_dijkstra(shipped_map):
+    model = ParkModel(
+        compiled=shipped_map,
+        engine="agents",
+        verbose=False,
+        seed=3,
+        congestion_detours=True,
+    )
+    detours = model.detours
+    destinations = model.tiles.destinations[:3]
+    for destination in destinations:
+        detours.route(destination)
+
+    sample = random.Random(0)
+    for _ in range(80):
+        model.step()
+        if not model.running:
+            break
+        stopped = detours.stopped_nodes()
+        for destination in destinations:
+            route = detours.route(destination)
+            goals = [
+                model.graph.node_id(road)
+                for road in model.destination_approaches[destination]
+            ]
+            costs = dijkstra(detours, goals, stopped)
+            for node in sample.sample(range(len(costs)), 20):
+                assert route.cost_from(node) == costs[node]
+
+            nodes = sample.sample(range(len(costs)), 3)
+            best = detours.best(destination, nodes)
+            reachable = [node for node in nodes if costs[node] < INFINITY]
+            if reachable:
+                assert costs[best] == min(costs[node] for node in reachable)
+            else:
+                assert best is None
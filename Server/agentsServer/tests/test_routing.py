@@ -0,0 +1,51 @@
+from conftest import bfs_distances
+from parkAgents.compiled import route_tables
+
+
+def check_routes(compiled):
+    graph = compiled.graph
+    for destination in compiled.tiles.destinations:
+        route = compiled.routes[destination]
+        distances = bfs_distances(graph, compiled.approaches[destination])
+        for pos in graph.positions:
+            expected = distances.get(pos, -1)
+            assert route.distance_from(pos) == expected
+
+            # The next road is a successor one step closer, and the route
+            # has as many roads as the distance.
+            next_hop = route.next_hop_from(pos)
+            if expected > 0:
+                assert next_hop in graph.neighbors(pos)
+                assert distances[next_hop] == expected - 1
+                path = route.route_from(pos)
+                assert len(path) == expected
+                assert path[-1] in compiled.approaches[destination]
+            else:
+                assert next_hop is None
+                assert route.route_from(pos) == []
+
+
+def test_route_tables_match_bfs(shipped_map):
+    check_routes(shipped_map)
+
+
+def test_route_tables_match_bfs_on_generated_map(generated_map):
+    check_routes(generated_map)
+
+
+def test_stacked_arrays_are_the_tables(shipped_map):
+    approaches, routes, distances, next_hops = route_tables(
+        shipped_map.tiles, shipped_map.graph
+    )
+    assert approaches == shipped_map.approaches
+    for row, destination in enumerate(shipped_map.tiles.destinations):
+        assert (distances[row] == routes[destination].distance).all()
+        assert (next_hops[row] == routes[destination].next_hop).all()
+
+
+def test_approaches_are_roads_next_to_destinations(shipped_map):
+    for (x, y), roads in shipped_map.approaches.items():
+        assert roads
+        for pos in roads:
+            assert pos in shipped_map.graph
+            assert max(abs(pos[0] - x), abs(pos[1] - y)) == 1
@@ -0,0 +1,259 @@
+from parkAgents.frames import FRAME_HEADER, unpack_frame
+from parkAgents.model import ParkModel
+from parkAgents.recording import TraceRecorder
+from sessions import SessionRegistry, UnknownSession
+import agents_server
+import gzip
+import json
+import pytest
+import time
+
+MAP = "2023_base.txt"
+
+
+def serve(replay_file=None):
+    """
+    Returns a test client of the server, with the registries made again so
+    that every test starts without sessions, and one worker process when
+    the server simulates.
+    """
+    agents_server.replayFile = replay_file
+    agents_server.streams = None
+    agents_server.frames = None
+    agents_server.prefetchers = None
+    agents_server.sessions = (
+        None if replay_file is not None else SessionRegistry(workers=1, max_memory=None)
+    )
+    return agents_server.app.test_client()
+
+
+def shutdown():
+    """Stops the registries made by serve."""
+    if agents_server.streams is not None:
+        for session in list(agents_server.streams.streams):
+            agents_server.streams.stop(session)
+    if agents_server.prefetchers is not None:
+        for session in list(agents_server.prefetchers.prefetchers):
+            agents_server.prefetchers.stop(session)
+    if agents_server.sessions is not None:
+        agents_server.sessions.shutdown()
+    agents_server.replayFile = None
+    agents_server.sessions = None
+
+
+@pytest.fixture(scope="module")
+def trace(tmp_path_factory):
+    model = ParkModel(map_file=MAP, verbose=False, seed=1)
+    path = tmp_path_factory.mktemp("traces") / "run.trace"
+    with TraceRecorder(path, model, MAP, chunk_steps=8) as recorder:
+        for _ in range(20):
+            model.step()
+            recorder.capture()
+    return path
+
+
+@pytest.fixture
+def client():
+    yield serve()
+    shutdown()
+
+
+@pytest.fixture
+def replay_client(trace):
+    yield serve(replay_file=str(trace))
+    shutdown()
+
+
+def test_init_replay(replay_client):
+    response = replay_client.get("/init")
+    assert response.status_code == 200
+    info = response.get_json()
+    assert info["map"] == MAP
+    assert info["engine"] == "replay"
+    assert "warning" not in info
+
+    session = info["session"]
+    agents = replay_client.get(f"/getAgents?session={session}").get_json()
+    assert agents["step"] == 0
+    update = replay_client.get(f"/update?session={session}").get_json()
+    assert update["currentStep"] == 1
+    agents = replay_client.get(f"/getAgents?session={session}").get_json()
+    assert agents["step"] == 1
+
+
+def etag_step(response):
+    # Step in the version of a prefetched frame, the part of its ETag that
+    # follows the session.
+    etag, _ = response.get_etag()
+    version = etag.split("-")[1]
+    assert version.startswith("p")
+    return int(version[1:])
+
+
+def test_prefetched_body_matches_etag(client):
+    session = client.get(f"/init?map={MAP}&seed=2&prefetch=4").get_json()["session"]
+    for _ in range(10):
+        client.get(f"/update?session={session}")
+        agents = client.get(f"/getAgents?session={session}")
+        assert agents.get_json()["step"] == etag_step(agents)
+        stats = client.get(f"/getStats?session={session}")
+        assert stats.get_json()["step"] == etag_step(stats)
+
+
+def test_advance_all_frames(client):
+    session = client.get(f"/init?map={MAP}&seed=2").get_json()["session"]
+    result = client.get(f"/advance?session={session}&steps=5&frames=all").get_json()
+    assert result["steps"] == 5 and result["currentStep"] == 5
+    assert [frame["step"] for frame in result["frames"]] == [1, 2, 3, 4, 5]
+
+    response = client.get(
+        f"/advance?session={session}&steps=3&frames=all&format=binary"
+    )
+    assert response.headers["X-Current-Step"] == "8"
+    steps, offset = [], 0
+    while offset < len(response.data):
+        step, records = unpack_frame(response.data[offset:])
+        steps.append(step)
+        offset += FRAME_HEADER.itemsize + records.nbytes
+    assert steps == [6, 7, 8]
+
+    for steps in [0, 1025]:
+        response = client.get(f"/advance?session={session}&steps={steps}")
+        assert response.status_code == 400
+
+
+def test_cached_frames(client):
+    session = client.get(f"/init?map={MAP}&seed=2").get_json()["session"]
+    client.get(f"/update?session={session}")
+    url = f"/getAgents?session={session}"
+
+    plain = client.get(url)
+    headers = {"If-None-Match": plain.headers["ETag"]}
+    assert client.get(url, headers=headers).status_code == 304
+
+    # The compressed body is another representation, with its own ETag.
+    compressed = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert compressed.headers["ETag"] != plain.headers["ETag"]
+    assert json.loads(gzip.decompress(compressed.data)) == plain.get_json()
+    headers = {"Accept-Encoding": "gzip", "If-None-Match": compressed.headers["ETag"]}
+    assert client.get(url, headers=headers).status_code == 304
+    headers["If-None-Match"] = plain.headers["ETag"]
+    assert client.get(url, headers=headers).status_code == 200
+
+    # Stepping the model makes the frames again.
+    client.get(f"/update?session={session}")
+    stepped = client.get(url, headers={"If-None-Match": plain.headers["ETag"]})
+    assert stepped.status_code == 200
+    assert stepped.get_json()["step"] == plain.get_json()["step"] + 1
+
+
+def apply_delta(agents, delta):
+    """
+    Returns the agents of a /getAgents body by id, with a /getAgents?since=
+    body applied to them.
+    """
+    if delta["full"]:
+        agents = {}
+    else:
+        agents = {
+            unique_id: agent
+            for unique_id, agent in agents.items()
+            if unique_id not in delta["removed"]
+        }
+    agents.update((agent["id"], agent) for agent in delta["agents"])
+    return agents
+
+
+@pytest.mark.parametrize("prefetch", [0, 4])
+def test_agents_since(client, prefetch):
+    init = client.get(f"/init?map={MAP}&seed=2&prefetch={prefetch}").get_json()
+    url = f"/getAgents?session={init['session']}"
+    body = client.get(url).get_json()
+    agents = {agent["id"]: agent for agent in body["agents"]}
+
+    for steps in [1, 1, 3, 1, 5]:
+        for _ in range(steps):
+            client.get(f"/update?session={init['session']}")
+        delta = client.get(f"{url}&since={body['step']}").get_json()
+        # Prefetched frames only keep the changes since the frame before.
+        assert delta["full"] == (prefetch > 0 and steps > 1)
+        body = client.get(url).get_json()
+        assert delta["step"] == body["step"]
+        agents = apply_delta(agents, delta)
+        assert agents == {agent["id"]: agent for agent in body["agents"]}
+
+
+def test_sessions_are_independent(client):
+    first = client.get(f"/init?map={MAP}&seed=2").get_json()["session"]
+    second = client.get("/init?map=2021_base.txt&engine=vector").get_json()
+    assert second["map"] == "2021_base.txt" and second["engine"] == "vector"
+    second = second["session"]
+
+    for _ in range(3):
+        client.get(f"/update?session={first}")
+    assert client.get(f"/getStats?session={first}").get_json()["step"] == 3
+    assert client.get(f"/getStats?session={second}").get_json()["step"] == 0
+
+    client.get(f"/close?session={first}")
+    assert client.get(f"/getAgents?session={first}").status_code == 404
+    assert client.get(f"/update?session={second}").status_code == 200
+    assert client.get("/init?map=missing.txt").status_code == 404
+
+
+def test_registry_closes_least_recently_used():
+    registry = SessionRegistry(workers=1, max_sessions=2, max_memory=None)
+    try:
+        first, _ = registry.create(MAP)
+        second, _ = registry.create(MAP)
+        registry.call(first, "update")
+        third, _ = registry.create(MAP)
+        assert first in registry and third in registry
+        assert second not in registry
+        assert registry.version(first) == 1
+        with pytest.raises(UnknownSession):
+            registry.call(second, "update")
+    finally:
+        registry.shutdown()
+
+
+def test_stream(client):
+    session = client.get(f"/init?map={MAP}&seed=2").get_json()["session"]
+    response = client.get(f"/stream?session={session}&rate=50", buffered=False)
+    assert response.mimetype == "text/event-stream"
+    events = iter(response.response)
+    steps = []
+    while len(steps) < 3:
+        event = next(events)
+        if isinstance(event, bytes):
+            event = event.decode()
+        if event.startswith("data: "):
+            frame = json.loads(event[len("data: ") :])
+            assert frame["currentStep"] == frame["step"]
+            steps.append(frame["step"])
+    assert steps == sorted(steps) and len(set(steps)) == 3
+
+    conflict = client.get(f"/stream?session={session}&rate=5", buffered=False)
+    assert conflict.status_code == 409 and conflict.get_json()["rate"] == 50
+    response.close()
+
+    # The stream pauses without subscribers, instead of stepping the model.
+    stream = agents_server.streams.streams[session]
+    deadline = time.monotonic() + 5
+    while stream.subscribed() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    version = agents_server.sessions.version(session)
+    time.sleep(0.2)
+    assert agents_server.sessions.version(session) == version
+    assert stream.running
+
+    # A client that subscribes again resumes it, at another rate.
+    response = client.get(f"/stream?session={session}&rate=20", buffered=False)
+    assert response.status_code == 200
+    deadline = time.monotonic() + 5
+    while agents_server.sessions.version(session) == version:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert stream.rate == 20
+    response.close()
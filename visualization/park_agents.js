@@ -39,6 +39,16 @@ class WebGLObject {
 const agent_server_uri = "http://localhost:8585/";
 let agent_server_running = true;
 
+// Id of the simulation session returned by the server's /init
+let session = null;
+
+// Server-Sent Events connection used when settings.stream is enabled
+let event_source = null;
+
+// Model step of the last agents received, to only ask for the agents that
+// changed after it
+let agents_step = null;
+
 // Initialize arrays to store agents and map_tiles
 let agents = [];
 const map_tiles = {};
@@ -85,7 +95,16 @@ const settings = {
     background: {
         running: [0.25, 0.5, 0.8, 1],
         stopped: [0.033, 0.046, 0.251, 1],
-    }
+    },
+    // Let the server step the simulation and push the agents, at rate
+    // steps per second, instead of requesting every step.
+    stream: {
+        enabled: false,
+        rate: 2,
+    },
+    // Number of steps the server computes ahead of the client, so that
+    // updates do not wait for the simulation to step.
+    prefetch: 8,
 };
 
 // Initialize the frame count
@@ -147,13 +166,15 @@ async function main() {
 async function initAgentsModel() {
     try {
         // Send a POST request to the agent server to initialize the model
-        let response = await fetch(agent_server_uri + "init")
+        let response = await fetch(agent_server_uri + "init?prefetch=" + settings.prefetch)
 
         // Check if the response was successful
         if (response.ok) {
            // Parse the response as JSON and log the message
            let result = await response.json()
            console.log(result.message)
+           session = result.session;
+           agents_step = null;
            data.width = result.width;
            data.height = result.height;
            settings.light.position.x = data.width;
@@ -166,75 +187,108 @@ async function initAgentsModel() {
 }
 
 /*
- * Retrieves the current positions of all agents from the agent server.
+ * Creates the Object3D of an agent received from the agent server, starting
+ * its animation from the previous state of the same agent, if any.
+ */
+function createAgent(new_agent, old_agent) {
+    let agent = new Object3D(
+        new_agent.id, [new_agent.x, new_agent.y, new_agent.z]
+    );
+
+    switch (new_agent.direction) {
+        case "Right":
+            agent.rotation[1] = Math.PI / 2;
+            break;
+        case "Left":
+            agent.rotation[1] = -Math.PI / 2;
+            break;
+        case "Down":
+            agent.rotation[1] = Math.PI;
+            break;
+    }
+
+    agent.old_position = [
+        new_agent.x, new_agent.y, new_agent.z
+    ];
+    agent.old_rotation = [
+        agent.rotation[0],
+        agent.rotation[1],
+        agent.rotation[2],
+    ];
+
+    if (old_agent != undefined) {
+        agent.old_position = [
+            old_agent.position[0],
+            old_agent.position[1],
+            old_agent.position[2],
+        ];
+        agent.old_rotation = [
+            old_agent.rotation[0],
+            old_agent.rotation[1],
+            old_agent.rotation[2],
+        ];
+        let diff_rot = agent.old_rotation[1] - agent.rotation[1];
+        if (diff_rot > Math.PI) {
+            agent.old_rotation[1] -= 2 * Math.PI;
+        } else if (diff_rot < -Math.PI) {
+            agent.old_rotation[1] += 2 * Math.PI;
+        }
+    }
+
+    return agent;
+}
+
+/*
+ * Updates the agents array with the agents received from the agent server,
+ * either every agent or the ones that changed since agents_step.
+ */
+function applyAgents(result) {
+    const old_agents = new Map(agents.map(agent => [agent.id, agent]));
+
+    // Agents that did not change keep their state and stop animating. A
+    // full response replaces every agent.
+    const new_agents = new Map();
+    if (result.full === false) {
+        for (const [id, agent] of old_agents) {
+            agent.old_position = [...agent.position];
+            agent.old_rotation = [...agent.rotation];
+            new_agents.set(id, agent);
+        }
+        for (const id of result.removed) {
+            new_agents.delete(id);
+        }
+    }
+
+    // Create the agents that changed and add them to the agents array
+    for (const new_agent of result.agents) {
+        new_agents.set(
+            new_agent.id,
+            createAgent(new_agent, old_agents.get(new_agent.id))
+        );
+    }
+    agents = Array.from(new_agents.values());
+    agents_step = result.step;
+}
+
+/*
+ * Retrieves the agents that changed since the last request from the agent
+ * server, or all of them on the first request.
  */
 async function getAgents() {
     try {
         // Send a GET request to the agent server to retrieve the agent positions
-        let response = await fetch(agent_server_uri + "getAgents")
+        let uri = agent_server_uri + "getAgents?session=" + session;
+        if (agents_step !== null) {
+            uri += "&since=" + agents_step;
+        }
+        let response = await fetch(uri)
 
         // Check if the response was successful
         if (response.ok) {
             // Parse the response as JSON
             let result = await response.json()
+            applyAgents(result);
 
-            // Log the agent positions
-            console.log(result.positions)
-
-            // Create new agents and add them to the agents array
-            agents = result.agents.map(
-                new_agent => {
-                    let agent = new Object3D(
-                        new_agent.id, [new_agent.x, new_agent.y, new_agent.z]
-                    );
-
-                    switch (new_agent.direction) {
-                        case "Right":
-                            agent.rotation[1] = Math.PI / 2;
-                            break;
-                        case "Left":
-                            agent.rotation[1] = -Math.PI / 2;
-                            break;
-                        case "Down":
-                            agent.rotation[1] = Math.PI;
-                            break;
-                    }
-
-                    agent.old_position = [
-                        new_agent.x, new_agent.y, new_agent.z
-                    ];
-                    agent.old_rotation = [
-                        agent.rotation[0],
-                        agent.rotation[1],
-                        agent.rotation[2],
-                    ];
-
-                    let old_agent = agents.find(
-                        old_a => old_a.id == new_agent.id
-                    );
-
-                    if (old_agent != undefined) {
-                        agent.old_position = [
-                            old_agent.position[0],
-                            old_agent.position[1],
-                            old_agent.position[2],
-                        ];
-                        agent.old_rotation = [
-                            old_agent.rotation[0],
-                            old_agent.rotation[1],
-                            old_agent.rotation[2],
-                        ];
-                        let diff_rot = agent.old_rotation[1] - agent.rotation[1];
-                        if (diff_rot > Math.PI) {
-                            agent.old_rotation[1] -= 2 * Math.PI;
-                        } else if (diff_rot < -Math.PI) {
-                            agent.old_rotation[1] += 2 * Math.PI;
-                        }
-                    }
-
-                    return agent;
-                }
-            );
             // Log the agents array
             console.log("Agents:", agents)
         }
@@ -252,7 +306,9 @@ async function getMap() {
     try {
         // Send a GET request to the agent server to retrieve the
         // map_tile positions
-        let response = await fetch(agent_server_uri + "getMap")
+        let response = await fetch(
+            agent_server_uri + "getMap?session=" + session
+        )
 
         // Check if the response was successful
         if (response.ok) {
@@ -322,11 +378,17 @@ async function getMap() {
 
 /*
  * Updates the agent positions by sending a request to the agent server.
+ * The model is advanced and the agents that changed are received in the
+ * same request.
  */
 async function update() {
     try {
         // Send a request to the agent server to update the agent positions
-        let response = await fetch(agent_server_uri + "update")
+        let uri = agent_server_uri + "advance?session=" + session;
+        if (agents_step !== null) {
+            uri += "&since=" + agents_step;
+        }
+        let response = await fetch(uri)
 
         // Check if the response was successful
         if (response.ok) {
@@ -340,7 +402,7 @@ async function update() {
                 return
             }
 
-            await getAgents()
+            applyAgents(result.frames[0]);
             // Log a message indicating that the agents have been updated
             console.log("Updated agents")
         }
@@ -350,6 +412,55 @@ async function update() {
     }
 }
 
+/*
+ * Starts receiving the agents from the server's stream, which steps the
+ * simulation on its own.
+ */
+function startStream() {
+    stopStream();
+    event_source = new EventSource(
+        agent_server_uri + "stream?session=" + session +
+        "&rate=" + settings.stream.rate
+    );
+
+    // Every message has all the agents after a step
+    event_source.onmessage = event => {
+        applyAgents(JSON.parse(event.data));
+        // Restart the animation towards the new positions
+        frameCount = 0;
+    };
+
+    event_source.addEventListener("end", () => {
+        agent_server_running = false;
+        console.error("SIMULATION ENDED!", "The stream was closed.");
+        stopStream();
+    });
+
+    // The server refuses a new rate while the previous connection of this
+    // client is still subscribed, so try again until it is closed
+    const source = event_source;
+    source.onerror = () => {
+        if (source.readyState === EventSource.CLOSED && event_source === source) {
+            event_source = null;
+            setTimeout(() => {
+                if (event_source === null && settings.stream.enabled && agent_server_running) {
+                    startStream();
+                }
+            }, 1000);
+        }
+    };
+}
+
+/*
+ * Stops receiving the agents from the server's stream.
+ */
+function stopStream() {
+    if (event_source !== null) {
+        event_source.close();
+        event_source = null;
+    }
+}
+
 /*
  * Draws the scene by rendering the agents and map_tiles.
  *
@@ -427,8 +538,14 @@ async function drawScene(gl, programInfo, agent_WebGL, map_WebGL) {
     // Increment the frame count
     frameCount++
 
-    // Update the scene every 30 frames
-    if (agent_server_running && frameCount % 30 == 0) {
+    // Streamed agents stay at their new position until the next message
+    if (event_source !== null) {
+        frameCount = Math.min(frameCount, 30);
+    }
+
+    // Update the scene every 30 frames, unless the server streams the
+    // agents
+    if (agent_server_running && event_source === null && frameCount % 30 == 0) {
         frameCount = 0;
         await update();
     }
@@ -727,6 +844,27 @@ function setupUI() {
             // Update the camera distance when the slider value changes
             settings.camera.scale.r = value
         });
+
+    // Create a folder for the simulation updates
+    const simFolder = gui.addFolder("Simulation:");
+
+    // Add a checkbox to let the server stream the agents
+    simFolder.add(settings.stream, "enabled").name("Server stream")
+        .onChange( value => {
+            if (value && agent_server_running) {
+                startStream();
+            } else {
+                stopStream();
+            }
+        });
+
+    // Add a slider for the steps per second of the stream
+    simFolder.add(settings.stream, "rate", 1, 30, 1).name("Steps/s")
+        .onFinishChange( () => {
+            if (event_source !== null) {
+                startStream();
+            }
+        });
 }
 
 main()